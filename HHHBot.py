@@ -1,22 +1,33 @@
 # -*- coding: utf-8 -*-
+# Heavy modules (praw, spotipy, tqdm, unidecode) are imported where they are used and clients are built on first
+# use, so a frequent trigger like checkMail only pays for what it runs
 import datetime
+import functools
+import json
 import time
-import praw
-import sqlite3
+import schema
+import storage
+import archive
+import roundup
+import ingest
+import inbox
+import scheduler
+import metrics
+import signal
+import threading
 import os
 import vals
 import sys
-import unidecode
-import numpy as np
 import logger
-import weekly_playlist
-from tqdm import tqdm
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 global log
 log = logger.get_logger(__name__) 
 
 class HHHBot:
-    def __init__(self):
+    def __init__(self, reddit=None, dbPath=None):
+        # reddit and dbPath default to the live account and fresh.db, benchmark.py points them at local fakes
         global log
 
         self.footer = '\n\n---\n\n^(This post was generated by a bot)\n\n^Subscribe ^to ^roundups: ^[[Daily](http://www.' \
@@ -29,24 +40,18 @@ class HHHBot:
                       '%20post%2C%20please%20include%20the%20link%20to%20that%20post.%20Thanks!)]'.format(
             username=vals.username, admin=vals.admin)
 
-        self.db = sqlite3.connect(os.path.join(vals.cwd, "fresh.db"))
+        # For subscribers who get a link rather than the full roundup, formatted with the roundup's title and link
+        self.notice = '{{title}} is up, [read it here]({{url}}).\n\n^(Rather have the whole roundup in your messages?) ' \
+                      '^[[Send me the full text](http://www.reddit.com/message/compose/?to={username}&subject=format' \
+                      '&message=full)]'.format(username=vals.username)
 
-        self.c = self.db.cursor()
-        self.c.execute("CREATE TABLE IF NOT EXISTS subscriptions(USER TEXT, SUBSCRIPTION TEXT)")
-        self.c.execute(
-            "CREATE TABLE IF NOT EXISTS posts (ID TEXT, TITLE TEXT, PERMA TEXT, URL TEXT, TIME INT, SCORE INT, SUBMITTER TEXT)")
-        self.db.commit()
-
-        self.r = praw.Reddit(client_id=vals.client_id, client_secret=vals.client_secret,
-                             password=vals.password, username=vals.username, user_agent=vals.userAgent)
-#        log.error("Test: No reddit instance set")
-        log.setRedditInst(self.r)      
-#        log.error("TEST: Reddit instance set")
-
-        self.prawCharLimit = 10000*0.9
+        self.dbPath = dbPath or os.path.join(vals.cwd, "fresh.db")
+        self.reddit = reddit
+        # Error digests only build the reddit client if there is an error to send
+        log.setRedditInst(lambda: self.r)
 
-        self.sub_posting = self.r.subreddit(vals.subreddit)       
-        self.hhh = self.r.subreddit(vals.hhh)
+        self.prawCharLimit = 10000  # reddit's limit, roundup.size counts parts as reddit does with & < > escaped
+        self.introAllowance = 500  # Room kept free in the first part for the mail/post intro, headers and footer are counted exactly
 
         self.today = datetime.datetime.utcnow().strftime('%A')
         self.ydat = (datetime.datetime.utcnow() - datetime.timedelta(1)).strftime('%A')
@@ -54,367 +59,757 @@ class HHHBot:
         # Config
         self.postScoreThreshold = 50
         self.fetchPostMaxAge = 7 * 24 * 60 * 60  # 1 day
-        self.deletePostAge = 31 * 24 * 60 * 60  # 1 month
-
-    def __del__(self):
-        self.c.close()
+        # [{name, subreddits, tags, ...}] as taken by ingest.Feed, thresholds default to the two above. None for
+        # the one /r/hiphopheads [FRESH] feed
+        self.feeds = getattr(vals, "feeds", None)
+        self.roundupName = ingest.DEFAULT  # The roundup the triggers send out, `python HHHBot.py <trigger> <roundup>` for another
+        self.deletePostAge = 31 * 24 * 60 * 60  # 1 month, older posts are moved to the archive
+        self.archivePath = os.path.join(vals.cwd, "archive.db")
+        self.archiveChunk = archive.CHUNK
+        self.deliveryWorkers = 2  # Concurrent PM senders, all sharing one rate limit token bucket
+        # >1 to share an edition's outbox with worker processes. They all send as vals.username and draw from its
+        # bucket in the store, so they add concurrency when sends are slow but never more than the account's rate
+        self.deliveryProcesses = 1
+        self.deliveryRate = 1.0  # PMs per second until reddit's rate limit headers say otherwise...
+        self.deliveryBurst = 5  # ...and how many can go out at once
+        self.deliveryShards = 16  # Outbox rows are split by a hash of the username, workers claim a shard at a time
+        self.deliveryLease = 5 * 60  # A dead worker's shard is taken over after this long
+        self.publishRoundups = True  # Post each mailing once and PM a link to it, False mails everyone the full text
+        self.publishSubreddit = "u_" + vals.username  # Where mailings are published, weekly ones link to postWeekly's post if it's up
+        self.inboxWorkers = 4  # Concurrent inbox replies
+        self.infoBatchSize = 100  # Max fullnames reddit's /api/info accepts per request
+        self.refreshWorkers = 1  # >1 to resolve info batches concurrently
+        self.refreshBudget = 50  # Max /api/info calls per score refresh
+        self.refreshAgeFactor = 0.25  # A post is next due after a quarter of its age...
+        self.refreshMinInterval = 30 * 60  # ...but no sooner than this
+        self.refreshMaxInterval = 7 * 24 * 60 * 60  # Backoff cap for settled scores
+        self.refreshRoundupInterval = 24 * 60 * 60  # Cap for posts still in the weekly roundup window
+        self.scoreChangeThreshold = 20  # Smaller score changes aren't written and count as settled
+        self.pendingInterval = 10 * 60  # How often the stream re-checks posts below postScoreThreshold
+        self.pendingBudget = 10  # Max /api/info calls per pending check
+        self.streamStopping = threading.Event()
+        self.fetchPageSize = 100  # Posts per listing page, existence is checked once per page
+        self.fetchRescanWindow = 60 * 60  # Overlap with the last run, pending catches posts crossing the score threshold later
+
+        # Daemon schedule, all times UTC
+        self.fetchInterval = 12 * 60 * 60
+        self.inboxInterval = 5 * 60
+        self.dailyHour = 18
+        self.weeklyDay = 6  # Sunday
+        self.weeklyHour = 18
+        self.weeklyMailMinute = 30  # mailWeekly runs this long after postWeekly, so link subscribers get its post
+        self.schedulerJitter = 60
+
+        self.storePoolSize = 4  # Connections per kind (read-write, read-only) in the storage pool
+        # PostgreSQL DSN for the shared tables (storage.py), so several bots can share them. None keeps them in fresh.db
+        self.storeDSN = getattr(vals, "postgres", None)
+        self.httpCachePath = os.path.join(vals.cwd, "http_cache.db")  # Reddit GET responses (httpcache.py), None to not cache
+        self.httpCacheSize = 5000  # Responses kept, in memory and on disk
+
+        self.spotify = None  # spotipy client, None to authorise as the playlist owner on each run
+
+    # Clients and connections, built on first use so they pick up the config above. Assigning one replaces it
+
+    @functools.cached_property
+    def r(self):
+        if self.reddit is not None:
+            return self.reddit
+        import praw
+        kwargs = {}
+        if self.httpCachePath is not None:
+            import httpcache
+            kwargs['requestor_kwargs'] = {'session': httpcache.CachingSession(self.httpCache)}
+        return praw.Reddit(client_id=vals.client_id, client_secret=vals.client_secret, password=vals.password,
+                           username=vals.username, user_agent=vals.userAgent, **kwargs)
+
+    def connect(self):
+        # Another client as the same account for a worker thread, praw isn't thread-safe (delivery.py, inbox.py).
+        # They only send, so they skip the GET cache. A passed in reddit gets a twin on the same endpoints
+        import praw
+        c = self.r.config
+        return praw.Reddit(client_id=c.client_id, client_secret=c.client_secret, password=c.password,
+                           username=c.username, user_agent=c.user_agent, oauth_url=c.oauth_url,
+                           reddit_url=c.reddit_url)
+
+    @functools.cached_property
+    def httpCache(self):
+        import httpcache
+        return httpcache.HTTPCache(self.httpCachePath, size=self.httpCacheSize)
+
+    @functools.cached_property
+    def sub_posting(self):
+        return self.r.subreddit(vals.subreddit)
+
+    @functools.cached_property
+    def pipeline(self):
+        feeds = self.feeds or [{'name': ingest.DEFAULT, 'subreddits': [vals.hhh], 'tags': ['[fresh']}]
+        return ingest.Pipeline([ingest.Feed(**dict({'minScore': self.postScoreThreshold, 'maxAge': self.fetchPostMaxAge}, **f))
+                                for f in feeds])
+
+    @functools.cached_property
+    def listing(self):
+        # Every feed's subreddits joined into one, its /new lists them all
+        return self.r.subreddit(self.pipeline.listing)
+
+    @functools.cached_property
+    def db(self):
+        # Bookkeeping (cursors, pending posts, runs, spotify searches) stays on this connection, posts and their
+        # refresh schedule, subscriptions, the outbox and caches go through self.store and its pooled connections
+        return schema.connect(self.dbPath)
+
+    @functools.cached_property
+    def store(self):
+        if self.storeDSN is not None:
+            return storage.PostgresRepository(self.storeDSN, size=self.storePoolSize)
+        return storage.SQLiteRepository(self.dbPath, size=self.storePoolSize)
+
+    @functools.cached_property
+    def delivery(self):
+        import delivery
+        bucket = delivery.SharedTokenBucket(self.store, "reddit:" + vals.username.lower(), rate=self.deliveryRate,
+                                            capacity=self.deliveryBurst)
+        return delivery.Delivery(self.r, self.store, workers=self.deliveryWorkers, bucket=bucket,
+                                 shards=self.deliveryShards, lease=self.deliveryLease, connect=self.connect)
+
+    @functools.cached_property
+    def roundups(self):
+        return roundup.RoundupCache(self.store)
+
+    @functools.cached_property
+    def inbox(self):
+        return inbox.Inbox(self.r, self.store, self.footer, workers=self.inboxWorkers, connect=self.connect)
+
+    def close(self):
+        # Only what was opened
+        if 'db' in self.__dict__:
+            self.db.commit()
+            self.db.close()
+        if 'store' in self.__dict__:
+            self.store.close()
+        if 'httpCache' in self.__dict__:
+            self.httpCache.close()
+
+    def getCursor(self, name):
+        return self.db.execute("SELECT FULLNAME, TIME FROM cursors WHERE NAME=?", (name,)).fetchone()
+
+    def setCursor(self, name, fullname, created):
+        self.db.execute("INSERT OR REPLACE INTO cursors VALUES (?,?,?)", (name, fullname, created))
+
+    def newCursor(self):
+        # Named after the listing, so changing the feeds' subreddits starts over. Plain 'new' is /r/hiphopheads alone
+        return 'new' if self.pipeline.listing == vals.hhh else 'new:' + self.pipeline.listing.lower()
+
+    @metrics.timed("fetchNewPosts")
+    def fetchNewPosts(self, backfill=False):
+        # Walk /new of every feed's subreddit at once until we are fetchRescanWindow behind the last run's newest
+        # post. A backfill (or the very first run) ignores the cursor and walks the whole listing up to the
+        # longest maxAge of the feeds
+        cursor = None if backfill else self.getCursor(self.newCursor())
+        stopTime = cursor[1] - self.fetchRescanWindow if cursor is not None else 0
+        newest = cursor
+        page = []
+        seen = 0
+        inserted = 0
+        for post in self.listing.new(limit=5000):
+            if time.time() - post.created_utc > self.pipeline.maxAge or post.created_utc < stopTime:
+                break
+            if newest is None or post.created_utc > newest[1]:
+                newest = (post.fullname, post.created_utc)
+            seen += 1
+            page.append(post)
+            if len(page) == self.fetchPageSize:
+                inserted += self.storeNewPosts(page)
+                page = []
+        inserted += self.storeNewPosts(page)
+
+        if newest is not None:
+            self.setCursor(self.newCursor(), newest[0], newest[1])
         self.db.commit()
-        self.db.close()
-
-    def fetchNewPosts(self):
-        for post in self.hhh.new(limit=5000):
-            if '[fresh' in post.title.lower() and post.score > self.postScoreThreshold and time.time() - post.created_utc < self.fetchPostMaxAge:  # [fresh...] tag, high enough score, and not too old
-
-                self.c.execute("SELECT * FROM posts WHERE ID=?", (post.id,))
-
-                if self.c.fetchone() is None:
-                    id_ = unidecode.unidecode(post.id)
-                    title = unidecode.unidecode(post.title.replace("[", "\[").replace("]", "\]").replace("|", "\|"))
-                    permalink = unidecode.unidecode('https://redd.it/' + id_)
-                    url = unidecode.unidecode(post.url)
-                    created = post.created_utc
-                    score = post.score
-                    submitter = unidecode.unidecode(post.author.name)
-
-
-                    log.debug("Fresh post found - name {title}, id {id}, score {score}, age {age} hrs".format(
-                        title=title,
-                        id=id_,
-                        score=score,
-                        age=round((time.time() - created) / (60 * 60), 2)))
-                    self.db.execute("INSERT INTO posts VALUES (?,?,?,?,?,?,?)",
-                                    (id_, title, permalink, url, created, score, submitter))
+        metrics.incr(metrics.API_CALLS, -(-seen // self.fetchPageSize))
+        metrics.incr(metrics.ROWS_SCANNED, seen)
+        metrics.incr(metrics.ROWS_WRITTEN, inserted)
+        log.info("Checked {seen} posts ({pages} pages) from /r/{sub}/new, {inserted} new fresh posts{backfill}".format(
+            seen=seen,
+            pages=-(-seen // self.fetchPageSize),
+            sub=self.pipeline.listing,
+            inserted=inserted,
+            backfill=" (backfill)" if backfill else ""))
+
+    def storeNewPosts(self, page):
+        # Posts a feed takes (ingest.Pipeline.route) go into posts for its roundup when their score is above the
+        # feed's minScore and into pending otherwise, where promotePending keeps checking them
+        import unidecode
+        candidates = []
+        for post in page:
+            feed = self.pipeline.route(post.subreddit.display_name, post.title)
+            if feed is not None and time.time() - post.created_utc <= feed.maxAge:
+                candidates.append((post, feed))
+        if not candidates:
+            return 0
+
+        # One existence check for the whole page rather than a SELECT per post
+        known = self.store.knownPosts([unidecode.unidecode(post.id) for post, feed in candidates])
+
+        rows = []
+        pending = []
+        for post, feed in candidates:
+            id_ = unidecode.unidecode(post.id)
+            if id_ in known:
+                continue
+            title = unidecode.unidecode(post.title.replace("[", "\\[").replace("]", "\\]").replace("|", "\\|"))
+            permalink = unidecode.unidecode('https://redd.it/' + id_)
+            url = unidecode.unidecode(post.url)
+            created = post.created_utc
+            score = post.score
+            submitter = unidecode.unidecode(post.author.name)
+
+            if score <= feed.minScore:
+                pending.append((id_, title, permalink, url, created, score, submitter, int(time.time()), feed.name))
+                continue
+            log.debug("{feed} post found - name {title}, id {id}, score {score}, age {age} hrs".format(
+                feed=feed.name.capitalize(),
+                title=title,
+                id=id_,
+                score=score,
+                age=round((time.time() - created) / (60 * 60), 2)))
+            rows.append(roundup.postRow((id_, title, permalink, url, created, score, submitter), feed.roundup))
+            known.add(id_)
+        self.store.addPosts(rows)
+        self.db.executemany("DELETE FROM pending WHERE ID = ?", [(f[0],) for f in rows])
+        self.db.executemany("INSERT OR REPLACE INTO pending (ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER, CHECKED, FEED) "
+                            "VALUES (?,?,?,?,?,?,?,?,?)", pending)
+        self.db.commit()  # The store writes on its own connections, they'd wait on an open transaction here
+        return len(rows)
+
+    @metrics.timed("promotePending")
+    def promotePending(self):
+        # Re-check pending posts, moving those that crossed their feed's minScore into posts. Posts that stay below
+        # it for the feed's maxAge are dropped, as are those of feeds no longer configured
+        t = time.time()
+        expired = 0
+        for feed in self.pipeline.feeds:
+            expired += self.db.execute("DELETE FROM pending WHERE FEED = ? AND TIME < ?",
+                                       (feed.name, time.time() - feed.maxAge)).rowcount
+        expired += self.db.execute("DELETE FROM pending WHERE FEED NOT IN ({})".format(",".join("?" * len(self.pipeline.feeds))),
+                                   [f.name for f in self.pipeline.feeds]).rowcount
+        feeds = dict((row[0], self.pipeline.byName[row[1]]) for row in self.db.execute(
+            "SELECT ID, FEED FROM pending ORDER BY CHECKED LIMIT ?", (self.pendingBudget * self.infoBatchSize,)))
+        ids = list(feeds)
+        scores = {}
+        for i in range(0, len(ids), self.infoBatchSize):
+            scores.update(self.fetchScores(ids[i:i + self.infoBatchSize]))
+
+        promoted = [(id_,) for id_, score in scores.items() if score > feeds[id_].minScore]
+        # Removed posts aren't returned, their CHECKED still moves so they don't hog the front of the queue
+        self.db.executemany("UPDATE pending SET SCORE=COALESCE(?, SCORE), CHECKED=? WHERE ID=?",
+                            [(scores.get(id_), int(time.time()), id_) for id_ in ids])
         self.db.commit()
-
+        self.store.addPosts([roundup.postRow(self.db.execute(
+            "SELECT ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER FROM pending WHERE ID = ?", f).fetchone(),
+            feeds[f[0]].roundup) for f in promoted])
+        self.db.executemany("DELETE FROM pending WHERE ID = ?", promoted)
+        self.db.commit()
+        metrics.incr(metrics.API_CALLS, -(-len(ids) // self.infoBatchSize))
+        metrics.incr(metrics.ROWS_WRITTEN, len(promoted))
+        log.info("Checked {n} pending posts in {s}s, {p} promoted and {e} expired".format(
+            n=len(ids), s=round(time.time() - t, 2), p=len(promoted), e=expired))
+        return len(promoted)
+
+    def stream(self):
+        # Long running intake from the /new submission stream. New candidates are stored as soon as the stream
+        # catches up and pending posts are re-checked every pendingInterval, each check saved as a metrics run
+        self.streamStopping.clear()
+        signal.signal(signal.SIGTERM, lambda *args: self.streamStopping.set())
+        signal.signal(signal.SIGINT, lambda *args: self.streamStopping.set())
+        log.info("Streaming new posts from /r/{}".format(self.pipeline.listing))
+        page = []
+        promoted = 0
+        for post in self.listing.stream.submissions(pause_after=0, exception_handler=lambda e: log.warning(
+                "Submission stream error, retrying: {}".format(e))):
+            if self.streamStopping.is_set():
+                break
+            if post is not None:
+                page.append(post)
+                if len(page) < self.fetchPageSize:
+                    continue
+            if page:
+                metrics.incr(metrics.ROWS_WRITTEN, self.storeNewPosts(page))
+                newest = max(page, key=lambda f: f.created_utc)
+                cursor = self.getCursor(self.newCursor())
+                if cursor is None or newest.created_utc > cursor[1]:
+                    # fetchNewPosts then only has to walk back over the rescan window
+                    self.setCursor(self.newCursor(), newest.fullname, newest.created_utc)
+                self.db.commit()
+                metrics.incr(metrics.ROWS_SCANNED, len(page))
+                page = []
+            if time.time() - promoted > self.pendingInterval:
+                self.recorded("stream", self.promotePending)()
+                promoted = time.time()
+        log.info("Submission stream stopped")
+
+    @metrics.timed("garbageDisposal")
     def garbageDisposal(self):
-        
-        if vals.DEV:                
-            self.c.execute("SELECT * FROM posts WHERE (TIME<{t}) OR (SCORE<{s} AND TIME<{t})".format(
-                t=time.time() - self.deletePostAge,  # Select all posts where the unix time of the posts creation is lower than current time - posts creation time
-                s=self.postScoreThreshold
-            ))
-
-            print(len(self.c.fetchall()))
-
-        else:
-            self.c.execute("DELETE FROM posts WHERE (TIME<{t}) OR (SCORE<{s} AND TIME<{t})".format(
-                t=time.time() - self.deletePostAge,  # Select all posts where the unix time of the posts creation is lower than current time - posts creation time
-                s=self.postScoreThreshold
-            ))
-            self.db.commit()
+        # Posts older than deletePostAge move to the archive, the hot table only keeps what roundups and score
+        # refreshes read
+        before = time.time() - self.deletePostAge
+        if vals.DEV:
+            print(self.store.postCount(before))
+            return 0
 
-    def updateScore(self):
+        store = archive.Archive(self.archivePath)
+        try:
+            return store.move(self.store, before, self.archiveChunk)
+        finally:
+            store.close()
+
+    def fetchScores(self, ids):
+        # One /api/info request resolves up to self.infoBatchSize posts
+        fullnames = ['t3_' + id_ for id_ in ids]
+        return dict((post.id, post.score) for post in self.r.info(fullnames=fullnames))
+
+    def refreshInterval(self, age, interval, change):
+        # Seconds until a post is checked again. Young posts are checked often, and a settled score (no change
+        # worth writing) doubles the interval each time up to refreshMaxInterval
+        base = min(max(age * self.refreshAgeFactor, self.refreshMinInterval), self.refreshMaxInterval)
+        if interval is not None and abs(change) <= self.scoreChangeThreshold:
+            base = min(max(interval * 2, base), self.refreshMaxInterval)
+        if age < self.fetchPostMaxAge:
+            # Still in the weekly roundup window
+            base = min(base, self.refreshRoundupInterval)
+        return int(base)
+
+    @metrics.timed("updateScore")
+    def updateScore(self, now=None):
+        # Only posts that are due, most overdue (and never refreshed) first, at most refreshBudget API calls
+        from tqdm import tqdm
         log.debug("Starting update scores process")
         t = time.time()
-        self.c.execute("SELECT * FROM posts")
-        posts = self.c.fetchall()
-        for row in tqdm(posts):
-            id_ = row[0]
-            oldScore = row[5]
-            post = self.r.submission(id=id_)
-            score = post.score
-            if abs(score-oldScore)>20: #Only significant changes
+        now = time.time() if now is None else now
+        due = self.store.duePosts(now, self.refreshBudget * self.infoBatchSize)
+        total = self.store.postCount()
+        ids = [f[0] for f in due]
+        batches = [ids[i:i + self.infoBatchSize] for i in range(0, len(ids), self.infoBatchSize)]
+
+        scores = {}
+        if self.refreshWorkers > 1:
+            pool = ThreadPool(self.refreshWorkers)
+            try:
+                for batch in tqdm(pool.imap_unordered(self.fetchScores, batches), total=len(batches)):
+                    scores.update(batch)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for batch in tqdm(batches):
+                scores.update(self.fetchScores(batch))
+
+        updates = []
+        schedule = []
+        history = []
+        for id_, oldScore, created, lastScore, interval in due:
+            # Removed posts aren't returned, they back off like a settled score
+            score = scores.get(id_, oldScore)
+            if abs(score-oldScore)>self.scoreChangeThreshold: #Only significant changes
                 log.debug("Post id {id} updated to new score {score} (change of {change})".format(
                     id=id_,
                     score=score,
                     change=oldScore - score))
-                self.db.execute("UPDATE posts SET SCORE=? WHERE ID=?", (score, id_))
-        self.db.commit()
-        log.debug("Finished update scores process in {}s".format(time.time()-t))
-
+                updates.append((score, id_))
+            if id_ in scores and score != lastScore:
+                history.append((id_, int(now), score))
+            interval = self.refreshInterval(now - created, interval, score - (oldScore if lastScore is None else lastScore))
+            schedule.append((id_, int(now), score, interval, int(now) + interval))
+        self.store.updateScores(updates)
+        self.store.scheduleRefresh(schedule, history)
+        metrics.incr(metrics.API_CALLS, len(batches))
+        metrics.incr(metrics.ROWS_SCANNED, len(ids))
+        metrics.incr(metrics.ROWS_WRITTEN, len(updates))
+
+        elapsed = time.time()-t
+        log.info("Refreshed {n} of {total} posts ({u} updated) in {s}s, {rate} rows/s. {calls} API calls, {saved} saved by "
+                 "batching and {skipped} posts not due yet".format(
+            n=len(ids),
+            total=total,
+            u=len(updates),
+            s=round(elapsed, 2),
+            rate=round(len(ids)/elapsed, 1) if elapsed else len(ids),
+            calls=len(batches),
+            saved=len(ids)-len(batches),
+            skipped=total-len(ids)))
+        if len(ids) == self.refreshBudget * self.infoBatchSize:
+            log.warning("Score refresh hit its budget of {} API calls, overdue posts are left for the next run".format(
+                self.refreshBudget))
+        log.debug("Finished update scores process in {}s".format(elapsed))
+
+    @metrics.timed("checkInbox")
     def checkInbox(self):
-        for pm in self.r.inbox.unread():
-            response = ""
-
-            subject = pm.subject.lower()
-            body = pm.body.lower()
-            try:
-                author = pm.author.name
-            except AttributeError:
-                author = "None"
-
-            if not pm.was_comment:
-                no_resp = False
-                if "unsubscribe" in subject:
-                    if 'daily' in body:
-                        response = self.unsubscribeUser(author, 'daily')
-                    elif 'weekly' in body:
-                        response = self.unsubscribeUser(author, 'weekly')
-                    elif 'remove' in body:
-                        response = self.unsubscribeUser(author, 'both')
-                    else:
-                        log.info("Unsubscribe message from {} could not be understood".format(author))
-                        response = 'I couldn\'t understand your message. Please use one of the links below to subscribe!'
-
-                elif "subscribe" in subject:
-                    if 'daily' in body:
-                        response = self.subscribeUser(author, 'daily')
-                    elif 'weekly' in body:
-                        response = self.subscribeUser(author, 'weekly')
-                    elif 'both' in body:
-                        response = self.subscribeUser(author, 'both')
-                    else:
-                        log.info("Subscribe message from {} could not be understood".format(author))
-                        response = 'I couldn\'t understand your message. Please use one of the links below to subscribe!'
-
-                else:
-                    log.info("Message from {author} has been forwarded to admin".format(author=author))
-                    try:
-                        self.r.redditor(vals.admin).message('PM from /u/{}'.format(author),
-                                                        "Message from /u/{author}\n\nSubject: {subject} \n\n---\n\n {body}".format(
-                                                            author=author,
-                                                            subject=subject,
-                                                            body=body.decode('utf_8')
-                                                        ) + self.footer)
-                    except UnicodeEncodeError as err:
-                        self.r.redditor(vals.admin).message('PM from /u/{} (error in code)'.format(author),
-                                "Error in code {err}, check logs on RPi".format(err=err))
-                    response = 'I received your message, but I\'m just a bot! I forwarded it to my admin {admin} who will take a look at it when he "\
-                                "gets a chance.\n\nIf it\'s urgent, you should PM them directly.\n\nIf you\'re trying to subscribe to one of the roundups,"\
-                                 "use the links below.\n\nThanks!'.format(admin=vals.admin)
-                    no_resp = True
-                #log.debug("no_resp = {}".format(no_resp))
-
-                try:
-                    if not no_resp:
-                        pm.reply(response+self.footer)
-                except Exception:
-                    log.exception("Failed to send message to {} with body {}".format(author, response))
-            else:
-                log.info("Forwarding comment message to admin")
-                self.r.redditor(vals.admin).message('Comment from /u/{}'.format(author),
-                                                    'Message from /u/{author}\n\nSubject: {subject}\n\nContext: {context}\n\n---\n\n{body}'.format(
-                                                        author=author,
-                                                        subject=subject,
-                                                        context=pm.context,
-                                                        body=body
-                                                    ))
-            pm.mark_read()
+        return self.inbox.process()
 
     def subscribeUser(self, user, subscription):
-        self.c.execute("SELECT * FROM subscriptions WHERE USER = ?", (user,))
-        msg = ''
-        val = self.c.fetchone()
-        if val is None:
-            self.c.execute("INSERT INTO subscriptions VALUES (?,?)", (user, subscription))
-            log.info("Subscribed {} to {}".format(user, subscription))
-            msg = "You have been subscribed to the {} mailing list".format(subscription)
-        else:
-                if val[1] == subscription:
-                    log.info("User {} already subscribed to {} mailing list".format(user, subscription))
-                    msg = "You are already subscribed to the {} mailing list!".format(subscription)
-                else:
-                    self.c.execute("UPDATE subscriptions SET SUBSCRIPTION=? WHERE USER=?", ("both", user))
-                    log.info("Subscribed {} to both".format(user))
-                    msg = "You have been subscribed to both mailing lists!"
-        self.db.commit()
-        return msg
+        return self.changeSubscription(user, inbox.subscribe, subscription)
 
     def unsubscribeUser(self, user, unsubscribeFrom):
-        self.c.execute('SELECT * FROM subscriptions WHERE USER = ?', (user,))
-        val = self.c.fetchone()
-        msg = ''
-        if val is None:
-            msg = 'Unable to unsubscribe because you are not currently subscribed to any mailing lists.'
-        else:
-            if val[1] == "both" and unsubscribeFrom != "both":
-                if unsubscribeFrom == "daily":
-                    self.c.execute("UPDATE subscriptions SET SUBSCRIPTION=? WHERE USER=?", ("weekly", user))
-                    msg = 'You have been unsubscribed from the daily mailing list.'
-                    log.info("Unsubscribing {} from daily mailing lists".format(user))
-                elif unsubscribeFrom == "weekly":
-                    self.c.execute("UPDATE subscriptions SET SUBSCRIPTION=? WHERE USER=?", ("daily", user))
-                    log.info("Unsubscribing {} from daily weekly lists".format(user))
-                    msg = 'You have been unsubscribed from the weekly mailing list.'
-            else:
-                self.c.execute('DELETE FROM subscriptions WHERE USER = ?', (user,))
-                log.info("Unsubscribing {} from all mailing lists".format(user))
-                msg = 'You have been unsubscribed from both mailing lists. Sorry to see you go!'
-        self.db.commit()
+        return self.changeSubscription(user, inbox.unsubscribe, unsubscribeFrom)
+
+    def changeSubscription(self, user, action, mailingList):
+        current = self.store.subscriptions([user])
+        state = dict(current)
+        state[user], msg = action(current.get(user), mailingList)
+        inbox.applyChanges(self.store, current, state)
+        log.info("{} {} ({}): now {}".format(action.__name__.capitalize(), user, mailingList, state[user]))
         return msg
 
-    def generate(self, timeStart, timeEnd):
-
-        self.c.execute("SELECT * FROM posts WHERE TIME<? AND TIME>? ORDER BY SCORE DESC", (timeStart,timeEnd))
-
+    def render(self, timeStart, timeEnd, name=None):
+        # Rows were rendered at ingest (roundup.fragments) with the score cell filled in by the query, so this
+        # only groups them by their stored day, best first within each. name defaults to roundupName
         dict_ = {}
-
-
-        for post in self.c:
-
-            id_ = post[0]
-            title = post[1].replace("|", ":") # backslash doesn't escape the | on reddit
-            perma = post[2]
-            url = post[3]
-            t = post[4]
-            key = datetime.datetime.utcfromtimestamp(t).strftime("%A, %B %-d, %Y")
-            score = post[5]
-            submitter = post[6]
-
-            entry = '[{title}]({url}) | [link]({perma}) | {score} | /u/{submitter}\n'.format(title=title, url=url, perma=perma, score=score, submitter=submitter)
-
-            if key not in dict_.keys():
-                dict_[key] = []
-
-            dict_[key].append(entry)
-
-
-        msg = []
-        for key in dict_.keys():
-            text = ""
-            text = text + "**"+key+"**" + "\n\nPost | link | Score | User \n :--|:--|:--|:--|\n"
-            for item in dict_[key]:
-                text += item
-            text+="\n\n"
-            msg.append((text,key,time.mktime(datetime.datetime.strptime(key, "%A, %B %d, %Y").timetuple())))
-
-        msg.sort(key=lambda x: x[2])
-
-        return msg
-
-    def mailDaily(self):
+        rows = self.store.roundupRows(timeStart, timeEnd, name or self.roundupName)
+        for day, entry in rows:
+            if day not in dict_:
+                dict_[day] = []
+            dict_[day].append(entry)
+        metrics.incr(metrics.ROWS_SCANNED, len(rows))
+
+        return [(roundup.dayLabel(day), dict_[day], day) for day in sorted(dict_.keys())]
+
+    @metrics.timed("generate")
+    def roundup(self, timeStart, timeEnd, name=None):
+        # Rendered once per roundup, window and data version, mailWeekly and postWeekly share the result
+        name = name or self.roundupName
+        version = self.roundups.version(name, timeStart, timeEnd)
+        entry = self.roundups.get(name, timeStart, timeEnd, version)
+        if entry is None:
+            days = self.render(timeStart, timeEnd, name)
+            msg = [(roundup.dayText(key, entries), key, day) for key, entries, day in days]
+            entry = self.roundups.put(name, timeStart, timeEnd, version, msg, self.split(days))
+        return entry
+
+    def generate(self, timeStart, timeEnd, name=None):
+        return self.roundup(timeStart, timeEnd, name)['days']
+
+    def split(self, days):
+        # Budget every part for the "Part N" header and footer, and the first one for the mail/post intro too
+        return list(roundup.split(((key, entries) for key, entries, day in days), self.prawCharLimit,
+                                  reserve=roundup.PART_HEADER.format(99) + self.footer,
+                                  firstReserve=" " * self.introAllowance))
+
+    @metrics.timed("mailDaily")
+    def mailDaily(self, name=None):
         log.debug("mailDaily has been run")
+        name = name or self.roundupName
+        if not self.mailed(name):
+            return
         #self.updateScore()
         #log.debug("score has been updated")
-        message = self.generate(time.time(), time.mktime(((datetime.datetime.utcnow()-datetime.timedelta(1)).timetuple())))
-        intro = 'Welcome to The Daily [Fresh]ness! Fresh /r/hiphopheads posts delivered right to your inbox ever day.\n\n'
+        message = self.generate(time.time(), time.mktime(((datetime.datetime.utcnow()-datetime.timedelta(1)).timetuple())), name)
+        intro = 'Welcome to The Daily [Fresh]ness! Fresh {} posts delivered right to your inbox ever day.\n\n'.format(self.sources(name))
 
         text = intro
         for day in message:
             text += day[0]
-        text += self.footer
         log.debug("Message has been selected")
-        self.c.execute('SELECT * FROM subscriptions WHERE SUBSCRIPTION = ? OR SUBSCRIPTION = ?', ('daily', 'both',))
-        log.debug("sqlite3 select command has been run")
-        i = 0
-        for row in self.c:
-            log.debug("Mailing {} their daily message".format(row[0]))
-            formattedDatetime = datetime.datetime.utcfromtimestamp(time.time()).strftime("%A, %B, %-d, %Y")
-            try:
-                self.r.redditor((row[0])).message("The Daily Freshness for {}".format(formattedDatetime), text) #message[0][1]), text)
-            except Exception as e:
-                log.error("Error caught: "+e)
+        formattedDatetime = datetime.datetime.utcfromtimestamp(time.time()).strftime("%A, %B, %-d, %Y")
+        title = "The Daily Freshness for {}".format(formattedDatetime)
+        edition = self.edition("daily", name, datetime.datetime.utcnow())
 
-            i+=1
-        log.info("Sent {i} people their daily message".format(i=i))
+        sent, users = self.mailRoundup(edition, ['daily', 'both'], title, [title], [text])
+        log.info("Sent {i} people their daily message".format(i=sent['sent']))
 
-    def mailWeekly(self):
+    @metrics.timed("mailWeekly")
+    def mailWeekly(self, name=None):
         #self.updateScore()
+        name = name or self.roundupName
+        if not self.mailed(name):
+            return
 	
-        message = self.generate(time.time(), time.mktime(((datetime.datetime.utcnow()-datetime.timedelta(7)).timetuple())))
-        intro = 'Welcome to The Weekly [Fresh]ness! Fresh /r/hiphopheads posts delivered right to your inbox every week.\n\n'
+        week = self.roundup(time.time(), time.mktime(((datetime.datetime.utcnow()-datetime.timedelta(7)).timetuple())), name)
+        message = week['days']
+        intro = 'Welcome to The Weekly [Fresh]ness! Fresh {} posts delivered right to your inbox every week.\n\n'.format(self.sources(name))
 
-        text = intro
-        parts = []
-        for day in message:
-            print(day[1], len(day[0]))
-            tempText = text + day[0]
-            if len(tempText) > self.prawCharLimit:
-                parts.append(text)
-                tempText = day[0]
-            text = tempText
-        parts.append(text) #To account for if the last day exceeds the prawCharLimit, or there is only one part
-
-        parts[len(parts)-1]+=self.footer
-
-        self.c.execute('SELECT * FROM subscriptions WHERE SUBSCRIPTION = ? OR SUBSCRIPTION = ?', ('weekly', 'both',))
-        users= self.c.fetchall()
-        i = 0
-        for part in range(len(parts)):
-            for row in users:
-                if len(parts) == 1:
-                    log.debug("Mailing {} their weekly message".format(row[0]))
-                    self.r.redditor((row[0])).message("The Weekly Freshness for the week beginning {}".format(message[0][1]), parts[part])
-                else:
-                    log.debug("Mailing {} their weekly message part {}".format(row[0], part+1))
-                    try:
-                        self.r.redditor((row[0])).message("The Weekly Freshness for the week beginning {} : Part {}".format(message[0][1], part+1), parts[part])
-                    except Exception as e:
-                        log.error("Error caught:" + e)
+        parts = list(week['parts'])
+        parts[0] = intro + parts[0]
 
-                i+=1
-        log.info("Sent {i} weekly messages to {u} people".format(i=i, u=len(users)))
-
-    def postWeekly(self):
-        #self.updateScore()
-        if vals.DEV:
-            sub = self.r.subreddit("testingsubforbot123")
+        title = "The Weekly Freshness for the week beginning {}".format(message[0][1])
+        if len(parts) == 1:
+            subjects = [title]
         else:
-            sub = self.sub_posting
-        message = self.generate(time.time(), time.mktime(((datetime.datetime.utcnow()-datetime.timedelta(7)).timetuple())))
+            subjects = ["{} : Part {}".format(title, part+1) for part in range(len(parts))]
+
+        # Link subscribers get postWeekly's post if it is already up rather than a second copy on the bot's profile.
+        # Mailing never posts to the subreddit itself, a failed or banned post mustn't hold up anyone's message
+        edition = self.weeklyEdition(name)
+        sent, users = self.mailRoundup(edition, ['weekly', 'both'], title, subjects, parts,
+                                       self.published(self.postingSub(), edition))
+        log.info("Sent {i} weekly messages to {u} people".format(i=sent['sent'], u=users))
+
+    def edition(self, kind, name, day):
+        # daily-2020-05-04, weekly-... for the default roundup as before feeds, <roundup>-weekly-... for the others
+        edition = kind + "-" + day.strftime("%Y-%m-%d")
+        return edition if name == ingest.DEFAULT else name + "-" + edition
+
+    def weeklyEdition(self, name=None):
+        return self.edition("weekly", name or self.roundupName, datetime.datetime.utcnow()-datetime.timedelta(7))
+
+    def mailed(self, name):
+        # Subscriptions don't name a roundup, subscribers get the default one. The others are only posted
+        if name != ingest.DEFAULT:
+            log.error("Only the {} roundup is mailed, post {} with postWeekly".format(ingest.DEFAULT, name))
+            return False
+        return True
+
+    def sources(self, name):
+        # Where a roundup's posts come from, for the intros
+        if name == ingest.DEFAULT:
+            return "/r/hiphopheads"
+        return ", ".join("/r/" + s for f in self.pipeline.feeds if f.roundup == name for s in f.subreddits)
+
+    def mailRoundup(self, edition, lists, title, subjects, parts, url=None):
+        # parts come without the footer. Subscribers who asked for the full text get every part, everyone else one
+        # short message linking to url, or to the roundup published once per edition on the bot's profile. Returns
+        # the delivery counts and the number of people mailed
+        if self.publishRoundups:
+            full = self.store.subscribers(lists, 'full')
+            short = self.store.subscribers(lists, 'link')
+        else:
+            full, short = self.store.subscribers(lists), []
+
+        messages = list(parts)
+        messages[-1] += self.footer
+        # One flat job per (user, part), the outbox makes a re-run pick up where a crashed one stopped
+        self.delivery.enqueue(edition, list(zip(subjects, messages)), full)
+        sent = self.deliver(edition)
+        if short:
+            if url is None:
+                url = self.publish(edition, title, parts)
+            self.delivery.enqueue(edition + "-link", [(title, self.notice.format(title=title, url=url) + self.footer)], short)
+            counts = self.deliver(edition + "-link")
+            sent = {'sent': sent['sent'] + counts['sent'], 'failed': sent['failed'] + counts['failed']}
+        return sent, len(full) + len(short)
+
+    def publish(self, edition, title, parts, sub=None):
+        # Submits a roundup once, the first part as a self post and any others as a chain of replies, to sub or the
+        # bot's profile. Every part's text is saved before anything is posted and each fullname as soon as it is,
+        # so a re-run carries on after the last part that went up with the first run's text (title and parts are
+        # then ignored, they may be None). Returns the link to the post
+        if sub is None:
+            sub = self.r.subreddit(self.publishSubreddit)
+        if self.store.publication(sub.display_name, edition) is None:
+            texts = [part + self.footer for part in parts]
+            if len(parts) > 1:
+                texts = [roundup.PART_HEADER.format(i+1) + text for i, text in enumerate(texts)]
+            self.store.startPublication(sub.display_name, edition, title, texts)
+        title, saved = self.store.publication(sub.display_name, edition)
+
+        posted = len([f for f in saved if f[2] is not None])
+        if posted:
+            log.info("{} of {} parts of {} already on {}".format(posted, len(saved), edition, sub.display_name))
+        things = []
+        for part, text, thing in saved:
+            if thing is None:
+                if not things:
+                    thing = sub.submit(title, selftext=text).fullname
+                else:
+                    log.debug("Submitting part {}/{} to {}".format(part+1, len(saved), sub.display_name))
+                    thing = self.thing(things[-1]).reply(text).fullname
+                self.store.markPublished(sub.display_name, edition, part, thing)
+                metrics.incr(metrics.API_CALLS)
+            things.append(thing)
+        url = self.thing(things[0]).shortlink
+        log.info("Published {} to {}: {}".format(edition, sub.display_name, url))
+        return url
+
+    def published(self, sub, edition):
+        # Link to an edition already posted in full to sub, None if it isn't (yet)
+        saved = self.store.publication(sub.display_name, edition)
+        if saved is None or any(f[2] is None for f in saved[1]):
+            return None
+        return self.thing(saved[1][0][2]).shortlink
+
+    def thing(self, fullname):
+        # A submission or comment from its fullname, without fetching it
+        kind, id_ = fullname.split("_", 1)
+        return self.r.submission(id=id_) if kind == "t3" else self.r.comment(id=id_)
+
+    def deliver(self, edition):
+        # One process sends everything, or deliveryProcesses share the outbox shard by shard (see
+        # Delivery.runShards). `python HHHBot.py deliver` joins in from another process or machine
+        if self.deliveryProcesses <= 1:
+            return self.delivery.run(edition)
+        context = multiprocessing.get_context("spawn")
+        config = dict((f, getattr(self, f)) for f in DELIVERY_CONFIG)
+        workers = [context.Process(target=deliveryWorker, args=(self.dbPath, edition, config))
+                   for i in range(self.deliveryProcesses - 1)]
+        for worker in workers:
+            worker.start()
+        try:
+            self.delivery.runShards(edition)
+        finally:
+            for worker in workers:
+                worker.join()
+        counts = self.store.editionCounts(edition)
+        return {'sent': counts.get('sent', 0), 'failed': counts.get('failed', 0)}
+
+    @metrics.timed("deliverPending")
+    def deliverPending(self):
+        for edition in self.store.pendingEditions():
+            log.info("Delivering pending messages of {}".format(edition))
+            self.delivery.runShards(edition)
+
+    @metrics.timed("postWeekly")
+    def postingSub(self):
+        return self.r.subreddit("testingsubforbot123") if vals.DEV else self.sub_posting
+
+    def postWeekly(self, name=None):
+        # Returns the link to the post
+        #self.updateScore()
+        name = name or self.roundupName
+        sub = self.postingSub()
+        edition = self.weeklyEdition(name)
+        if self.store.publication(sub.display_name, edition) is not None:
+            # A failed or repeated run, publish carries on with the saved parts, nothing is rendered or synced again
+            return self.publish(edition, None, None, sub)
+
+        week = self.roundup(time.time(), time.mktime(((datetime.datetime.utcnow()-datetime.timedelta(7)).timetuple())), name)
+        message = week['days']
 
         try:
-            playlist_url, len_found, len_total, perc = self.spotify_playlist()          
-            intro = 'Welcome to The Weekly [Fresh]ness! Fresh /r/hiphopheads posts every week.\n\n[Spotify playlist]({}) with {}% ({}/{}) songs from this week! \n\n^This ^playlist ^is ^updated ^weekly!\n\n'.format(
-            playlist_url, perc, len_found, len_total)
+            playlist_url, len_found, len_total, perc = self.weeklyPlaylist(edition, name)
+            intro = 'Welcome to The Weekly [Fresh]ness! Fresh {} posts every week.\n\n[Spotify playlist]({}) with {}% ({}/{}) songs from this week! \n\n^This ^playlist ^is ^updated ^weekly!\n\n'.format(
+            self.sources(name), playlist_url, perc, len_found, len_total)
         except Exception as e:
-            intro = 'Welcome to The Weekly [Fresh]ness! Fresh /r/hiphopheads posts every week.\n\n'
+            intro = 'Welcome to The Weekly [Fresh]ness! Fresh {} posts every week.\n\n'.format(self.sources(name))
             log.error("An error has occured whilst updating the spotify playlist")
             log.error(e)
-        text = intro
-        parts = []
-        for day in message:
-            tempText = text + day[0]
-            if len(tempText) > self.prawCharLimit:
-                parts.append(text)
-                tempText = day[0]
-            text = tempText
-        parts.append(text) #To account for if the last day exceeds the prawCharLimit, or there is only one part
-
-        i = 0
-        for part in range(len(parts)):
-            if len(parts) == 1:
-                sub.submit("The Weekly Freshness for the week beginning {}".format(message[0][1]), selftext=parts[part]+self.footer)
-            else:
-                if part == 0:
-                    submission = sub.submit("The Weekly Freshness for the week beginning {}".format(message[0][1]), selftext="**Part {}**\n\n".format(part+1)+parts[part]+self.footer)
-                else:
-                    log.debug("Submitting part {}/{} to {}".format(part+1, len(parts), sub.display_name))
-                    submission = submission.reply("**Part {}**\n\n".format(part+1)+parts[part]+self.footer)
+        parts = list(week['parts'])
+        parts[0] = intro + parts[0]
 
-            i+=1
+        label = "" if name == ingest.DEFAULT else " ({})".format(name)
+        url = self.publish(edition, "The Weekly Freshness{} for the week beginning {}".format(label, message[0][1]), parts, sub)
         log.info("Submitted weekly freshness to {}".format(sub.display_name))
-
-    def spotify_playlist(self):
-        return weekly_playlist.weekly_playlist(self.c)
-
-
-if __name__ == "__main__":
-    triggers = ["getFresh", "mailDaily", "mailWeekly", "postWeekly", "checkMail", "help", "updatePlaylist"]
-    log.debug("Starting {} with args {}".format(__name__,sys.argv))
-    t = time.time()
-    if len(sys.argv)==2:
-        if sys.argv[1] in triggers:
-            h = HHHBot()
+        return url
+
+    def weeklyPlaylist(self, edition, name=None):
+        # spotify_playlist's result, synced once per week. A retried postWeekly reuses it
+        key = "playlist:" + edition
+        saved = self.store.setting(key)
+        if saved is not None:
+            log.info("Reusing the playlist synced for {}".format(edition))
+            return tuple(json.loads(saved))
+        result = self.spotify_playlist(name)
+        self.store.setSetting(key, json.dumps(list(result)))
+        return result
+
+    def backfill(self):
+        # Ignore the /new cursor and re-walk the listing, e.g. on a fresh database
+        self.fetchNewPosts(backfill=True)
+        self.updateScore()
+
+    def getFresh(self):
+        self.fetchNewPosts()
+        self.promotePending()
+        self.garbageDisposal()  # Before the refresh, archived posts don't need new scores
+        self.updateScore()
+
+    def recorded(self, command, fn):
+        # Every daemon job is saved as its own run in the metrics tables
+        def run():
+            metrics.reset()
             try:
-                if sys.argv[1] == triggers[0]:
-	                # Run this twice a day, takes forever to run....
-                    h.fetchNewPosts()
-                    h.updateScore()
-                    h.checkInbox()
-                elif sys.argv[1] == triggers[1]:
-                    h.checkInbox()
-                    h.mailDaily()
-                elif sys.argv[1] == triggers[2]:
-                    h.checkInbox()
-                    h.mailWeekly()
-                elif sys.argv[1] == triggers[3]:
-   		    h.checkInbox()
-        	    h.postWeekly()
-                elif sys.argv[1] == triggers[4]:
-               	    h.checkInbox()
-                elif sys.argv[1] == triggers[6]:
-                    # Not needed really, a call to spotify_playlist() is made in weekly post
-                    #h.updateScore()
-                    h.spotify_playlist()
-            	    
-                else:
-                    print("\n".join([f for f in triggers]))
-            except Exception as e:
-                log.exception("Exception in main core of code... yikes")
-
-        else:
-            log.error("No correct argument was given")
-    else:
+                fn()
+            finally:
+                metrics.save(self.db, command)
+        return run
+
+    def daemon(self):
+        s = scheduler.Scheduler()
+        s.add("getFresh", self.recorded("getFresh", self.getFresh), scheduler.interval(self.fetchInterval), jitter=self.schedulerJitter)
+        s.add("checkInbox", self.recorded("checkMail", self.checkInbox), scheduler.interval(self.inboxInterval), jitter=self.schedulerJitter)
+        s.add("mailDaily", self.recorded("mailDaily", self.mailDaily), scheduler.daily(self.dailyHour), jitter=self.schedulerJitter)
+        s.add("mailWeekly", self.recorded("mailWeekly", self.mailWeekly), scheduler.weekly(self.weeklyDay, self.weeklyHour, self.weeklyMailMinute), jitter=self.schedulerJitter)
+        s.add("postWeekly", self.recorded("postWeekly", self.postWeekly), scheduler.weekly(self.weeklyDay, self.weeklyHour), jitter=self.schedulerJitter)
+        for name in self.pipeline.roundups:
+            # Every other configured roundup is posted too, each with its own edition and playlist
+            if name != self.roundupName:
+                s.add("postWeekly:" + name, self.recorded("postWeekly", functools.partial(self.postWeekly, name)),
+                      scheduler.weekly(self.weeklyDay, self.weeklyHour), jitter=self.schedulerJitter)
+        s.run()
+
+    @metrics.timed("spotify_playlist")
+    def spotify_playlist(self, name=None):
+        import weekly_playlist  # spotipy and requests
+        name = name or self.roundupName
+        # The default roundup keeps the playlist it always had, the others get one each
+        playlist = weekly_playlist.PLAYLIST if name == ingest.DEFAULT else "{} ({})".format(weekly_playlist.PLAYLIST, name)
+        c = self.db.cursor()
+        try:
+            titles = self.store.playlistTitles(name, time.time() - 7*24*60*60, 50)
+            return weekly_playlist.weekly_playlist(c, self.spotify, name, playlist, titles)
+        finally:
+            c.close()
+
+
+# What HHHBot.deliver's worker processes take over from the bot that starts them
+DELIVERY_CONFIG = ["deliveryWorkers", "deliveryRate", "deliveryBurst", "deliveryShards", "deliveryLease", "storeDSN",
+                   "storePoolSize", "httpCachePath"]
+
+
+def deliveryWorker(dbPath, edition, config):
+    # Entry point of the processes HHHBot.deliver starts, module level so it can be pickled
+    h = HHHBot(dbPath=dbPath)
+    for name, value in config.items():
+        setattr(h, name, value)
+    try:
+        h.delivery.runShards(edition)
+    finally:
+        h.close()
+
+
+# Trigger -> the HHHBot methods it runs, in order. Nothing is imported or connected before a method needs it
+TRIGGERS = [
+    ("getFresh", ["getFresh", "checkInbox"]),  # Run this twice a day, takes forever to run....
+    ("mailDaily", ["checkInbox", "mailDaily"]),
+    ("mailWeekly", ["checkInbox", "mailWeekly"]),
+    ("postWeekly", ["checkInbox", "postWeekly"]),
+    ("checkMail", ["checkInbox"]),
+    ("help", []),
+    ("updatePlaylist", ["spotify_playlist"]),  # Not needed really, postWeekly updates the playlist too
+    ("backfill", ["backfill"]),
+    ("daemon", ["daemon"]),  # Long running, replaces the cron entries for the triggers above
+    ("stream", ["stream"]),  # Long running, next to cron or the daemon, which then only walk /new over the rescan window
+    ("deliver", ["deliverPending"]),  # Extra delivery worker for whatever is in the outbox, shares the account's rate limit
+]
+UNRECORDED = ("help", "daemon", "stream")  # Not saved as a metrics run, the long running ones save each job
+
+
+def main(argv):
+    log.debug("Starting {} with args {}".format(__name__, argv))
+    t = time.time()
+    triggers = dict(TRIGGERS)
+    if len(argv) not in (2, 3):
         log.error("No argument was given")
+    elif argv[1] not in triggers:
+        log.error("No correct argument was given")
+    elif argv[1] == "help":
+        print("\n".join(name for name, methods in TRIGGERS))
+        print("A roundup other than {} can follow the trigger, e.g. postWeekly <roundup>".format(ingest.DEFAULT))
+    else:
+        h = HHHBot()
+        if len(argv) == 3:
+            if argv[2] not in h.pipeline.roundups:
+                log.error("No roundup {}, the configured ones are {}".format(argv[2], ", ".join(h.pipeline.roundups)))
+                h.close()
+                return
+            h.roundupName = argv[2]
+        try:
+            for method in triggers[argv[1]]:
+                getattr(h, method)()
+        except Exception as e:
+            log.exception("Exception in main core of code... yikes")
+        if argv[1] not in UNRECORDED:
+            metrics.save(h.db, argv[1])
+        h.close()
     log.debug("Finishing {}. Time to complete was {}s".format(__name__, time.time()-t))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Posts that aged out of the hot posts table, kept in their own SQLite file. Rows are partitioned into one
+# table per month, submitters and URL prefixes are stored once in dictionary tables and referenced by integer,
+# and the permalink isn't stored at all since it is always https://redd.it/<ID>. The posts view decodes it all
+# back into the hot table's columns for long range queries
+import datetime
+import re
+import time
+import logger
+import metrics
+import schema
+
+log = logger.get_logger(__name__)
+
+CHUNK = 1000  # Rows per move, each one is a short write transaction on fresh.db
+PERMALINK = "https://redd.it/"
+# Scheme, host and the first path segment: youtube.com/, open.spotify.com/track/, soundcloud.com/<artist>/
+URL_PREFIX = re.compile(r'^[a-zA-Z]+://[^/?#]+/(?:[^/?#]*/)?')
+
+
+def _dictionaries(c):
+    c.execute("CREATE TABLE submitters (ID INTEGER PRIMARY KEY, NAME TEXT UNIQUE NOT NULL)")
+    c.execute("CREATE TABLE url_prefixes (ID INTEGER PRIMARY KEY, PREFIX TEXT UNIQUE NOT NULL)")
+    c.execute("CREATE TABLE partitions (NAME TEXT PRIMARY KEY)")
+
+
+# Same contract as schema.MIGRATIONS, for archive.db
+MIGRATIONS = [
+    _dictionaries,
+]
+
+
+def partition(t):
+    return "posts_" + datetime.datetime.utcfromtimestamp(t).strftime("%Y_%m")
+
+
+def splitUrl(url):
+    match = URL_PREFIX.match(url or "")
+    if match is None:
+        return "", url
+    return match.group(0), url[match.end():]
+
+
+class Archive(object):
+    def __init__(self, path):
+        self.db = schema.connect(path, MIGRATIONS)
+        self.load()
+        self.longestChunk = 0.0
+
+    def load(self):
+        self.submitters = dict(self.db.execute("SELECT NAME, ID FROM submitters").fetchall())
+        self.prefixes = dict(self.db.execute("SELECT PREFIX, ID FROM url_prefixes").fetchall())
+        self.partitions = set(f[0] for f in self.db.execute("SELECT NAME FROM partitions").fetchall())
+
+    def close(self):
+        self.db.close()
+
+    def intern(self, table, column, cache, value):
+        id_ = cache.get(value)
+        if id_ is None:
+            id_ = self.db.execute("INSERT INTO {} ({}) VALUES (?)".format(table, column), (value,)).lastrowid
+            cache[value] = id_
+        return id_
+
+    def addPartition(self, name):
+        # Partition names come from partition(), never from input, so formatting them into the SQL is safe
+        self.db.execute("CREATE TABLE IF NOT EXISTS {} (ID TEXT PRIMARY KEY, TITLE TEXT, PREFIX INT, URL TEXT, "
+                        "TIME INT, SCORE INT, SUBMITTER INT) WITHOUT ROWID".format(name))
+        self.db.execute("INSERT INTO partitions VALUES (?)", (name,))
+        self.partitions.add(name)
+        self.db.execute("DROP VIEW IF EXISTS posts")
+        self.db.execute("CREATE VIEW posts AS " + " UNION ALL ".join(
+            "SELECT p.ID, p.TITLE, '{perma}' || p.ID AS PERMA, u.PREFIX || p.URL AS URL, p.TIME, p.SCORE, "
+            "s.NAME AS SUBMITTER FROM {name} p JOIN url_prefixes u ON u.ID = p.PREFIX "
+            "JOIN submitters s ON s.ID = p.SUBMITTER".format(perma=PERMALINK, name=name)
+            for name in sorted(self.partitions)))
+
+    def store(self, rows):
+        # rows as selected from the hot posts table, written in one archive transaction
+        encoded = {}
+        try:
+            for id_, title, perma, url, created, score, submitter in rows:
+                name = partition(created)
+                if name not in self.partitions:
+                    self.addPartition(name)
+                prefix, rest = splitUrl(url)
+                encoded.setdefault(name, []).append((
+                    id_, title, self.intern("url_prefixes", "PREFIX", self.prefixes, prefix), rest, created, score,
+                    self.intern("submitters", "NAME", self.submitters, submitter or "")))
+            for name, values in encoded.items():
+                # Replacing makes a move interrupted after this commit safe to redo
+                self.db.executemany("INSERT OR REPLACE INTO {} VALUES (?,?,?,?,?,?,?)".format(name), values)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            self.load()  # The caches may hold IDs from the rolled back transaction
+            raise
+
+    def move(self, hot, before, chunk=CHUNK):
+        # Oldest first, CHUNK rows at a time from hot (a storage.Repository): archive them, then delete them from
+        # the hot table in a transaction of its own, so cron runs and readers never wait on one long lock
+        moved = 0
+        t = time.time()
+        while True:
+            rows = hot.oldPosts(before, chunk)
+            if not rows:
+                break
+            self.store(rows)
+            lock = time.time()
+            hot.deletePosts([f[0] for f in rows])
+            self.longestChunk = max(self.longestChunk, time.time() - lock)
+            moved += len(rows)
+        metrics.incr(metrics.ROWS_WRITTEN, moved)
+        if moved:
+            log.info("Archived {n} posts in {s}s, longest hot table write {lock}ms".format(
+                n=moved, s=round(time.time() - t, 2), lock=round(self.longestChunk * 1000, 1)))
+        return moved
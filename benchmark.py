@@ -0,0 +1,747 @@
+# -*- coding: utf-8 -*-
+# Offline benchmarks, run with `python benchmark.py <name> [sizes...] [--out results.jsonl]`. --out appends the
+# table tagged with the current commit, so runs can be compared across commits
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import schema
+import storage
+import delivery
+import inbox
+import roundup
+import fake_reddit
+import fake_spotify
+import metrics
+from tabulate import tabulate
+
+DAY = 24 * 60 * 60
+
+
+def timeit(fn, repeat=20):
+    # Best of `repeat` runs in ms, we care about the query plan not noise
+    best = None
+    for _ in range(repeat):
+        t = time.time()
+        fn()
+        elapsed = time.time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 3)
+
+
+def fill_legacy(path, rows):
+    db = sqlite3.connect(path)
+    c = db.cursor()
+    c.execute("PRAGMA user_version=0")
+    schema.MIGRATIONS[0](c)
+    now = time.time()
+    c.executemany("INSERT INTO posts VALUES (?,?,?,?,?,?,?)", (
+        ("p{}".format(i), "\\[FRESH\\] Artist - Song {}".format(i), "https://redd.it/p{}".format(i),
+         "https://example.com/{}".format(i), now - random.random() * 31 * DAY, random.randint(50, 5000),
+         "user{}".format(i % 5000)) for i in range(rows)))
+    c.executemany("INSERT INTO subscriptions (USER, SUBSCRIPTION) VALUES (?,?)", (
+        ("user{}".format(i), random.choice(["daily", "weekly", "both"])) for i in range(rows)))
+    c.execute("PRAGMA user_version=1")
+    db.commit()
+    return db
+
+
+def schema_queries(db, rows):
+    now = time.time()
+    probe = "p{}".format(rows // 2)
+    user = "user{}".format(rows // 2)
+    return [
+        timeit(lambda: db.execute("SELECT * FROM posts WHERE ID=?", (probe,)).fetchall()),
+        timeit(lambda: db.execute("SELECT * FROM subscriptions WHERE USER=?", (user,)).fetchall()),
+        timeit(lambda: db.execute("SELECT * FROM posts WHERE TIME<? AND TIME>? ORDER BY SCORE DESC",
+                                  (now, now - DAY)).fetchall(), repeat=5),
+        timeit(lambda: db.execute("SELECT USER FROM subscriptions WHERE SUBSCRIPTION = ? OR SUBSCRIPTION = ?",
+                                  ("daily", "both")).fetchall(), repeat=5),
+    ]
+
+
+def bench_schema(sizes):
+    table = []
+    tmp = tempfile.mkdtemp()
+    try:
+        for rows in sizes:
+            path = os.path.join(tmp, "fresh-{}.db".format(rows))
+            db = fill_legacy(path, rows)
+            before = schema_queries(db, rows)
+            db.close()
+
+            db = schema.connect(path)
+            after = schema_queries(db, rows)
+            db.close()
+
+            for name, b, a in zip(["posts by ID", "subscriptions by USER", "posts in 1 day window", "daily subscribers"],
+                                  before, after):
+                table.append([rows, name, b, a, round(b / a, 1) if a else "-"])
+    finally:
+        shutil.rmtree(tmp)
+    return table, ["Rows", "Query", "Before (ms)", "After (ms)", "Speedup"]
+
+
+def bench_delivery(sizes, latency=0.02, parts=2, dead=20):
+    # One user in `dead` is deleted and one has blocked the bot, their PMs fail on the first try. One PM is rate
+    # limited for a second, which holds every worker back that long without costing the message an attempt
+    table = []
+    tmp = tempfile.mkdtemp()
+    server = fake_reddit.FakeReddit(latency=latency, ratelimit=100000).start()
+    try:
+        reddit = server.reddit()
+        for users in sizes:
+            for i in range(0, users, dead):
+                server.refuse("user{}".format(i), "USER_DOESNT_EXIST", "that user doesn't exist")
+                server.refuse("user{}".format(i + 1), "NOT_WHITELISTED_BY_USER_MESSAGE", "that user has blocked you")
+            for workers in [1, 2, 4, 8]:
+                server.refuse("user{}".format(users - 1), "RATELIMIT", "Take a break for 1 second before trying again.",
+                              1)
+                store = storage.SQLiteRepository(os.path.join(tmp, "outbox-{}-{}.db".format(users, workers)))
+                # A generous bucket so we measure the engine, not the default 1 msg/s throttle
+                d = delivery.Delivery(reddit, store, workers=workers, connect=server.reddit,
+                                      bucket=delivery.TokenBucket(rate=10000, capacity=100))
+                d.enqueue("bench", [("Part {}".format(i + 1), "x" * 9000) for i in range(parts)],
+                          ["user{}".format(i) for i in range(users)])
+                requests = server.requests
+                t = time.time()
+                counts = d.run("bench")
+                elapsed = time.time() - t
+                requests = server.requests - requests
+                resumed = d.run("bench")  # Nothing left to send, a re-run must be a no-op
+                table.append([users * parts, workers, counts['sent'], counts['failed'], round(elapsed, 2),
+                              round(counts['sent'] / elapsed, 1), round(requests / float(users * parts), 3),
+                              resumed['sent']])
+                store.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+    return table, ["Jobs", "Workers", "Sent", "Failed", "Time (s)", "Msg/s", "Requests/job", "Re-sent on re-run"]
+
+
+class FixedRateBucket(delivery.SharedTokenBucket):
+    # The fake's rate limit headers allow anything, hold the shared account to its configured rate instead
+    def update(self, remaining, reset):
+        pass
+
+
+def shard_worker(url, path, lease, crash=False, rate=None):
+    # One delivery process of bench_shards. A crashing worker claims a shard and dies holding the lease. rate
+    # makes it send as the one shared account, drawing from its bucket in the store
+    store = storage.SQLiteRepository(path)
+    bucket = delivery.TokenBucket(rate=10000, capacity=100) if rate is None else \
+        FixedRateBucket(store, "bench", rate=rate, capacity=1)
+    d = delivery.Delivery(fake_reddit.client(url), store, workers=2, lease=lease, bucket=bucket,
+                          connect=lambda: fake_reddit.client(url))
+    if crash:
+        shard = d.store.pendingShards("bench")[0]
+        now = int(time.time())
+        d.store.claimShard("bench", shard, d.worker, now + lease, now)
+        os._exit(1)
+    d.runShards("bench")
+
+
+def bench_shards(sizes, latency=0.02, shards=16, lease=2, rate=50):
+    # Worker processes sharing one outbox file, each with its own praw client and token bucket as separate
+    # accounts would have. One process runs the plain single process path, "+ crash" first kills a worker
+    # holding a lease, which costs the others up to `lease` seconds before they take its shard over. The
+    # "shared" rows send as one account limited to `rate` msg/s, more processes mustn't get past it
+    table = []
+    tmp = tempfile.mkdtemp()
+    server = fake_reddit.FakeReddit(latency=latency, ratelimit=10 ** 9).start()
+    context = multiprocessing.get_context("spawn")
+    try:
+        for users in sizes:
+            for processes, crash, account in [(1, False, None), (2, False, None), (4, False, None), (4, True, None),
+                                              (2, False, rate), (4, False, rate)]:
+                path = os.path.join(tmp, "shards-{}-{}-{}-{}.db".format(users, processes, crash, account))
+                store = storage.SQLiteRepository(path)
+                d = delivery.Delivery(server.reddit(), store, workers=2, shards=shards,
+                                      bucket=delivery.TokenBucket(rate=10000, capacity=100), connect=server.reddit)
+                d.enqueue("bench", [("Daily", "x" * 2000)], ["user{}".format(i) for i in range(users)])
+                del server.messages[:]
+                t = time.time()
+                if crash:
+                    dead = context.Process(target=shard_worker, args=(server.url, path, lease, True))
+                    dead.start()
+                    dead.join()
+                if processes == 1:
+                    d.run("bench")
+                else:
+                    workers = [context.Process(target=shard_worker, args=(server.url, path, lease, False, account))
+                               for i in range(processes)]
+                    for worker in workers:
+                        worker.start()
+                    for worker in workers:
+                        worker.join()
+                elapsed = time.time() - t
+                counts = store.editionCounts("bench")
+                sent = len(server.messages)
+                table.append([users, processes, "shared" if account else "own", "yes" if crash else "no",
+                              counts.get('sent', 0), round(elapsed, 2),
+                              round(sent / elapsed, 1), sent - len(set(f[0] for f in server.messages)),
+                              counts.get('pending', 0)])
+                store.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+    return table, ["Users", "Processes", "Account", "Crash", "Sent", "Time (s)", "Msg/s", "Duplicates", "Left pending"]
+
+
+def synthetic_week(rows):
+    days = []
+    for d in range(7):
+        label = "Day {}".format(d)
+        days.append((label, ['[\\[FRESH\\] Artist {i} - Song {i} (feat. Someone)](https://example.com/{i}) | '
+                             '[link](https://redd.it/p{i}) | {s} | /u/user{i}\n'.format(i=i, s=random.randint(50, 5000))
+                             for i in range(d, rows, 7)]))
+    return days
+
+
+def legacy_split(days, limit, intro):
+    # The loop mailWeekly/postWeekly used to carry, kept here as the baseline
+    message = []
+    for label, rows in days:
+        text = "**" + label + "**" + roundup.TABLE_HEADER
+        for row in rows:
+            text += row
+        text += "\n\n"
+        message.append(text)
+    text = intro
+    parts = []
+    for day in message:
+        tempText = text + day
+        if len(tempText) > limit:
+            parts.append(text)
+            tempText = day
+        text = tempText
+    parts.append(text)
+    return parts
+
+
+def bench_splitter(sizes, limit=10000):
+    footer = "\n\n---\n\n" + "^footer " * 60
+    reserve = roundup.PART_HEADER.format(99) + footer
+    intro = "Welcome to The Weekly [Fresh]ness!\n\n"
+    table = []
+    for rows in sizes:
+        days = synthetic_week(rows)
+        t = time.time()
+        old = legacy_split(days, limit * 0.9, intro)
+        oldTime = time.time() - t
+        t = time.time()
+        new = list(roundup.split(days, limit, reserve=reserve, firstReserve=intro))
+        newTime = time.time() - t
+
+        # Every part fits as reddit counts it once header/footer/intro are added, and no row is lost, duplicated or
+        # reordered
+        over = sum(1 for i, part in enumerate(new) if roundup.size(part + reserve + (intro if i == 0 else ''))[0] > limit)
+        oldOver = sum(1 for part in old if roundup.size(roundup.PART_HEADER.format(99) + part + footer)[0] > limit)
+        allRows = [row for label, dayRows in days for row in dayRows]
+        kept = [line + "\n" for part in new for line in part.split("\n") if line.startswith("[")] == allRows
+        table.append([rows, len(old), oldOver, round(oldTime * 1000, 2), len(new), over, round(newTime * 1000, 2), kept])
+    return table, ["Rows", "Old parts", "Old over limit", "Old (ms)", "New parts", "New over limit", "New (ms)",
+                   "Rows intact"]
+
+
+def legacy_render(db, timeStart, timeEnd):
+    # HHHBot.render before rows were rendered at ingest, kept here as the baseline
+    dict_ = {}
+    for post in db.execute("SELECT ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER FROM posts WHERE TIME<? AND TIME>? "
+                           "ORDER BY SCORE DESC", (timeStart, timeEnd)):
+        title = post[1].replace("|", ":")
+        t = post[4]
+        day = int(t // DAY)
+        entry = '[{title}]({url}) | [link]({perma}) | {score} | /u/{submitter}\n'.format(
+            title=title, url=post[3], perma=post[2], score=post[5], submitter=post[6])
+        if day not in dict_:
+            dict_[day] = (datetime.datetime.utcfromtimestamp(t).strftime("%A, %B %-d, %Y"), [])
+        dict_[day][1].append(entry)
+    return [dict_[day] + (day,) for day in sorted(dict_.keys())]
+
+
+def bench_render(sizes, days=7):
+    # A weekly roundup's worth of posts out of `rows`, rendered per row in Python against the fragments stored
+    # at ingest. Both have to produce the same bytes
+    from HHHBot import HHHBot
+    table = []
+    tmp = tempfile.mkdtemp()
+    try:
+        for rows in sizes:
+            path = os.path.join(tmp, "render-{}.db".format(rows))
+            fill_legacy(path, rows).close()
+            bot = HHHBot(reddit=fake_reddit.client("http://127.0.0.1:1"), dbPath=path)
+            now = time.time()
+            old = timeit(lambda: legacy_render(bot.db, now, now - days * DAY), repeat=5)
+            new = timeit(lambda: bot.render(now, now - days * DAY), repeat=5)
+            same = legacy_render(bot.db, now, now - days * DAY) == bot.render(now, now - days * DAY)
+            table.append([rows, sum(len(f[1]) for f in bot.render(now, now - days * DAY)), old, new,
+                          round(old / new, 1) if new else "-", same])
+            bot.close()
+    finally:
+        shutil.rmtree(tmp)
+    return table, ["Rows", "Rendered", "Per row (ms)", "Fragments (ms)", "Speedup", "Identical"]
+
+
+# The mix of messages the bot gets after a weekly post: mostly subscriptions, some noise
+INBOX_FIXTURE = [
+    ('subscribe', 'weekly'), ('subscribe', 'daily'), ('subscribe', 'both'), ('unsubscribe', 'remove'),
+    ('unsubscribe', 'daily'), ('subscribe', 'please add me'), ('great bot', 'thanks for the roundup'),
+]
+
+
+def bench_inbox(sizes, latency=0.01):
+    table = []
+    for messages in sizes:
+        for workers in [1, 4, 8]:
+            server = fake_reddit.FakeReddit(latency=latency, ratelimit=100000).start()
+            try:
+                for i in range(messages):
+                    subject, body = INBOX_FIXTURE[i % len(INBOX_FIXTURE)]
+                    server.addMessage("user{}".format(i % (messages // 2 or 1)), subject, body)
+                store = storage.SQLiteRepository(":memory:")
+                processor = inbox.Inbox(server.reddit(), store, "", workers=workers, connect=server.reddit)
+                t = time.time()
+                processor.process()
+                elapsed = time.time() - t
+                table.append([messages, workers, round(elapsed, 2), round(messages / elapsed, 1),
+                              round(server.requests / float(messages), 2), len(server.read)])
+                store.close()
+            finally:
+                server.stop()
+    return table, ["Messages", "Workers", "Time (s)", "Msg/s", "Requests/msg", "Marked read"]
+
+
+def bench_suite(sizes, latency=0.005):
+    # The bot's real code paths end to end against the fake reddit and spotify servers.
+    # sizes are [posts, subscribers, unread PMs]
+    from HHHBot import HHHBot  # Needs vals, the other benchmarks don't
+    import vals
+
+    posts, subscribers, unread = (list(sizes) + [1000, 200, 200][len(sizes):])[:3]
+    tmp = tempfile.mkdtemp()
+    reddit = fake_reddit.FakeReddit(latency=latency, ratelimit=100000).start()
+    spotify = fake_spotify.FakeSpotify(latency=latency).start()
+    try:
+        reddit.addPosts(posts, subreddit=vals.hhh)
+        for i in range(unread):
+            subject, body = INBOX_FIXTURE[i % len(INBOX_FIXTURE)]
+            reddit.addMessage("reader{}".format(i), subject, body)
+
+        bot = HHHBot(reddit=reddit.reddit(), dbPath=os.path.join(tmp, "fresh.db"))
+        bot.spotify = spotify.client()
+        bot.delivery = delivery.Delivery(bot.r, bot.store, workers=bot.deliveryWorkers,
+                                         bucket=delivery.TokenBucket(rate=10000, capacity=100), connect=bot.connect)
+        bot.db.executemany("INSERT INTO subscriptions (USER, SUBSCRIPTION) VALUES (?,?)", (
+            ("user{}".format(i), random.choice(["daily", "weekly", "both"])) for i in range(subscribers)))
+        bot.db.commit()
+
+        def counter(name):
+            return metrics.snapshot()[1].get(name, 0)
+
+        def posted():
+            return len(reddit.submissions) + len(reddit.replies)
+
+        before = {}
+
+        # (stage, fn, items handled given the fn's result). The weekly stages run in the daemon's order so each one
+        # only does its own part: weekly_playlist syncs and saves the edition's playlist, postWeekly reuses it and
+        # posts, mailWeekly links to that post and only sends PMs
+        stages = [
+            ("fetchNewPosts", bot.fetchNewPosts, lambda result: counter(metrics.ROWS_SCANNED)),
+            ("updateScore", bot.updateScore, lambda result: counter(metrics.ROWS_SCANNED)),
+            ("checkInbox", bot.checkInbox, lambda result: result),
+            ("weekly_playlist", lambda: bot.weeklyPlaylist(bot.weeklyEdition()), lambda result: result[2]),
+            ("postWeekly", bot.postWeekly, lambda result: posted() - before['posted']),
+            ("mailWeekly", bot.mailWeekly, lambda result: counter(metrics.MESSAGES_SENT)),
+        ]
+        table = []
+        for name, fn, items in stages:
+            metrics.reset()
+            requests = reddit.requests, spotify.requests
+            before['posted'] = posted()
+            t = time.time()
+            n = items(fn())
+            elapsed = time.time() - t
+            requests = reddit.requests - requests[0], spotify.requests - requests[1]
+            total = sum(requests)
+            table.append([name, n, requests[0], requests[1], round(elapsed, 3),
+                          round(n / elapsed, 1) if elapsed else "-", round(elapsed * 1000 / n, 2) if n else "-",
+                          round(elapsed * 1000 / total, 2) if total else "-"])
+        bot.close()
+    finally:
+        reddit.stop()
+        spotify.stop()
+        shutil.rmtree(tmp)
+    return table, ["Stage", "Items", "Reddit requests", "Spotify requests", "Time (s)", "Items/s", "ms/item",
+                   "ms/request"]
+
+
+def bench_digest(sizes, latency=0.002):
+    # The weekly mailing to sizes[1] subscribers over sizes[0] posts, everyone mailed the full text against the
+    # roundup published once with a short PM each. Bytes count the text sent in PMs, posts and replies
+    from HHHBot import HHHBot
+    import vals
+
+    posts, subscribers = (list(sizes) + [1000, 200][len(sizes):])[:2]
+    table = []
+    for mode, publish in [("Full text", False), ("Publish once", True)]:
+        tmp = tempfile.mkdtemp()
+        reddit = fake_reddit.FakeReddit(latency=latency, ratelimit=10 ** 9).start()
+        try:
+            reddit.addPosts(posts, subreddit=vals.hhh, fresh=1.0)
+            bot = HHHBot(reddit=reddit.reddit(), dbPath=os.path.join(tmp, "fresh.db"))
+            bot.publishRoundups = publish
+            bot.delivery = delivery.Delivery(bot.r, bot.store, workers=bot.deliveryWorkers,
+                                             bucket=delivery.TokenBucket(rate=10000, capacity=100),
+                                             connect=bot.connect)
+            bot.store.applySubscriptions([("user{}".format(i), "weekly") for i in range(subscribers)], [])
+            reddit.clock = lambda: time.time() + 2 * DAY  # Scores settle above the threshold
+            bot.fetchNewPosts()
+            bot.updateScore()
+
+            requests = reddit.requests
+            t = time.time()
+            bot.mailWeekly()
+            elapsed = time.time() - t
+            sent = sum(len(f[2].encode("utf-8")) for f in reddit.messages)
+            published = sum(len(f[-1].encode("utf-8")) for f in reddit.submissions + reddit.replies)
+            table.append([mode, subscribers, len(reddit.messages), round(sent / 1024.0, 1), round(published / 1024.0, 1),
+                          round((sent + published) / float(subscribers)), reddit.requests - requests, round(elapsed, 2)])
+            bot.close()
+        finally:
+            reddit.stop()
+            shutil.rmtree(tmp)
+    return table, ["Mode", "Subscribers", "PMs", "PM KB", "Published KB", "Bytes/subscriber", "Requests", "Time (s)"]
+
+
+def bench_feeds(sizes, latency=0.005, new=5):
+    # sizes[1] subreddits of sizes[0] posts each, ingested by a bot per subreddit against one bot with a feed per
+    # subreddit walking the shared listing. The second run is the steady state, `new` posts per subreddit since
+    from HHHBot import HHHBot
+
+    posts, subreddits = (list(sizes) + [500, 8][len(sizes):])[:2]
+    names = ["sub{}".format(i) for i in range(subreddits)]
+    feeds = [{'name': name, 'subreddits': [name], 'tags': ['[fresh'], 'minScore': 0} for name in names]
+    table = []
+    for mode, groups in [("Bot per subreddit", [[f] for f in feeds]), ("Shared listing", [feeds])]:
+        random.seed(0)  # The same posts for both
+        tmp = tempfile.mkdtemp()
+        reddit = fake_reddit.FakeReddit(latency=latency, ratelimit=10 ** 9).start()
+        try:
+            for name in names:
+                reddit.addPosts(posts, subreddit=name)
+            bots = []
+            for i, group in enumerate(groups):
+                bot = HHHBot(reddit=reddit.reddit(), dbPath=os.path.join(tmp, "feeds-{}.db".format(i)))
+                bot.feeds = group
+                bots.append(bot)
+            row = [mode, subreddits, posts * subreddits]
+            for run in range(2):
+                if run:
+                    for name in names:
+                        reddit.addPosts(new, subreddit=name, maxAge=60)
+                requests = reddit.requests
+                t = time.time()
+                for bot in bots:
+                    bot.fetchNewPosts()
+                row += [reddit.requests - requests, round(time.time() - t, 2)]
+            row.append(sum(bot.db.execute("SELECT (SELECT COUNT(*) FROM posts) + (SELECT COUNT(*) FROM pending)").fetchone()[0]
+                           for bot in bots))
+            table.append(row)
+            for bot in bots:
+                bot.close()
+        finally:
+            reddit.stop()
+            shutil.rmtree(tmp)
+    return table, ["Mode", "Subreddits", "Posts", "Requests", "Time (s)", "Requests (next run)", "Time (s)",
+                   "Taken by feeds"]
+
+
+def bench_httpcache(sizes, latency=0.02):
+    # A backfill and full score refresh over sizes[0] posts, then the same job retried by a new process (a new
+    # client and bot over the same files), without and with the response cache in the praw session
+    from HHHBot import HHHBot
+    import httpcache
+    import vals
+
+    posts = sizes[0] if sizes else 1000
+    table = []
+    for mode in ["No cache", "Cache"]:
+        random.seed(0)
+        tmp = tempfile.mkdtemp()
+        reddit = fake_reddit.FakeReddit(latency=latency, ratelimit=10 ** 9).start()
+        try:
+            reddit.addPosts(posts, subreddit=vals.hhh, fresh=1.0)
+            row = [mode, posts]
+            caches = []
+            for run in range(2):
+                kwargs = {}
+                if mode == "Cache":
+                    caches.append(httpcache.HTTPCache(os.path.join(tmp, "http_cache.db")))
+                    kwargs['requestor_kwargs'] = {'session': httpcache.CachingSession(caches[-1])}
+                bot = HHHBot(reddit=reddit.reddit(**kwargs), dbPath=os.path.join(tmp, "fresh.db"))
+                bot.refreshMinInterval = bot.refreshMaxInterval = bot.refreshRoundupInterval = 0
+                requests = reddit.requests
+                t = time.time()
+                bot.fetchNewPosts(backfill=True)
+                bot.updateScore()
+                row += [reddit.requests - requests, round(time.time() - t, 2)]
+                bot.close()
+            row += [sum(f.hits for f in caches), sum(f.misses for f in caches)]
+            for cache in caches:
+                cache.close()
+            table.append(row)
+        finally:
+            reddit.stop()
+            shutil.rmtree(tmp)
+    return table, ["Mode", "Posts", "Requests", "Time (s)", "Requests (retry)", "Time (s)", "Cache hits", "Misses"]
+
+
+def bench_publish(sizes, latency=0.005, failAt=4):
+    # postWeekly over sizes[0] posts, once cleanly and once with reddit failing part `failAt` and the job re-run
+    # by a new process. The re-run should post only the missing parts, without syncing the playlist again, and
+    # leave one unbroken chain of replies
+    from HHHBot import HHHBot
+    import vals
+
+    posts = sizes[0] if sizes else 1000
+    table = []
+    for mode in ["Clean", "Fails at part {}".format(failAt)]:
+        random.seed(0)
+        tmp = tempfile.mkdtemp()
+        reddit = fake_reddit.FakeReddit(latency=latency, ratelimit=10 ** 9).start()
+        spotify = fake_spotify.FakeSpotify(latency=latency).start()
+        try:
+            reddit.addPosts(posts, subreddit=vals.hhh, fresh=1.0)
+            reddit.clock = lambda: time.time() + 2 * DAY  # Scores settle above the threshold
+            if mode != "Clean":
+                reddit.fail(r'/api/comment$', 3, after=failAt - 2)  # praw tries a request three times
+            row = [mode]
+            for run in range(2):
+                bot = HHHBot(reddit=reddit.reddit(), dbPath=os.path.join(tmp, "fresh.db"))
+                bot.spotify = spotify.client()
+                if run == 0:
+                    bot.fetchNewPosts()
+                    bot.updateScore()
+                before = reddit.requests, spotify.requests
+                t = time.time()
+                try:
+                    bot.postWeekly()
+                    ok = True
+                except Exception:
+                    ok = False
+                row += [ok, reddit.requests - before[0], spotify.requests - before[1], round(time.time() - t, 2)]
+                bot.close()
+            # Every reply answers the one before it, part 1 being the submission
+            parents = ['t3_s1'] + ['t1_c{}'.format(i + 1) for i in range(len(reddit.replies) - 1)]
+            intact = len(reddit.submissions) == 1 and [f[0] for f in reddit.replies] == parents and all(
+                f[1].startswith(roundup.PART_HEADER.format(i + 2)) for i, f in enumerate(reddit.replies))
+            table.append(row + [len(reddit.submissions) + len(reddit.replies), intact])
+        finally:
+            reddit.stop()
+            spotify.stop()
+            shutil.rmtree(tmp)
+    return table, ["Mode", "Succeeded", "Reddit requests", "Spotify requests", "Time (s)", "Re-run succeeded",
+                   "Reddit requests", "Spotify requests", "Time (s)", "Parts posted", "Thread intact"]
+
+
+def bench_refresh(sizes, days=14):
+    # Simulated weeks of twice daily score refreshes, re-fetching every post each run against the adaptive
+    # schedule. Error is |stored - live score| over the posts a weekly roundup would show
+    from HHHBot import HHHBot
+    table = []
+    tmp = tempfile.mkdtemp()
+    try:
+        for posts in sizes:
+            for mode in ["every post", "adaptive"]:
+                reddit = fake_reddit.FakeReddit(ratelimit=10 ** 9).start()
+                try:
+                    clock = [time.time()]
+                    reddit.clock = lambda: clock[0]
+                    reddit.addPosts(posts, maxAge=31 * DAY, fresh=1)
+                    bot = HHHBot(reddit=reddit.reddit(), dbPath=os.path.join(tmp, "refresh-{}-{}.db".format(posts, mode)))
+                    if mode == "every post":
+                        bot.refreshMinInterval = bot.refreshMaxInterval = bot.refreshRoundupInterval = 0
+
+                    def store(new):
+                        bot.store.addPosts([roundup.postRow((f['id'], f['title'], "https://redd.it/" + f['id'], f['url'],
+                                                             f['created_utc'], reddit.score(f), f['author']),
+                                                            bot.roundupName) for f in new])
+                    store(reddit.posts)
+
+                    calls = 0
+                    errors = []
+                    for run in range(days * 2):
+                        # The month of posts keeps its size, new ones arrive between runs as fetchNewPosts would see them
+                        clock[0] += bot.fetchInterval
+                        known = set(f['id'] for f in reddit.posts)
+                        reddit.addPosts(posts * bot.fetchInterval // (31 * DAY), maxAge=bot.fetchInterval, fresh=1)
+                        store([f for f in reddit.posts if f['id'] not in known])
+                        metrics.reset()
+                        bot.updateScore(now=clock[0])
+                        calls += metrics.snapshot()[1].get(metrics.API_CALLS, 0)
+                        stored = dict(bot.db.execute("SELECT ID, SCORE FROM posts WHERE TIME > ?",
+                                                     (clock[0] - bot.fetchPostMaxAge,)).fetchall())
+                        errors += [abs(stored[f['id']] - reddit.score(f)) for f in reddit.posts if f['id'] in stored]
+                    table.append([posts, mode, days * 2, calls, round(sum(errors) / float(len(errors) or 1), 2),
+                                  max(errors or [0])])
+                    bot.close()
+                finally:
+                    reddit.stop()
+    finally:
+        shutil.rmtree(tmp)
+    return table, ["Posts", "Mode", "Runs", "API calls", "Mean roundup error", "Max roundup error"]
+
+
+def bench_stats(sizes):
+    # Every stats report over a growing posts history, peak Python/numpy memory has to stay flat
+    import stats
+    table = []
+    tmp = tempfile.mkdtemp()
+    try:
+        for rows in sizes:
+            path = os.path.join(tmp, "stats-{}.db".format(rows))
+            fill_legacy(path, rows).close()
+            pool = storage.SQLitePool(path)
+            for name in stats.REPORTS:
+                tracemalloc.start()
+                t = time.time()
+                with pool.reader() as db:
+                    stats.run(db, [name], 0)
+                elapsed = time.time() - t
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                table.append([rows, name, round(elapsed * 1000, 1), round(peak / 1024.0 / 1024.0, 2)])
+            pool.close()
+    finally:
+        shutil.rmtree(tmp)
+    return table, ["Rows", "Report", "Time (ms)", "Peak memory (MB)"]
+
+
+def bench_archive(sizes, keep=7, chunk=1000):
+    # Move everything older than `keep` days out of fresh.db, then compare bytes per row in both files
+    import archive
+    table = []
+    tmp = tempfile.mkdtemp()
+    try:
+        for rows in sizes:
+            path = os.path.join(tmp, "fresh-{}.db".format(rows))
+            fill_legacy(path, rows).close()
+            db = schema.connect(path)
+            db.execute("DELETE FROM subscriptions")  # Only posts are archived
+            db.commit()
+            db.execute("VACUUM")
+            before = os.path.getsize(path)
+            store = archive.Archive(os.path.join(tmp, "archive-{}.db".format(rows)))
+            hot = storage.SQLiteRepository(path)
+            t = time.time()
+            moved = store.move(hot, time.time() - keep * DAY, chunk)
+            elapsed = time.time() - t
+            hot.close()
+            store.close()
+            db.execute("VACUUM")
+            db.close()
+            archived = os.path.getsize(os.path.join(tmp, "archive-{}.db".format(rows)))
+            table.append([rows, moved, round(elapsed, 2), round(moved / elapsed, 1),
+                          round(store.longestChunk * 1000, 1), round(before / float(rows)),
+                          round(archived / float(moved)), os.path.getsize(path) // 1024])
+    finally:
+        shutil.rmtree(tmp)
+    return table, ["Rows", "Archived", "Time (s)", "Rows/s", "Longest lock (ms)", "Hot bytes/row",
+                   "Archive bytes/row", "Hot after (KB)"]
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_storage(sizes, seconds=2.0, readers=4):
+    # Roundup reads from `readers` threads while one thread keeps rescoring posts. One shared connection serialises
+    # them all, the pool gives every thread its own and WAL lets the reads run next to the writes
+    table = []
+    tmp = tempfile.mkdtemp()
+    try:
+        for rows in sizes:
+            path = os.path.join(tmp, "storage-{}.db".format(rows))
+            fill_legacy(path, rows).close()
+            now = time.time()
+            for shared in [True, False]:
+                store = storage.SQLiteRepository(path, size=readers, shared=shared)
+                ids = [f[0] for f in store.postsInWindow(now, 0)]
+                counts = {'reads': 0, 'writes': 0}
+                lock = threading.Lock()
+                stop = time.time() + seconds
+
+                def read():
+                    while time.time() < stop:
+                        start = random.uniform(now - 30 * DAY, now)
+                        store.postsInWindow(start, start - DAY)
+                        with lock:
+                            counts['reads'] += 1
+
+                def write():
+                    while time.time() < stop:
+                        store.updateScores([(random.randint(0, 5000), random.choice(ids)) for i in range(100)])
+                        counts['writes'] += 1
+
+                threads = [threading.Thread(target=read) for i in range(readers)] + [threading.Thread(target=write)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                store.close()
+                table.append([rows, "shared" if shared else "pool of {}".format(readers), round(counts['reads'] / seconds, 1), round(counts['writes'] / seconds, 1)])
+    finally:
+        shutil.rmtree(tmp)
+    return table, ["Rows", "Connections", "Roundup reads/s", "Score writes/s"]
+
+
+BENCHMARKS = {
+    "schema": (bench_schema, [10000, 100000, 1000000]),
+    "delivery": (bench_delivery, [100]),
+    "shards": (bench_shards, [2000]),
+    "splitter": (bench_splitter, [100, 1000, 10000]),
+    "render": (bench_render, [100000, 1000000]),
+    "inbox": (bench_inbox, [100, 500]),
+    "suite": (bench_suite, [1000, 200, 200]),
+    "digest": (bench_digest, [1000, 200]),
+    "feeds": (bench_feeds, [500, 8]),
+    "httpcache": (bench_httpcache, [1000]),
+    "publish": (bench_publish, [1000]),
+    "stats": (bench_stats, [100000, 1000000]),
+    "archive": (bench_archive, [100000, 1000000]),
+    "refresh": (bench_refresh, [2000]),
+    "storage": (bench_storage, [100000]),
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("Usage: python benchmark.py <{}> [sizes...] [--out FILE]".format("|".join(sorted(BENCHMARKS))))
+        sys.exit(1)
+    args = sys.argv[2:]
+    out = None
+    if "--out" in args:
+        out = args[args.index("--out") + 1]
+        del args[args.index("--out"):args.index("--out") + 2]
+    fn, sizes = BENCHMARKS[sys.argv[1]]
+    sizes = [int(f) for f in args] or sizes
+    table, headers = fn(sizes)
+    print(tabulate(table, headers=headers, tablefmt='orgtbl'))
+    if out:
+        with open(out, "a") as f:
+            f.write(json.dumps({"benchmark": sys.argv[1], "commit": commit(), "time": int(time.time()), "sizes": sizes,
+                                "headers": headers, "rows": table}) + "\n")
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# praw clients for worker threads. praw isn't thread-safe, so a thread borrows a client nobody else is using for
+# as long as it needs one. Clients are kept for the next borrower, a pool never has more than the most threads
+# that ever used it at once
+import queue
+from contextlib import contextmanager
+
+
+class ClientPool(object):
+    def __init__(self, connect):
+        # connect() makes a new client logged in as the account
+        self.connect = connect
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def client(self):
+        try:
+            r = self.idle.get_nowait()
+        except queue.Empty:
+            r = self.connect()
+        try:
+            yield r
+        finally:
+            self.idle.put(r)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import random
+import re
+import socket
+import threading
+import time
+import zlib
+import praw.exceptions
+import prawcore
+import clients
+import logger
+import metrics
+from multiprocessing.pool import ThreadPool
+
+log = logger.get_logger(__name__)
+
+# reddit's rate limit windows are 10 minutes, aligned to the clock
+RATELIMIT_WINDOW = 600
+
+# Retrying these won't help, the user is gone or has blocked the bot
+PERMANENT_ERRORS = (prawcore.exceptions.Forbidden, prawcore.exceptions.NotFound)
+# The same as reddit API errors (praw.exceptions.RedditAPIException error types): a deleted or suspended user, or
+# one who only takes PMs from people they whitelisted
+PERMANENT_API_ERRORS = {"USER_DOESNT_EXIST", "NOT_WHITELISTED_BY_USER_MESSAGE"}
+# reddit's anti-spam limit on PMs, separate from the API rate limit: "Take a break for 3 minutes before trying again"
+RATELIMIT_DELAY = re.compile(r"(\d+) (second|minute)")
+
+
+def apiErrors(e):
+    # (permanent, seconds reddit asked us to wait or None) for an exception from sending a PM
+    if not isinstance(e, praw.exceptions.RedditAPIException):
+        return False, None
+    wait = None
+    for item in e.items:
+        if item.error_type in PERMANENT_API_ERRORS:
+            return True, None
+        match = RATELIMIT_DELAY.search(item.message or "") if item.error_type == "RATELIMIT" else None
+        if match is not None:
+            wait = int(match.group(1)) * (60 if match.group(2) == "minute" else 1)
+    return False, wait
+
+
+def shard(user, shards):
+    # Stable across processes and machines, unlike hash()
+    return zlib.crc32(user.lower().encode('utf-8')) % shards
+
+
+class TokenBucket(object):
+    def __init__(self, rate=1.0, capacity=5):
+        self.defaultRate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.time()
+        self.resetAt = 0
+        self.lock = threading.Lock()
+
+    def update(self, remaining, reset):
+        # Follow reddit's x-ratelimit-* headers: spread what is left of the window evenly until it resets
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            window = max(reset - time.time(), 1)
+            self.rate = max(remaining, 0) / window
+            self.tokens = min(self.tokens, max(remaining, 0))
+            self.resetAt = reset
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.rate <= 0 and now >= self.resetAt:
+                    self.rate = self.defaultRate
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate if self.rate > 0 else max(self.resetAt - now, 0.1)
+            time.sleep(wait)
+
+
+class SharedTokenBucket(object):
+    # TokenBucket kept in the store (storage.Repository.takeToken), one per reddit account. reddit limits the
+    # account, not the process, so every delivery process sending as it, here or on other machines, draws from
+    # the same bucket
+    def __init__(self, store, name, rate=1.0, capacity=5):
+        self.store = store
+        self.name = name
+        self.defaultRate = float(rate)
+        self.capacity = float(capacity)
+
+    def update(self, remaining, reset):
+        if remaining is None or reset is None:
+            return
+        window = max(reset - time.time(), 1)
+        self.store.setRate(self.name, max(remaining, 0) / window, max(remaining, 0), reset)
+
+    def acquire(self):
+        while True:
+            wait = self.store.takeToken(self.name, time.time(), self.defaultRate, self.capacity)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class Delivery(object):
+    def __init__(self, reddit, store, workers=2, maxAttempts=5, backoff=2, bucket=None, shards=1, lease=5 * 60,
+                 connect=None):
+        # store is a storage.Repository. Users are spread over `shards` by a hash of their name, worker processes
+        # each claim a shard for `lease` seconds at a time, see runShards. connect() makes another client as the
+        # same account, every worker thread sends with one of its own. Without it they all share reddit, which
+        # praw doesn't support beyond one worker
+        self.r = reddit
+        self.clients = clients.ClientPool(connect or (lambda: reddit))
+        self.store = store
+        self.workers = workers
+        self.maxAttempts = maxAttempts
+        self.backoff = backoff
+        self.bucket = bucket or TokenBucket()
+        self.shards = shards
+        self.lease = lease
+        self.worker = "{}:{}:{}".format(socket.gethostname(), os.getpid(), random.randint(0, 10 ** 6))
+
+    def enqueue(self, edition, parts, users):
+        # parts is a list of (subject, body). Re-enqueueing an edition is a no-op for rows that already exist,
+        # so a re-run after a crash only adds what is missing
+        self.store.enqueue(edition, parts, users, dict((user, shard(user, self.shards)) for user in users))
+
+    def pending(self, edition, shard=None):
+        return self.store.pendingJobs(edition, shard)
+
+    def updateLimits(self, r):
+        limits = getattr(r.auth, 'limits', None) or {}
+        # Newer praw versions no longer expose reset_timestamp, fall back to the end of the current window
+        reset = limits.get('reset_timestamp') or (time.time() // RATELIMIT_WINDOW + 1) * RATELIMIT_WINDOW
+        self.bucket.update(limits.get('remaining'), reset)
+
+    def send(self, job):
+        user, part, subject, body, attempts = job
+        error = None
+        attempt = attempts
+        while attempt < self.maxAttempts:
+            self.bucket.acquire()
+            if attempt > attempts:
+                metrics.incr(metrics.RETRIES)
+            metrics.incr(metrics.API_CALLS)
+            with self.clients.client() as r:
+                try:
+                    r.redditor(user).message(subject=subject, message=body)
+                    metrics.incr(metrics.MESSAGES_SENT)
+                    self.updateLimits(r)
+                    return user, part, 'sent', attempt + 1, None
+                except PERMANENT_ERRORS as e:
+                    return user, part, 'failed', attempt + 1, repr(e)
+                except Exception as e:
+                    error = repr(e)
+                    self.updateLimits(r)
+                    permanent, wait = apiErrors(e)
+            if permanent:
+                return user, part, 'failed', attempt + 1, error
+            if wait is not None:
+                # Not the message's fault, so it doesn't cost an attempt. The bucket holds back every sender on the
+                # account until then, bucket.acquire waits it out
+                log.warning("Rate limited messaging {}, waiting {}s: {}".format(user, wait, error))
+                self.bucket.update(0, time.time() + wait)
+                continue
+            log.warning("Attempt {} to message {} failed: {}".format(attempt + 1, user, error))
+            attempt += 1
+            if attempt < self.maxAttempts:
+                time.sleep(self.backoff * 2 ** (attempt - attempts - 1))
+        return user, part, 'failed', self.maxAttempts, error
+
+    def sendInOrder(self, jobs):
+        # A user's parts go out one after the other so part 2 never arrives before part 1
+        return [self.send(job) for job in jobs]
+
+    def run(self, edition, shard=None):
+        # Every pending job of the edition, or of one shard while holding its lease
+        jobs = self.pending(edition, shard)
+        byUser = []
+        for job in jobs:
+            if byUser and byUser[-1][0][0] == job[0]:
+                byUser[-1].append(job)
+            else:
+                byUser.append([job])
+
+        t = time.time()
+        renew = t + self.lease / 2.0
+        counts = {'sent': 0, 'failed': 0}
+        pool = ThreadPool(self.workers)
+        try:
+            # Results are written from this thread only and committed as they come in, so a crash loses nothing.
+            # The lease is renewed while the workers wait out a rate limit too
+            sending = pool.imap_unordered(self.sendInOrder, byUser)
+            while True:
+                try:
+                    results = sending.next(timeout=self.lease / 4.0)
+                except StopIteration:
+                    break
+                except multiprocessing.TimeoutError:
+                    results = []
+                for user, part, status, attempts, error in results:
+                    counts[status] += 1
+                    if status == 'failed':
+                        log.error("Giving up on messaging {} part {} of {}: {}".format(user, part + 1, edition, error))
+                self.store.markJobs(edition, results)
+                if shard is not None and time.time() > renew:
+                    renew = time.time() + self.lease / 2.0
+                    if not self.store.renewLease(edition, shard, self.worker, int(time.time()) + self.lease):
+                        # Another worker took the shard over, it sends whatever is still pending
+                        log.warning("Lost the lease on shard {} of {}, stopping".format(shard, edition))
+                        pool.terminate()
+                        break
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - t
+        log.info("Delivered {sent} messages for {edition} ({failed} failed) in {s}s, {rate} msg/s".format(
+            sent=counts['sent'],
+            failed=counts['failed'],
+            edition=edition,
+            s=round(elapsed, 2),
+            rate=round(len(jobs) / elapsed, 1) if elapsed else len(jobs)))
+        return counts
+
+    def runShards(self, edition):
+        # Claim shards with pending jobs one at a time until none are left. Any number of processes, here or on
+        # other machines, can run this against the same outbox. A shard whose worker died is taken over once its
+        # lease expires, so while shards are leased by others this waits rather than returning
+        counts = {'sent': 0, 'failed': 0}
+        while True:
+            shards = self.store.pendingShards(edition)
+            if not shards:
+                break
+            random.shuffle(shards)  # Workers starting together don't all race for the same shard
+            now = int(time.time())
+            claimed = next((f for f in shards if self.store.claimShard(edition, f, self.worker, now + self.lease, now)), None)
+            if claimed is None:
+                time.sleep(min(self.lease / 10.0, 5))
+                continue
+            try:
+                result = self.run(edition, claimed)
+            finally:
+                self.store.releaseShard(edition, claimed, self.worker)
+            counts['sent'] += result['sent']
+            counts['failed'] += result['failed']
+        return counts
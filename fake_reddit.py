@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+# A local stand-in for the reddit API, just enough of it for praw to drive HHHBot against
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import praw
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def client(url, **kwargs):
+    # A praw client for a fake server at url, also from processes that don't have the server object
+    return praw.Reddit(client_id='fake', client_secret='fake', username='HHHFreshBot2_0', password='fake',
+                       user_agent='HHHFreshBot2.0 benchmark', oauth_url=url, reddit_url=url, **kwargs)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            raw = self.rfile.read(length).decode('utf-8')
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params['json'] = json.loads(raw)
+            else:
+                params.update((k, v[-1]) for k, v in parse_qs(raw).items())
+
+        status, body, headers = self.server.dispatch(method, url.path.rstrip('/'), params)
+        data = json.dumps(body).encode('utf-8')
+        if method == 'GET' and status == 200:
+            # Conditional GETs get a 304 while the body is unchanged
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            headers = dict(headers, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                status, data = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeServer(ThreadingHTTPServer):
+    # Routes are (method, path regex, handler). Handlers get the regex groups then the request params, which
+    # hold the query string, the form fields and a JSON body under 'json'
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, ratelimit=600, window=600):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), FakeHandler)
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.window = window
+        self.windowStart = time.time() // window * window
+        self.used = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.routes = []
+        self.outages = []  # [path regex, requests to let through first, requests to fail], see fail
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def route(self, method, pattern, handler):
+        self.routes.append((method, re.compile(pattern + '$'), handler))
+
+    def fail(self, pattern, n, after=0):
+        # Once `after` more requests to matching paths went through, answer the next n with a 500
+        with self.lock:
+            self.outages.append([re.compile(pattern), after, n])
+
+    def outage(self, path):
+        with self.lock:
+            for outage in self.outages:
+                if outage[2] > 0 and outage[0].search(path):
+                    if outage[1] > 0:
+                        outage[1] -= 1
+                        return False
+                    outage[2] -= 1
+                    return True
+        return False
+
+    def countRequest(self):
+        # (over the limit, headers to send back)
+        with self.lock:
+            now = time.time()
+            if now - self.windowStart >= self.window:
+                self.windowStart = now // self.window * self.window
+                self.used = 0
+            self.used += 1
+            self.requests += 1
+            return self.used > self.ratelimit, self.ratelimitHeaders(now)
+
+    def ratelimitHeaders(self, now):
+        return {}
+
+    def error(self, status, message):
+        return {'message': message, 'error': status}
+
+    def limited(self, headers):
+        headers['Retry-After'] = str(int(self.window - (time.time() - self.windowStart)) + 1)
+        return 429, self.error(429, 'Too Many Requests'), headers
+
+    def dispatch(self, method, path, params):
+        if self.latency:
+            time.sleep(self.latency)
+        for routeMethod, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if routeMethod == method and match is not None:
+                break
+        else:
+            return 404, self.error(404, 'Not Found'), {}
+
+        over, headers = self.countRequest()
+        if over:
+            return self.limited(headers)
+        if self.outage(path):
+            return 500, self.error(500, 'Internal Server Error'), headers
+        return 200, handler(*match.groups() + (params,)), headers
+
+
+class FakeReddit(FakeServer):
+    # Post scores climb towards their final score and settle, SETTLE seconds is the time constant
+    SETTLE = 12 * 60 * 60
+
+    def __init__(self, port=0, latency=0.0, ratelimit=600, window=600):
+        FakeServer.__init__(self, port, latency, ratelimit, window)
+        self.clock = time.time  # Replaced to simulate days of score movement
+        self.finalScores = {}
+        self.messages = []  # (to, subject, text) for every PM sent
+        self.inbox = []  # t4 message data, see addMessage
+        self.read = set()
+        self.refusals = {}  # lowercased username -> [reddit error type, message, compose requests left to refuse]
+        self.replies = []  # (parent fullname, text)
+        self.posts = []  # t3 submission data, newest first, see addPosts
+        self.postsByName = {}
+        self.submissions = []  # (subreddit, title, text)
+        self.route('POST', r'/api/compose', self.compose)
+        self.route('GET', r'/message/unread', self.unread)
+        self.route('POST', r'/api/read_message', self.read_message)
+        self.route('POST', r'/api/comment', self.comment)
+        self.route('GET', r'/r/([^/]+)/new', self.new)
+        self.route('GET', r'/api/info', self.info)
+        self.route('POST', r'/api/submit', self.submit)
+
+    def reddit(self, **kwargs):
+        return client(self.url, **kwargs)
+
+    def ratelimitHeaders(self, now):
+        # Same headers reddit sends, praw feeds them into reddit.auth.limits
+        return {
+            'x-ratelimit-used': str(self.used),
+            'x-ratelimit-remaining': str(max(self.ratelimit - self.used, 0)),
+            'x-ratelimit-reset': str(int(self.window - (now - self.windowStart))),
+        }
+
+    def dispatch(self, method, path, params):
+        # Token requests don't count against the API limit
+        if path == '/api/v1/access_token':
+            return 200, self.access_token(params), {}
+        return FakeServer.dispatch(self, method, path, params)
+
+    def access_token(self, params):
+        return {'access_token': 'fake', 'token_type': 'bearer', 'expires_in': 3600, 'scope': '*'}
+
+    def compose(self, params):
+        with self.lock:
+            refusal = self.refusals.get((params.get('to') or '').lower())
+            if refusal is not None and refusal[2] != 0:
+                if refusal[2] is not None:
+                    refusal[2] -= 1
+                return {'json': {'errors': [[refusal[0], refusal[1], 'to']]}}
+            self.messages.append((params.get('to'), params.get('subject'), params.get('text')))
+        return {'json': {'errors': []}}
+
+    def refuse(self, user, errorType, message, n=None):
+        # Answer the next n PMs to user (all of them when n is None) with a reddit API error, e.g.
+        # USER_DOESNT_EXIST or RATELIMIT "Take a break for 2 seconds before trying again."
+        with self.lock:
+            self.refusals[user.lower()] = [errorType, message, n]
+
+    def addMessage(self, author, subject, body, was_comment=False):
+        with self.lock:
+            id_ = 'm{}'.format(len(self.inbox))
+            self.inbox.append({'id': id_, 'name': 't4_' + id_, 'author': author, 'subject': subject, 'body': body,
+                               'body_html': body, 'was_comment': was_comment, 'context': '', 'dest': 'HHHFreshBot2_0',
+                               'new': True, 'created_utc': time.time(), 'replies': '', 'subreddit': None,
+                               'parent_id': None, 'first_message_name': None, 'distinguished': None})
+
+    def addPosts(self, n, subreddit='hiphopheads', maxAge=7 * 24 * 60 * 60, fresh=0.5):
+        # n posts spread evenly over the last maxAge seconds, about `fresh` of them tagged [FRESH]
+        now = self.clock()
+        with self.lock:
+            for i in range(n):
+                id_ = 'p{}'.format(len(self.posts))
+                tag = '[FRESH] ' if random.random() < fresh else ''
+                post = {'id': id_, 'name': 't3_' + id_, 'title': '{}Artist {} - Song {}'.format(tag, i % 300, i),
+                        'score': 0, 'created_utc': now - maxAge * float(i) / n,
+                        'url': 'https://example.com/' + id_, 'author': 'user{}'.format(i % 500),
+                        'permalink': '/r/{}/comments/{}/song/'.format(subreddit, id_), 'subreddit': subreddit,
+                        'selftext': '', 'is_self': False, 'num_comments': 0}
+                self.posts.append(post)
+                self.postsByName[post['name']] = post
+                self.finalScores[post['name']] = random.randint(0, 2000)
+            self.posts.sort(key=lambda f: -f['created_utc'])
+
+    def score(self, post):
+        age = max(self.clock() - post['created_utc'], 0)
+        return int(self.finalScores[post['name']] * (1 - math.exp(-age / self.SETTLE)))
+
+    def listing(self, children, params):
+        limit = min(int(params.get('limit') or 25), 100)  # reddit caps listing pages at 100
+        after = params.get('after')
+        names = [f['data']['name'] for f in children]
+        start = names.index(after) + 1 if after in names else 0
+        page = children[start:start + limit]
+        return {'kind': 'Listing', 'data': {
+            'after': page[-1]['data']['name'] if start + limit < len(children) and page else None,
+            'before': None, 'children': page}}
+
+    def unread(self, params):
+        with self.lock:
+            children = [{'kind': 't4', 'data': f} for f in self.inbox if f['name'] not in self.read]
+        return self.listing(children, params)
+
+    def read_message(self, params):
+        with self.lock:
+            self.read.update(params.get('id', '').split(','))
+        return {}
+
+    def comment(self, params):
+        # praw builds the returned Comment from this, so chained replies have something to reply to
+        with self.lock:
+            self.replies.append((params.get('thing_id'), params.get('text')))
+            id_ = 'c{}'.format(len(self.replies))
+        return {'json': {'errors': [], 'data': {'things': [{'kind': 't1', 'data': {
+            'id': id_, 'name': 't1_' + id_, 'body': params.get('text'), 'parent_id': params.get('thing_id'),
+            'link_id': params.get('thing_id'), 'subreddit': 'hiphopheads', 'author': 'HHHFreshBot2_0'}}]}}}
+
+    def new(self, subreddit, params):
+        # /r/a+b/new lists several subreddits as one
+        subreddits = set(subreddit.lower().split('+'))
+        with self.lock:
+            children = [{'kind': 't3', 'data': dict(f, score=self.score(f))} for f in self.posts
+                        if f['subreddit'].lower() in subreddits]
+        return self.listing(children, params)
+
+    def info(self, params):
+        with self.lock:
+            children = []
+            for name in params.get('id', '').split(','):
+                post = self.postsByName.get(name)
+                if post is not None:
+                    children.append({'kind': 't3', 'data': dict(post, score=self.score(post))})
+        return {'kind': 'Listing', 'data': {'after': None, 'before': None, 'children': children}}
+
+    def submit(self, params):
+        with self.lock:
+            self.submissions.append((params.get('sr'), params.get('title'), params.get('text')))
+            id_ = 's{}'.format(len(self.submissions))
+        return {'json': {'errors': [], 'data': {
+            'id': id_, 'name': 't3_' + id_,
+            'url': 'https://www.reddit.com/r/{}/comments/{}/weekly/'.format(params.get('sr'), id_)}}}
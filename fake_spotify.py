@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# A local stand-in for the spotify web API endpoints weekly_playlist uses
+import random
+import spotipy
+from fake_reddit import FakeServer
+
+
+class FakeSpotify(FakeServer):
+    def __init__(self, port=0, latency=0.0, ratelimit=100000, window=30, matchRate=0.8):
+        FakeServer.__init__(self, port, latency, ratelimit, window)
+        self.matchRate = matchRate  # Share of searches that find a track
+        self.matches = {}
+        self.playlists = {}  # id -> playlist object with a 'uris' list, None for a track spotify no longer has
+        self.route('GET', r'/v1/search', self.search)
+        self.route('GET', r'/v1/users/([^/]+)/playlists', self.user_playlists)
+        self.route('POST', r'/v1/users/([^/]+)/playlists', self.create_playlist)
+        self.route('GET', r'/v1/playlists/([^/]+)', self.playlist)
+        self.route('PUT', r'/v1/playlists/([^/]+)', self.update_playlist)
+        self.route('PUT', r'/v1/playlists/([^/]+)/images', self.update_playlist)
+        # spotipy has moved between the /tracks and /items spellings of these
+        items = r'/v1/(?:users/[^/]+/)?playlists/([^/]+)/(?:tracks|items)'
+        self.route('GET', items, self.tracks)
+        self.route('POST', items, self.add_tracks)
+        self.route('DELETE', items, self.remove_tracks)
+        self.route('PUT', items, self.put_tracks)
+
+    def client(self):
+        sp = spotipy.Spotify(auth='fake', retries=0)
+        sp.prefix = self.url + '/v1/'
+        return sp
+
+    def error(self, status, message):
+        return {'error': {'status': status, 'message': message}}
+
+    def snapshot(self, playlist):
+        playlist['snapshot_id'] = str(int(playlist['snapshot_id']) + 1)
+        return {'snapshot_id': playlist['snapshot_id']}
+
+    def search(self, params):
+        query = params.get('q', '')
+        with self.lock:
+            if query not in self.matches:
+                self.matches[query] = random.random() < self.matchRate
+            found = self.matches[query]
+        items = [{'uri': 'spotify:track:{}'.format(abs(hash(query)) % 10 ** 12), 'name': query}] if found else []
+        return {'tracks': {'items': items, 'next': None, 'total': len(items)}}
+
+    def user_playlists(self, user, params):
+        with self.lock:
+            items = [dict((k, v) for k, v in f.items() if k != 'uris') for f in self.playlists.values()]
+        return {'items': items, 'next': None, 'total': len(items)}
+
+    def create_playlist(self, user, params):
+        with self.lock:
+            id_ = 'pl{}'.format(len(self.playlists))
+            self.playlists[id_] = {'id': id_, 'name': params['json']['name'], 'snapshot_id': '1', 'uris': [],
+                                   'external_urls': {'spotify': 'https://open.spotify.com/playlist/' + id_}}
+            return dict((k, v) for k, v in self.playlists[id_].items() if k != 'uris')
+
+    def playlist(self, id_, params):
+        with self.lock:
+            return dict((k, v) for k, v in self.playlists[id_].items() if k != 'uris')
+
+    def update_playlist(self, id_, params):
+        return {}
+
+    def tracks(self, id_, params):
+        limit = int(params.get('limit') or 100)
+        offset = int(params.get('offset') or 0)
+        with self.lock:
+            uris = self.playlists[id_]['uris']
+            page = uris[offset:offset + limit]
+            more = offset + limit < len(uris)
+        return {'items': [{'track': {'uri': f} if f is not None else None} for f in page], 'total': len(uris),
+                'offset': offset,
+                'next': '{}/v1/playlists/{}/tracks?offset={}&limit={}'.format(self.url, id_, offset + limit, limit)
+                if more else None}
+
+    def add_tracks(self, id_, params):
+        with self.lock:
+            playlist = self.playlists[id_]
+            body = params['json']
+            playlist['uris'].extend(body['uris'] if isinstance(body, dict) else body)
+            return self.snapshot(playlist)
+
+    def remove_tracks(self, id_, params):
+        with self.lock:
+            playlist = self.playlists[id_]
+            body = params['json']
+            items = body.get('items', body.get('tracks', []))  # Newer spotipy sends 'items'
+            positions = sorted((p for f in items for p in f.get('positions', [])), reverse=True)
+            for p in positions:
+                playlist['uris'].pop(p)
+            return self.snapshot(playlist)
+
+    def put_tracks(self, id_, params):
+        # Replace and reorder share the endpoint, the body tells them apart
+        if 'uris' in params['json']:
+            return self.replace_tracks(id_, params)
+        return self.reorder_tracks(id_, params)
+
+    def replace_tracks(self, id_, params):
+        with self.lock:
+            playlist = self.playlists[id_]
+            playlist['uris'] = list(params['json']['uris'])
+            return self.snapshot(playlist)
+
+    def reorder_tracks(self, id_, params):
+        body = params['json']
+        with self.lock:
+            playlist = self.playlists[id_]
+            uris = playlist['uris']
+            start, before = body['range_start'], body['insert_before']
+            moved = uris[start:start + body.get('range_length', 1)]
+            gap = object()  # Not None, that is an empty slot
+            rest = uris[:start] + [gap] * len(moved) + uris[start + len(moved):]
+            rest[before:before] = moved
+            playlist['uris'] = [f for f in rest if f is not gap]
+            return self.snapshot(playlist)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# A response cache inside praw's requests session. GET responses of the endpoint classes in ENDPOINTS are kept for
+# their TTL in a size bounded LRU, backed by a SQLite file so cron runs and retried jobs share it. Stale entries
+# with an ETag or Last-Modified are revalidated with a conditional request, a 304 serves the cached body again.
+# `python httpcache.py` prints what is stored per endpoint class
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+import requests
+from requests.structures import CaseInsensitiveDict
+import logger
+import metrics
+import schema
+
+log = logger.get_logger(__name__)
+
+# (class, path regex, TTL in seconds), first match wins. Other paths and anything but GET go straight through
+ENDPOINTS = [
+    ("inbox", r"/message/", 0),  # Never, a replayed unread listing would answer the same messages twice
+    ("listing", r"/r/[^/]+/(new|hot|top|rising)$", 60),
+    ("submission", r"/api/info$|/comments/", 10 * 60),
+]
+# Not replayed: the rate limit headers would rewind praw's limiter, the body is stored decoded
+DROPPED = ("x-ratelimit-used", "x-ratelimit-remaining", "x-ratelimit-reset", "content-encoding", "content-length",
+           "transfer-encoding", "set-cookie")
+STALE_KEEP = 24 * 60 * 60  # Expired entries are kept this long for revalidation
+
+
+def _responses(c):
+    c.execute("CREATE TABLE responses (KEY TEXT PRIMARY KEY, CLASS TEXT, STATUS INT, HEADERS TEXT, BODY BLOB, "
+              "EXPIRES REAL, USED REAL)")
+    c.execute("CREATE INDEX responses_used ON responses (USED)")
+
+
+# Same contract as schema.MIGRATIONS, for http_cache.db
+MIGRATIONS = [
+    _responses,
+]
+
+
+class HTTPCache(object):
+    def __init__(self, path, size=5000, endpoints=ENDPOINTS, trimEvery=100):
+        # Shared by the threads of the delivery and inbox pools, every access holds the lock
+        self.db = schema.connect(path, MIGRATIONS, check_same_thread=False)
+        self.size = size
+        self.endpoints = [(name, re.compile(pattern), ttl) for name, pattern, ttl in endpoints]
+        self.trimEvery = trimEvery
+        self.memory = OrderedDict()  # key -> entry, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.writes = 0
+
+    def endpoint(self, url):
+        # (class, TTL) of a URL, None if it isn't cached
+        path = urlparse(url).path.rstrip("/")
+        for name, pattern, ttl in self.endpoints:
+            if pattern.search(path):
+                return (name, ttl) if ttl > 0 else None
+        return None
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        # The entry, possibly expired, or None
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+            row = self.db.execute("SELECT STATUS, HEADERS, BODY, EXPIRES FROM responses WHERE KEY=?", (key,)).fetchone()
+            if row is None:
+                return None
+            entry = {'status': row[0], 'headers': json.loads(row[1]), 'body': row[2], 'expires': row[3]}
+            self.remember(key, entry)
+            self.db.execute("UPDATE responses SET USED=? WHERE KEY=?", (time.time(), key))
+            self.db.commit()
+            return entry
+
+    def put(self, key, name, entry):
+        with self.lock:
+            self.remember(key, entry)
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?)",
+                            (key, name, entry['status'], json.dumps(entry['headers']), entry['body'], entry['expires'],
+                             time.time()))
+            self.writes += 1
+            if self.writes % self.trimEvery == 0:
+                self.trim()
+            self.db.commit()
+
+    def trim(self):
+        # The file is bounded like memory, least recently stored or loaded entries go first
+        self.db.execute("DELETE FROM responses WHERE EXPIRES < ?", (time.time() - STALE_KEEP,))
+        self.db.execute("DELETE FROM responses WHERE KEY NOT IN (SELECT KEY FROM responses ORDER BY USED DESC LIMIT ?)",
+                        (self.size,))
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        metrics.incr({'hits': metrics.HTTP_CACHE_HITS, 'misses': metrics.HTTP_CACHE_MISSES,
+                      'revalidated': metrics.HTTP_CACHE_REVALIDATED}[counter])
+
+    def close(self):
+        if self.hits or self.misses:
+            log.info("HTTP cache: {h} hits ({r} revalidated), {m} misses, {n} entries in memory".format(
+                h=self.hits, r=self.revalidated, m=self.misses, n=len(self.memory)))
+        with self.lock:
+            self.trim()
+            self.db.commit()
+            self.db.close()
+
+
+def response(url, entry):
+    # A requests.Response as prawcore reads it, from a cache entry
+    cached = requests.Response()
+    cached.status_code = entry['status']
+    cached.reason = "OK"
+    cached.headers = CaseInsensitiveDict(entry['headers'])
+    cached._content = entry['body']
+    cached.encoding = "utf-8"
+    cached.url = url
+    return cached
+
+
+class CachingSession(requests.Session):
+    # Pass as praw.Reddit(requestor_kwargs={'session': CachingSession(cache)}). The key is the full URL, the
+    # Authorization header isn't part of it since a session belongs to one account
+    def __init__(self, cache):
+        requests.Session.__init__(self)
+        self.cache = cache
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        endpoint = self.cache.endpoint(url) if method.upper() == "GET" else None
+        if endpoint is None:
+            return requests.Session.request(self, method, url, params=params, headers=headers, **kwargs)
+        name, ttl = endpoint
+        key = requests.Request(method, url, params=params).prepare().url
+        entry = self.cache.get(key)
+        if entry is not None and entry['expires'] > time.time():
+            self.cache.count('hits')
+            return response(key, entry)
+
+        headers = dict(headers or {})
+        if entry is not None:
+            # Conditional request for a stale entry, if reddit gave us something to validate with
+            if 'etag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['etag']
+            if 'last-modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['last-modified']
+        fresh = requests.Session.request(self, method, url, params=params, headers=headers, **kwargs)
+        if fresh.status_code == 304 and entry is not None:
+            self.cache.count('revalidated')
+            self.cache.count('hits')
+            entry = dict(entry, expires=time.time() + ttl)
+            self.cache.put(key, name, entry)
+            return response(key, entry)
+
+        self.cache.count('misses')
+        if fresh.status_code == 200:
+            self.cache.put(key, name, {'status': 200, 'body': fresh.content, 'expires': time.time() + ttl,
+                                       'headers': dict((k.lower(), v) for k, v in fresh.headers.items()
+                                                       if k.lower() not in DROPPED)})
+        return fresh
+
+
+if __name__ == "__main__":
+    import os
+    import vals
+    from tabulate import tabulate
+
+    db = schema.connect(os.path.join(vals.cwd, "http_cache.db"), MIGRATIONS)
+    print(tabulate(db.execute("SELECT CLASS, COUNT(*), SUM(EXPIRES > ?), ROUND(SUM(LENGTH(BODY)) / 1024.0, 1) "
+                              "FROM responses GROUP BY CLASS ORDER BY CLASS", (time.time(),)).fetchall(),
+                   headers=["Class", "Entries", "Fresh", "KB"], tablefmt='orgtbl'))
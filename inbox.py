@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import time
+import vals
+import clients
+import logger
+import metrics
+from multiprocessing.pool import ThreadPool
+
+log = logger.get_logger(__name__)
+
+UNKNOWN = 'I couldn\'t understand your message. Please use one of the links below to subscribe!'
+
+
+def subscribe(current, subscription):
+    # (current subscription, requested list) -> (new subscription, reply)
+    if current is None:
+        return subscription, "You have been subscribed to the {} mailing list".format(subscription)
+    if current == subscription:
+        return current, "You are already subscribed to the {} mailing list!".format(subscription)
+    return "both", "You have been subscribed to both mailing lists!"
+
+
+def unsubscribe(current, unsubscribeFrom):
+    if current is None:
+        return None, 'Unable to unsubscribe because you are not currently subscribed to any mailing lists.'
+    if current == "both" and unsubscribeFrom == "daily":
+        return "weekly", 'You have been unsubscribed from the daily mailing list.'
+    if current == "both" and unsubscribeFrom == "weekly":
+        return "daily", 'You have been unsubscribed from the weekly mailing list.'
+    return None, 'You have been unsubscribed from both mailing lists. Sorry to see you go!'
+
+
+def setFormat(current, format):
+    # (current subscription, requested format) -> (new format or None if nothing changes, reply)
+    if current is None:
+        return None, 'You need to subscribe to a mailing list before choosing how roundups are sent.'
+    if format == "full":
+        return format, "You will now get the full roundup in your messages."
+    return format, "You will now get a short message with a link to each roundup."
+
+
+# Subject keyword, then (body keyword, mailing list) pairs, first match wins. "unsubscribe" contains "subscribe"
+# so it has to come first
+COMMANDS = [
+    ('unsubscribe', unsubscribe, [('daily', 'daily'), ('weekly', 'weekly'), ('remove', 'both')]),
+    ('subscribe', subscribe, [('daily', 'daily'), ('weekly', 'weekly'), ('both', 'both')]),
+    ('format', setFormat, [('full', 'full'), ('link', 'link')]),
+]
+
+
+def parse(subject, body):
+    # (action, mailing list), (action, None) if the body wasn't understood, None if it isn't a command at all
+    subject = subject.lower()
+    body = body.lower()
+    for keyword, action, lists in COMMANDS:
+        if keyword in subject:
+            for bodyKeyword, mailingList in lists:
+                if bodyKeyword in body:
+                    return action, mailingList
+            return action, None
+    return None
+
+
+def applyChanges(store, current, state):
+    # Write the difference between the subscriptions before and after a batch in one transaction
+    upserts = [(user, sub) for user, sub in state.items() if sub is not None and current.get(user) != sub]
+    deletes = [user for user, sub in state.items() if sub is None and current.get(user) is not None]
+    store.applySubscriptions(upserts, deletes)
+    return len(upserts), len(deletes)
+
+
+class Inbox(object):
+    def __init__(self, reddit, store, footer, workers=4, batchSize=100, connect=None):
+        # store is a storage.Repository. Replies go out from worker threads, each with its own client from
+        # connect() (see delivery.Delivery), reddit reads the inbox and marks it read
+        self.r = reddit
+        self.clients = clients.ClientPool(connect or (lambda: reddit))
+        self.store = store
+        self.footer = footer
+        self.workers = workers
+        self.batchSize = batchSize
+
+    def process(self):
+        t = time.time()
+        # Read the whole unread listing before marking anything, marking read while paging would move the
+        # listing under praw's "after" cursor
+        unread = list(self.r.inbox.unread(limit=None))
+        metrics.incr(metrics.API_CALLS, len(unread) // 100 + 1)
+        for i in range(0, len(unread), self.batchSize):
+            self.processBatch(unread[i:i + self.batchSize])
+        elapsed = time.time() - t
+        if unread:
+            log.info("Processed {n} inbox messages in {s}s, {rate} msg/s".format(
+                n=len(unread), s=round(elapsed, 2), rate=round(len(unread) / elapsed, 1) if elapsed else len(unread)))
+        return len(unread)
+
+    def processBatch(self, batch):
+        authors = []
+        for pm in batch:
+            try:
+                authors.append(pm.author.name)
+            except AttributeError:
+                authors.append("None")
+
+        current = self.store.subscriptions(set(authors))
+        state = dict(current)
+        formats = {}
+        outgoing = []  # (pm to reply to or None for the admin, subject, text)
+
+        for pm, author in zip(batch, authors):
+            subject = pm.subject.lower()
+            body = pm.body.lower()
+
+            if pm.was_comment:
+                log.info("Forwarding comment message to admin")
+                outgoing.append((None, 'Comment from /u/{}'.format(author),
+                                 'Message from /u/{author}\n\nSubject: {subject}\n\nContext: {context}\n\n---\n\n{body}'.format(
+                                     author=author, subject=subject, context=pm.context, body=body)))
+                continue
+
+            command = parse(subject, body)
+            if command is None:
+                log.info("Message from {author} has been forwarded to admin".format(author=author))
+                outgoing.append((None, 'PM from /u/{}'.format(author),
+                                 "Message from /u/{author}\n\nSubject: {subject} \n\n---\n\n {body}".format(
+                                     author=author, subject=subject, body=body) + self.footer))
+                continue
+
+            action, mailingList = command
+            if mailingList is None:
+                log.info("{} message from {} could not be understood".format(action.__name__.capitalize(), author))
+                response = UNKNOWN
+            elif action is setFormat:
+                format, response = setFormat(state.get(author), mailingList)
+                if format is not None:
+                    formats[author] = format
+                log.info("Format {} ({}): now {}".format(author, mailingList, format))
+            else:
+                state[author], response = action(state.get(author), mailingList)
+                log.info("{} {} ({}): now {}".format(action.__name__.capitalize(), author, mailingList, state[author]))
+            outgoing.append((pm, None, response))
+
+        upserts, deletes = applyChanges(self.store, current, state)
+        # After the subscriptions, a subscribe and a format message in the same batch both count
+        formats = [(user, format) for user, format in formats.items() if state.get(user) is not None]
+        self.store.setFormats(formats)
+        log.debug("Batch of {} messages: {} subscriptions written, {} removed, {} formats set".format(
+            len(batch), upserts, deletes, len(formats)))
+
+        pool = ThreadPool(self.workers)
+        try:
+            pool.map(self.send, outgoing)
+        finally:
+            pool.close()
+            pool.join()
+        self.r.inbox.mark_read(batch)
+        metrics.incr(metrics.API_CALLS, -(-len(batch) // 25))  # praw marks 25 per request
+        metrics.incr(metrics.ROWS_WRITTEN, upserts + deletes + len(formats))
+
+    def send(self, message):
+        from praw.models import Message  # Loaded with the reddit client anyway, `help` doesn't need either
+        pm, subject, text = message
+        metrics.incr(metrics.API_CALLS)
+        try:
+            with self.clients.client() as r:
+                if pm is None:
+                    r.redditor(vals.admin).message(subject=subject, message=text)
+                else:
+                    # pm belongs to the reading client, reply through this thread's
+                    Message(r, {'id': pm.id}).reply(text + self.footer)
+            metrics.incr(metrics.MESSAGES_SENT)
+        except Exception:
+            log.exception("Failed to send message {} with body {}".format(subject or pm.author, text))
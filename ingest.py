@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Which posts go into which roundup. A feed is a set of subreddits, title tag rules, thresholds and the roundup
+# its posts are rolled up in. All feeds' subreddits are listed together (one /r/a+b+c/new walk, see
+# Pipeline.listing) and every post goes to the first feed whose compiled predicate accepts it
+import re
+import logger
+
+log = logger.get_logger(__name__)
+
+DEFAULT = "fresh"  # Roundup name for posts stored before there were feeds, see schema._feeds
+
+
+def predicate(subreddits, tags, exclude=()):
+    # A predicate on (subreddit, title). Tags and excludes are case insensitive substrings, each list joined into
+    # a single regex so a title is scanned once per list. No tags accepts every title
+    subreddits = frozenset(f.lower() for f in subreddits)
+    tagged = re.compile("|".join(re.escape(f) for f in tags), re.I).search if tags else None
+    excluded = re.compile("|".join(re.escape(f) for f in exclude), re.I).search if exclude else None
+
+    def match(subreddit, title):
+        if subreddit.lower() not in subreddits:
+            return False
+        if tagged is not None and tagged(title) is None:
+            return False
+        return excluded is None or excluded(title) is None
+    return match
+
+
+class Feed(object):
+    def __init__(self, name, subreddits, tags, minScore, maxAge, roundup=None, exclude=()):
+        # Posts scoring above minScore are stored for the roundup right away, the rest wait in pending until they
+        # do or turn maxAge seconds old. Feeds without a roundup of their own roll up under their name
+        self.name = name
+        self.subreddits = list(subreddits)
+        self.minScore = minScore
+        self.maxAge = maxAge
+        self.roundup = roundup or name
+        self.match = predicate(self.subreddits, tags, exclude)
+
+
+class Pipeline(object):
+    def __init__(self, feeds):
+        if not feeds:
+            raise ValueError("At least one feed is needed")
+        self.feeds = list(feeds)
+        self.byName = dict((f.name, f) for f in self.feeds)
+        self.subreddits = []
+        for feed in self.feeds:
+            for subreddit in feed.subreddits:
+                if subreddit.lower() not in [f.lower() for f in self.subreddits]:
+                    self.subreddits.append(subreddit)
+        self.maxAge = max(f.maxAge for f in self.feeds)
+        self.roundups = []  # Roundup names in the order the feeds give them
+        for feed in self.feeds:
+            if feed.roundup not in self.roundups:
+                self.roundups.append(feed.roundup)
+
+    @property
+    def listing(self):
+        # reddit serves /new for several subreddits joined with + as one listing
+        return "+".join(self.subreddits)
+
+    def route(self, subreddit, title):
+        # The first feed taking the post, None if no feed does
+        for feed in self.feeds:
+            if feed.match(subreddit, title):
+                return feed
+        return None
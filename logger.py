@@ -4,12 +4,18 @@ import logging
 import vals
 import os
 import sys
-import praw
+import queue
+import re
+import threading
+import time
+import atexit
+from collections import OrderedDict
 from datetime import datetime
 
 FORMATTER = logging.Formatter(
     "%(asctime)s — %(name)s — %(levelname)s — %(message)s")
 LOG_FILE = os.path.join(vals.cwd, "HHHBot.log")
+_handlers = []
 
 
 def get_console_handler():
@@ -19,23 +25,104 @@ def get_console_handler():
 
 
 def get_file_handler():
-    file_handler = TimedRotatingFileHandler(LOG_FILE, when='midnight', backupCount=10)
+    # delay: the file is opened by the first record written, not on import
+    file_handler = TimedRotatingFileHandler(LOG_FILE, when='midnight', backupCount=10, delay=True)
     file_handler.setFormatter(FORMATTER)
     return file_handler
 
 
+class Alerter(object):
+    # Sends error logs to the admin from a background thread. Errors are fingerprinted and everything logged within
+    # `window` seconds of the first one goes out as a single digest PM, so a failing loop can't spam the admin
+    # or block on reddit
+    STOP = object()
+
+    def __init__(self, reddit_instance, window=10 * 60, log=None):
+        self.r = reddit_instance  # Or a function returning it, called when a digest is sent
+        self.window = window
+        self.log = log
+        self.queue = queue.Queue()
+        self.pending = OrderedDict()  # fingerprint -> [first message, count]
+        self.windowStart = None
+        self.thread = threading.Thread(target=self.run, name="alerter")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def fingerprint(name, msg):
+        # Ids, scores and timestamps change between otherwise identical errors
+        return name, re.sub(r'\d+', 'N', msg)[:200]
+
+    def alert(self, name, msg):
+        self.queue.put((time.time(), name, "{}".format(msg)))
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.windowStart is not None:
+                timeout = max(self.windowStart + self.window - time.time(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self.STOP:
+                self.flush()
+                return
+            if item is not None:
+                t, name, msg = item
+                key = self.fingerprint(name, msg)
+                if key in self.pending:
+                    self.pending[key][1] += 1
+                else:
+                    self.pending[key] = [msg, 1]
+                if self.windowStart is None:
+                    self.windowStart = t
+            if self.windowStart is not None and time.time() - self.windowStart >= self.window:
+                self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        total = sum(f[1] for f in self.pending.values())
+        body = "{} errors ({} distinct) since {}\n\n".format(
+            total, len(self.pending), datetime.utcfromtimestamp(self.windowStart).strftime("%H:%M %d/%m/%Y"))
+        body += "\n\n".join("**{}x** {}: {}".format(count, name, msg)
+                             for (name, _), (msg, count) in self.pending.items())
+        self.pending = OrderedDict()
+        self.windowStart = None
+        try:
+            r = self.r() if callable(self.r) else self.r
+            r.redditor(vals.admin).message(
+                subject="An error occured in the HHHFreshness bot at {}".format(datetime.now().strftime("%H:%M %d/%m/%Y")),
+                message=body[:10000])
+        except Exception as e:
+            if self.log is not None:
+                self.log.warning("Failed to send error digest to admin: {}".format(e))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(self.STOP)
+            self.thread.join(30)
+
+
 class cust_logger(logging.Logger):
+    alerter = None  # Shared by every logger once a reddit instance is set
+
     def __init__(self, name, level = logging.NOTSET):
-	self.r = None 
-    	return super(cust_logger, self).__init__(name, level)        
-    
+        return super(cust_logger, self).__init__(name, level)
+
     def setRedditInst(self, reddit_instance):
-        self.r = reddit_instance
+        if cust_logger.alerter is None:
+            cust_logger.alerter = Alerter(reddit_instance, log=self)
+        else:
+            cust_logger.alerter.r = reddit_instance
 
     def error(self, msg, *args, **kwargs):
-        if self.r is not None:
-            self.r.redditor(vals.admin).message("An error occured in the HHHFreshness bot at {}".format(datetime.now().strftime("%H:%M %d/%m/%Y")), msg)
-	return super(cust_logger, self).warning(msg, *args, **kwargs)
+        if cust_logger.alerter is not None:
+            cust_logger.alerter.alert(self.name, msg)
+        return super(cust_logger, self).warning(msg, *args, **kwargs)
 
 def get_logger(logger_name):
     logging.setLoggerClass(cust_logger)
@@ -45,8 +132,11 @@ def get_logger(logger_name):
     
     # better to have too much log than not enough
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(get_console_handler())
-    logger.addHandler(get_file_handler())
+    # One console and one file handler shared by every module's logger
+    if not _handlers:
+        _handlers.extend([get_console_handler(), get_file_handler()])
+    for handler in _handlers:
+        logger.addHandler(handler)
     # with this pattern, it's rarely necessary to propagate the error up to parent
     logger.propagate = False
     return logger
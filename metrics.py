@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Per-run timings and counters, saved to the runs/run_metrics tables. `python metrics.py [days]` prints p50/p95
+# per stage over the recorded runs
+import functools
+import math
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+API_CALLS = "api_calls"
+ROWS_SCANNED = "rows_scanned"
+ROWS_WRITTEN = "rows_written"
+MESSAGES_SENT = "messages_sent"
+RETRIES = "retries"
+HTTP_CACHE_HITS = "http_cache_hits"
+HTTP_CACHE_MISSES = "http_cache_misses"
+HTTP_CACHE_REVALIDATED = "http_cache_revalidated"
+
+_lock = threading.Lock()
+_spans = []
+_counters = defaultdict(int)
+_started = time.time()
+
+
+def reset():
+    global _started
+    with _lock:
+        del _spans[:]
+        _counters.clear()
+        _started = time.time()
+
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+@contextmanager
+def span(name):
+    t = time.time()
+    try:
+        yield
+    finally:
+        with _lock:
+            _spans.append((name, time.time() - t))
+
+
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        return list(_spans), dict(_counters)
+
+
+def save(db, command):
+    spans, counters = snapshot()
+    finished = time.time()
+    c = db.cursor()
+    c.execute("INSERT INTO runs (COMMAND, STARTED, SECONDS) VALUES (?,?,?)", (command, _started, finished - _started))
+    run = c.lastrowid
+    c.executemany("INSERT INTO run_metrics VALUES (?,?,?,?)",
+                  [(run, 'span', name, seconds) for name, seconds in spans] +
+                  [(run, 'counter', name, value) for name, value in counters.items()])
+    db.commit()
+    reset()
+    return run
+
+
+def percentile(values, p):
+    # Nearest rank on an already sorted list
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def report(db, since=0):
+    rows = db.execute("SELECT m.KIND, m.NAME, m.VALUE FROM run_metrics m JOIN runs r ON r.ID = m.RUN "
+                      "WHERE r.STARTED > ? UNION ALL SELECT 'span', 'run:' || COMMAND, SECONDS FROM runs WHERE STARTED > ? "
+                      "ORDER BY 1, 2, 3", (since, since)).fetchall()
+    values = defaultdict(list)
+    for kind, name, value in rows:
+        values[(kind, name)].append(value)
+    return [[kind, name, len(v), round(percentile(v, 50), 3), round(percentile(v, 95), 3), round(max(v), 3)]
+            for (kind, name), v in sorted(values.items())]
+
+
+if __name__ == "__main__":
+    import vals
+    import schema
+    from tabulate import tabulate
+
+    days = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    db = schema.connect(os.path.join(vals.cwd, "fresh.db"))
+    print(tabulate(report(db, time.time() - days * 24 * 60 * 60),
+                   headers=["Kind", "Stage", "Samples", "p50", "p95", "Max"], tablefmt='orgtbl'))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logger
+
+log = logger.get_logger(__name__)
+
+DAY = 24 * 60 * 60
+TABLE_HEADER = "\n\nPost | link | Score | User \n :--|:--|:--|:--|\n"
+DAY_END = "\n\n"
+PART_HEADER = "**Part {}**\n\n"
+
+
+def fragments(title, perma, url, submitter):
+    # A post's table row around its score cell, rendered once at ingest so a score change re-renders nothing.
+    # The row is head + score + tail
+    head = '[{title}]({url}) | [link]({perma}) | '.format(
+        title=title.replace("|", ":"),  # backslash doesn't escape the | on reddit
+        url=url, perma=perma)
+    return head, ' | /u/{submitter}\n'.format(submitter=submitter)
+
+
+def postRow(row, name):
+    # (ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER) as ingest has escaped it, plus DAY, HEAD, TAIL and the name
+    # of the roundup it goes in
+    id_, title, perma, url, created, score, submitter = row
+    return tuple(row) + (day(created),) + fragments(title, perma, url, submitter) + (name,)
+
+
+def day(t):
+    # UTC day number, posts are grouped by it
+    return int(t // DAY)
+
+
+def dayLabel(day):
+    return datetime.datetime.utcfromtimestamp(day * DAY).strftime("%A, %B %-d, %Y")
+
+
+def dayText(label, rows):
+    return "**" + label + "**" + TABLE_HEADER + "".join(rows) + DAY_END
+
+
+def size(text):
+    # (characters, UTF-8 bytes) as reddit counts them, which is after escaping & < > to &amp; &lt; &gt;
+    escaped = 4 * text.count('&') + 3 * (text.count('<') + text.count('>'))
+    return len(text) + escaped, len(text.encode('utf-8')) + escaped
+
+
+def split(days, maxChars, maxBytes=None, reserve='', firstReserve=''):
+    # Lazily yields parts from an iterable of (label, rows), each at most maxChars characters and maxBytes UTF-8
+    # bytes once `reserve` (part header, footer) is added, plus `firstReserve` (intro) on the first part. Days are
+    # split between rows when they don't fit, repeating the day's label and table header in the next part
+    maxBytes = maxChars if maxBytes is None else maxBytes
+    reserveChars, reserveBytes = size(reserve)
+    firstChars, firstBytes = size(firstReserve)
+    endChars, endBytes = size(DAY_END)
+    current = []
+    usedChars, usedBytes = reserveChars + firstChars, reserveBytes + firstBytes
+    rowsInPart = 0
+    for label, rows in days:
+        header = "**" + label + "**" + TABLE_HEADER
+        headerChars, headerBytes = size(header)
+        inDay = False
+        for row in rows:
+            rowChars, rowBytes = size(row)
+            # DAY_END is always budgeted for, so closing the day can never overflow the part
+            needChars = rowChars + endChars + (0 if inDay else headerChars)
+            needBytes = rowBytes + endBytes + (0 if inDay else headerBytes)
+            if rowsInPart and (usedChars + needChars > maxChars or usedBytes + needBytes > maxBytes):
+                if inDay:
+                    current.append(DAY_END)
+                yield "".join(current)
+                current = []
+                usedChars, usedBytes = reserveChars, reserveBytes
+                rowsInPart = 0
+                inDay = False
+            if not inDay:
+                current.append(header)
+                usedChars += headerChars
+                usedBytes += headerBytes
+                inDay = True
+            current.append(row)
+            usedChars += rowChars
+            usedBytes += rowBytes
+            rowsInPart += 1
+        if inDay:
+            current.append(DAY_END)
+            usedChars += endChars
+            usedBytes += endBytes
+    yield "".join(current)
+
+
+class RoundupCache(object):
+    # Rendered roundups keyed by their name and (hour aligned) time window. The version is a fingerprint of the
+    # roundup's posts inside the exact window, so any insert, delete or score change there invalidates the entry
+    def __init__(self, store, granularity=60 * 60, keep=24 * 60 * 60):
+        # store is a storage.Repository. Windows ending more than `keep` seconds before the newest one stored are
+        # dropped, from memory and the store, a daemon would otherwise add one every hour forever
+        self.store = store
+        self.granularity = granularity
+        self.keep = keep
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name, timeStart, timeEnd):
+        return name, int(timeStart) // self.granularity, int(timeEnd) // self.granularity
+
+    def version(self, name, timeStart, timeEnd):
+        return self.store.postsVersion(timeStart, timeEnd, name)
+
+    def get(self, name, timeStart, timeEnd, version):
+        key = self.key(name, timeStart, timeEnd)
+        entry = self.memory.get(key)
+        if entry is None or entry['version'] != version:
+            row = self.store.roundup(key)
+            entry = None
+            if row is not None and row[0] == version:
+                entry = {'version': row[0], 'days': row[1], 'parts': row[2]}
+                self.memory[key] = entry
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            log.debug("Roundup cache hit for window {}".format(key))
+        return entry
+
+    def put(self, name, timeStart, timeEnd, version, days, parts):
+        key = self.key(name, timeStart, timeEnd)
+        entry = {'version': version, 'days': days, 'parts': parts}
+        self.memory[key] = entry
+        self.store.putRoundup(key, version, days, parts)
+        self.prune(key[1] - self.keep // self.granularity)
+        return entry
+
+    def prune(self, before):
+        # Windows ending before `before`, in granularity units
+        for key in [f for f in self.memory if f[1] < before]:
+            del self.memory[key]
+        self.store.pruneRoundups(before)
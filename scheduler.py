@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import datetime
+import random
+import signal
+import threading
+import time
+import logger
+
+log = logger.get_logger(__name__)
+
+DAY = 24 * 60 * 60
+
+
+class Job(object):
+    def __init__(self, name, fn, nextRun, jitter=0):
+        self.name = name
+        self.fn = fn
+        self.nextRun = nextRun  # Called with the current time, returns the next time the job is due
+        self.jitter = jitter
+        self.due = self.schedule(time.time())
+        self.runs = 0
+
+    def schedule(self, now):
+        return self.nextRun(now) + random.uniform(0, self.jitter)
+
+
+def interval(seconds):
+    return lambda now: now + seconds
+
+
+def daily(hour, minute=0):
+    def nextRun(now):
+        today = datetime.datetime.utcfromtimestamp(now).replace(hour=hour, minute=minute, second=0, microsecond=0)
+        t = (today - datetime.datetime(1970, 1, 1)).total_seconds()
+        return t if t > now else t + DAY
+    return nextRun
+
+
+def weekly(weekday, hour, minute=0):
+    # weekday as in datetime.weekday(), 0 is Monday
+    def nextRun(now):
+        t = daily(hour, minute)(now)
+        while datetime.datetime.utcfromtimestamp(t).weekday() != weekday:
+            t += DAY
+        return t
+    return nextRun
+
+
+class Scheduler(object):
+    # Runs jobs one at a time on the calling thread. A job that overruns its next due time is not queued up
+    # behind itself, missed runs are coalesced into one
+    def __init__(self):
+        self.jobs = []
+        self.stopping = threading.Event()
+
+    def add(self, name, fn, nextRun, jitter=0):
+        job = Job(name, fn, nextRun, jitter)
+        self.jobs.append(job)
+        log.info("Scheduled {} for {}".format(name, datetime.datetime.utcfromtimestamp(job.due).strftime("%Y-%m-%d %H:%M:%S")))
+        return job
+
+    def stop(self, *args):
+        log.info("Stopping scheduler after the current job")
+        self.stopping.set()
+
+    def runJob(self, job):
+        # Jobs run one after another, so a job can't still be running when it comes due again
+        t = time.time()
+        try:
+            job.fn()
+        except Exception:
+            log.exception("Scheduled job {} failed".format(job.name))
+        finally:
+            job.runs += 1
+            job.due = job.schedule(time.time())
+        log.debug("{} finished in {}s, next run at {}".format(
+            job.name, round(time.time() - t, 2),
+            datetime.datetime.utcfromtimestamp(job.due).strftime("%Y-%m-%d %H:%M:%S")))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log.info("Scheduler running {} jobs".format(len(self.jobs)))
+        while not self.stopping.is_set():
+            job = min(self.jobs, key=lambda f: f.due)
+            wait = job.due - time.time()
+            if wait > 0:
+                self.stopping.wait(wait)
+                continue
+            self.runJob(job)
+        log.info("Scheduler stopped")
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import logger
+
+log = logger.get_logger(__name__)
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",  # Readers (stats, playlist) don't block the cron writers
+    "PRAGMA synchronous=NORMAL",  # Safe with WAL, avoids an fsync per commit
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",  # 8MB page cache
+    "PRAGMA busy_timeout=5000",
+]
+
+
+def _baseline(c):
+    # The tables as HHHBot has always created them, so old databases start at version 1
+    c.execute("CREATE TABLE IF NOT EXISTS subscriptions(USER TEXT, SUBSCRIPTION TEXT)")
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS posts (ID TEXT, TITLE TEXT, PERMA TEXT, URL TEXT, TIME INT, SCORE INT, SUBMITTER TEXT)")
+    c.execute("CREATE TABLE IF NOT EXISTS cursors (NAME TEXT PRIMARY KEY, FULLNAME TEXT, TIME INT)")
+
+
+def _keys_and_indexes(c):
+    # Rebuild posts/subscriptions with primary keys, dropping any duplicates the old schema allowed
+    c.execute("CREATE TABLE posts_new (ID TEXT PRIMARY KEY, TITLE TEXT, PERMA TEXT, URL TEXT, TIME INT NOT NULL, "
+              "SCORE INT NOT NULL, SUBMITTER TEXT)")
+    c.execute("INSERT OR REPLACE INTO posts_new SELECT * FROM posts ORDER BY rowid")
+    c.execute("DROP TABLE posts")
+    c.execute("ALTER TABLE posts_new RENAME TO posts")
+
+    c.execute("CREATE TABLE subscriptions_new (USER TEXT PRIMARY KEY, SUBSCRIPTION TEXT NOT NULL)")
+    c.execute("INSERT OR REPLACE INTO subscriptions_new SELECT * FROM subscriptions ORDER BY rowid")
+    c.execute("DROP TABLE subscriptions")
+    c.execute("ALTER TABLE subscriptions_new RENAME TO subscriptions")
+
+    c.execute("CREATE INDEX posts_time_score ON posts (TIME, SCORE)")
+    c.execute("CREATE INDEX subscriptions_type ON subscriptions (SUBSCRIPTION, USER)")
+
+
+def _outbox(c):
+    # Rendered message parts are stored once per edition, the outbox holds one row per (user, edition, part)
+    c.execute("CREATE TABLE outbox_parts (EDITION TEXT, PART INT, SUBJECT TEXT, BODY TEXT, PRIMARY KEY (EDITION, PART))")
+    c.execute("CREATE TABLE outbox (USER TEXT, EDITION TEXT, PART INT, STATUS TEXT NOT NULL DEFAULT 'pending', "
+              "ATTEMPTS INT NOT NULL DEFAULT 0, UPDATED INT, ERROR TEXT, PRIMARY KEY (USER, EDITION, PART))")
+    c.execute("CREATE INDEX outbox_status ON outbox (EDITION, STATUS)")
+
+
+def _roundups(c):
+    c.execute("CREATE TABLE roundups (WINDOW_START INT, WINDOW_END INT, VERSION TEXT, DAYS TEXT, PARTS TEXT, "
+              "PRIMARY KEY (WINDOW_START, WINDOW_END))")
+
+
+def _spotify_tracks(c):
+    # Normalised "artist - title" to spotify track URI, a NULL URI is a cached miss
+    c.execute("CREATE TABLE spotify_tracks (QUERY TEXT PRIMARY KEY, URI TEXT, CHECKED INT NOT NULL)")
+
+
+def _settings(c):
+    c.execute("CREATE TABLE settings (KEY TEXT PRIMARY KEY, VALUE TEXT)")
+
+
+def _runs(c):
+    c.execute("CREATE TABLE runs (ID INTEGER PRIMARY KEY, COMMAND TEXT, STARTED REAL, SECONDS REAL)")
+    c.execute("CREATE INDEX runs_started ON runs (STARTED)")
+    # KIND is 'span' (VALUE in seconds) or 'counter'
+    c.execute("CREATE TABLE run_metrics (RUN INT, KIND TEXT, NAME TEXT, VALUE REAL)")
+    c.execute("CREATE INDEX run_metrics_run ON run_metrics (RUN)")
+
+
+def _refresh_schedule(c):
+    # When each post is next due a score refresh, posts without a row have never been refreshed
+    c.execute("CREATE TABLE refresh (ID TEXT PRIMARY KEY, CHECKED INT, SCORE INT, INTERVAL INT, DUE INT)")
+    c.execute("CREATE INDEX refresh_due ON refresh (DUE)")
+    c.execute("CREATE TABLE score_history (ID TEXT, TIME INT, SCORE INT, PRIMARY KEY (ID, TIME)) WITHOUT ROWID")
+
+
+def _pending(c):
+    # [FRESH] posts seen below the score threshold, same columns as posts plus the last score check
+    c.execute("CREATE TABLE pending (ID TEXT PRIMARY KEY, TITLE TEXT, PERMA TEXT, URL TEXT, TIME INT NOT NULL, "
+              "SCORE INT, SUBMITTER TEXT, CHECKED INT)")
+    c.execute("CREATE INDEX pending_time ON pending (TIME)")
+
+
+def _delivery_shards(c):
+    # Outbox rows are sharded by a hash of the username, delivery workers claim (edition, shard) leases
+    c.execute("ALTER TABLE outbox ADD COLUMN SHARD INT NOT NULL DEFAULT 0")
+    c.execute("CREATE INDEX outbox_shard ON outbox (EDITION, SHARD, STATUS)")
+    c.execute("CREATE TABLE outbox_leases (EDITION TEXT, SHARD INT, WORKER TEXT, EXPIRES INT, PRIMARY KEY (EDITION, SHARD))")
+
+
+def _post_fragments(c):
+    # UTC day number and the roundup row around the score cell (roundup.fragments), written at ingest. Existing
+    # posts are filled in the same way, None renders as 'None' like str.format does
+    c.execute("ALTER TABLE posts ADD COLUMN DAY INT")
+    c.execute("ALTER TABLE posts ADD COLUMN HEAD TEXT")
+    c.execute("ALTER TABLE posts ADD COLUMN TAIL TEXT")
+    c.execute("UPDATE posts SET DAY = CAST(TIME / 86400 AS INT), "
+              "HEAD = '[' || REPLACE(TITLE, '|', ':') || '](' || COALESCE(URL, 'None') || ') | [link](' || "
+              "COALESCE(PERMA, 'None') || ') | ', TAIL = ' | /u/' || COALESCE(SUBMITTER, 'None') || char(10)")
+
+
+def _subscription_format(c):
+    # 'link' subscribers get a short PM pointing at the roundup published once, 'full' ones the whole text
+    c.execute("ALTER TABLE subscriptions ADD COLUMN FORMAT TEXT NOT NULL DEFAULT 'link'")
+
+
+def _feeds(c):
+    # Posts remember the roundup they are rolled up in and pending posts the feed that took them (ingest.py),
+    # everything so far came from the one /r/hiphopheads [FRESH] feed. Cached roundups are keyed by roundup too,
+    # the old cache is just dropped
+    c.execute("ALTER TABLE posts ADD COLUMN ROUNDUP TEXT NOT NULL DEFAULT 'fresh'")
+    c.execute("CREATE INDEX posts_roundup_time ON posts (ROUNDUP, TIME, SCORE)")
+    c.execute("ALTER TABLE pending ADD COLUMN FEED TEXT NOT NULL DEFAULT 'fresh'")
+    c.execute("DROP TABLE roundups")
+    c.execute("CREATE TABLE roundup_cache (ROUNDUP TEXT, WINDOW_START INT, WINDOW_END INT, VERSION TEXT, DAYS TEXT, "
+              "PARTS TEXT, PRIMARY KEY (ROUNDUP, WINDOW_START, WINDOW_END))")
+
+
+def _publications(c):
+    # Roundups posted as a self post plus a chain of replies, each part's text saved before anything is posted
+    # and its fullname once it is, so a failed run resumes after the last part that went up
+    c.execute("CREATE TABLE publications (SUBREDDIT TEXT, EDITION TEXT, PART INT, TITLE TEXT, BODY TEXT, THING TEXT, "
+              "PRIMARY KEY (SUBREDDIT, EDITION, PART))")
+
+
+def _rate_limits(c):
+    # Token buckets shared by every delivery process sending as the same account
+    c.execute("CREATE TABLE rate_limits (NAME TEXT PRIMARY KEY, TOKENS REAL, RATE REAL, UPDATED REAL, RESET REAL)")
+
+
+def _posts_changed(c):
+    # Every insert or update of a post stamps it with the next value of posts_counter, so a window's post count and
+    # newest stamp (storage.Repository.postsVersion) change with any edit. Sums of scores could cancel out
+    bump = ("BEGIN UPDATE posts_counter SET N = N + 1; "
+            "UPDATE posts SET CHANGED = (SELECT N FROM posts_counter) WHERE ID = NEW.ID; END")
+    c.execute("ALTER TABLE posts ADD COLUMN CHANGED INT NOT NULL DEFAULT 0")
+    c.execute("CREATE INDEX posts_roundup_changed ON posts (ROUNDUP, TIME, CHANGED)")
+    c.execute("CREATE TABLE posts_counter (N INT NOT NULL)")
+    c.execute("INSERT INTO posts_counter VALUES (0)")
+    c.execute("CREATE TRIGGER posts_inserted AFTER INSERT ON posts " + bump)
+    c.execute("CREATE TRIGGER posts_updated AFTER UPDATE OF ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER, DAY, HEAD, "
+              "TAIL, ROUNDUP ON posts " + bump)
+
+
+# Ordered migration steps, MIGRATIONS[i] moves the database from user_version i to i+1. Only ever append
+MIGRATIONS = [
+    _baseline,
+    _keys_and_indexes,
+    _outbox,
+    _roundups,
+    _spotify_tracks,
+    _settings,
+    _runs,
+    _refresh_schedule,
+    _pending,
+    _delivery_shards,
+    _post_fragments,
+    _subscription_format,
+    _feeds,
+    _publications,
+    _rate_limits,
+    _posts_changed,
+]
+
+
+def version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db, migrations=MIGRATIONS):
+    current = version(db)
+    for i in range(current, len(migrations)):
+        log.info("Migrating database from version {} to {}".format(i, i + 1))
+        c = db.cursor()
+        try:
+            c.execute("BEGIN")
+            migrations[i](c)
+            c.execute("PRAGMA user_version={}".format(i + 1))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            log.exception("Migration to version {} failed".format(i + 1))
+            raise
+        finally:
+            c.close()
+    return version(db)
+
+
+def connect(path, migrations=MIGRATIONS, **kwargs):
+    # isolation_level=None for the duration of the migrations so they control their own transactions. Other
+    # database files (archive.py, httpcache.py) pass their own migration list, kwargs go to sqlite3.connect
+    db = sqlite3.connect(path, isolation_level=None, **kwargs)
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+    migrate(db, migrations)
+    db.isolation_level = ""
+    return db
@@ -1,39 +1,186 @@
 # -*- coding: utf-8 -*-
+# Reports over fresh.db, run with `python stats.py [report...] [--days N] [--archive] [--csv|--json]`. Everything
+# is aggregated in SQL or over fixed size numpy chunks, so memory doesn't grow with the posts history. Reports run
+# on a read-only connection, so they never hold up the bot's writes. --archive adds the posts moved to archive.db.
+# Only the SQLite store is read, a bot with HHHBot.storeDSN set keeps its posts in PostgreSQL
+import calendar
+import csv
 import datetime
-import time
-import praw
-import sqlite3
-import logging
+import json
 import os
-import vals
+import re
 import sys
-import unidecode
+import time
 import numpy as np
+import vals
+import storage
 from tabulate import tabulate
 
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+CHUNK = 50000  # Rows per fetchmany when streaming
+SCORE_BUCKETS = [0, 50, 100, 250, 500, 1000, 2500, 5000, np.inf]
+VELOCITY_BINS = np.logspace(-3, 4, 7 * 40 + 1)  # Points per hour, 40 bins per decade, ~6% wide
+PERCENTILES = [25, 50, 75, 90, 95, 99]
 
-db = sqlite3.connect(os.path.join(vals.cwd, "fresh.db"))
-c = db.cursor()
 
-# Get user data
-c.execute("SELECT * FROM subscriptions")
+def date(t):
+    return datetime.datetime.utcfromtimestamp(t).strftime("%Y-%m-%d")
 
-users=0
-both=0
-daily=0
-weekly=0
 
-for f in c.fetchall():
-    users+=1
-    f = f[1]
-    if f=="both":
-        both+=1
-    elif f=="daily":
-        daily+=1
-    else:
-        weekly+=1
+def rank(counts, p):
+    # Index of the nearest rank percentile in a histogram of counts
+    cumulative = np.cumsum(counts)
+    return int(np.searchsorted(cumulative, max(int(np.ceil(p / 100.0 * cumulative[-1])), 1)))
+
+
+def subscriptions(db, since):
+    counts = dict(db.execute("SELECT SUBSCRIPTION, COUNT(*) FROM subscriptions GROUP BY SUBSCRIPTION").fetchall())
+    return [["Users", sum(counts.values())], ["Both", counts.get("both", 0)], ["Daily", counts.get("daily", 0)],
+            ["Weekly", counts.get("weekly", 0)]]
+
+
+def scoreCounts(db, since):
+    # Distinct scores are few next to the posts, so (score, count) is a compact exact histogram
+    rows = db.execute("SELECT SCORE, COUNT(*) FROM posts WHERE TIME > ? GROUP BY SCORE ORDER BY SCORE",
+                      (since,)).fetchall()
+    if not rows:
+        return np.zeros(0), np.zeros(0)
+    values, counts = np.array(rows, dtype=np.float64).T
+    return values, counts
+
+
+def scores(db, since):
+    values, counts = scoreCounts(db, since)
+    if not len(values):
+        return []
+    table = [["Posts", int(counts.sum())], ["Mean", round(float(np.dot(values, counts) / counts.sum()), 1)],
+             ["Min", int(values[0])]]
+    table += [["p{}".format(p), int(values[rank(counts, p)])] for p in PERCENTILES]
+    return table + [["Max", int(values[-1])]]
+
+
+def scoreBuckets(db, since):
+    values, counts = scoreCounts(db, since)
+    hist = np.histogram(values, bins=SCORE_BUCKETS, weights=counts)[0] if len(values) else []
+    total = float(sum(hist)) or 1
+    return [["{}-{}".format(lo, hi - 1) if hi != np.inf else "{}+".format(lo), int(n), round(100 * n / total, 1)]
+            for lo, hi, n in zip(SCORE_BUCKETS, SCORE_BUCKETS[1:], hist)]
+
 
-print(tabulate([["Users", users],["Both", both],["Daily", daily],["Weekly",weekly]],headers=["Type", "Number"], tablefmt='orgtbl'))
+def daily(db, since):
+    return [[date(day * DAY), n, round(avg, 1), best] for day, n, avg, best in db.execute(
+        "SELECT CAST(TIME / ? AS INT) AS DAY, COUNT(*), AVG(SCORE), MAX(SCORE) FROM posts WHERE TIME > ? "
+        "GROUP BY DAY ORDER BY DAY", (DAY, since))]
 
 
+def submitters(db, since, top=20):
+    return [[user, n, total, round(total / float(n), 1), best] for user, n, total, best in db.execute(
+        "SELECT SUBMITTER, COUNT(*) AS N, SUM(SCORE) AS TOTAL, MAX(SCORE) FROM posts WHERE TIME > ? "
+        "GROUP BY SUBMITTER ORDER BY N DESC, TOTAL DESC LIMIT ?", (since, top))]
 
+
+def velocity(db, since, now=None):
+    # Points per hour since posting as of the last score refresh. The rate is computed by SQLite and streamed in
+    # CHUNK sized numpy arrays into a fixed log histogram, percentiles are the upper edge of their bin
+    now = time.time() if now is None else now
+    counts = np.zeros(len(VELOCITY_BINS) - 1)
+    lo, hi = np.log10(VELOCITY_BINS[0]), np.log10(VELOCITY_BINS[-1])
+    c = db.execute("SELECT SCORE / MAX((? - TIME) / 3600.0, 1 / 60.0) FROM posts WHERE TIME > ?", (now, since))
+    while True:
+        rows = c.fetchmany(CHUNK)
+        if not rows:
+            break
+        rate = np.fromiter((f[0] for f in rows), dtype=np.float64, count=len(rows))
+        rate = np.log10(np.clip(rate, VELOCITY_BINS[0], VELOCITY_BINS[-1]))
+        counts += np.histogram(rate, bins=len(counts), range=(lo, hi))[0]
+    if not counts.sum():
+        return []
+    return [["p{}".format(p), round(float(VELOCITY_BINS[rank(counts, p) + 1]), 2)] for p in PERCENTILES]
+
+
+def spotify(db, since):
+    # Each weekly edition's playlist as HHHBot.weeklyPlaylist saved it: (url, songs found, songs, match %) under
+    # playlist:<edition>, editions ending with the date their week began
+    rows = []
+    for key, value in db.execute("SELECT KEY, VALUE FROM settings WHERE KEY LIKE 'playlist:%'"):
+        edition = key[len("playlist:"):]
+        week = re.search(r"(\d{4}-\d{2}-\d{2})$", edition)
+        if week is None:
+            continue
+        start = calendar.timegm(time.strptime(week.group(1), "%Y-%m-%d"))
+        if start + WEEK > since:
+            url, found, total, perc = json.loads(value)
+            rows.append([week.group(1), edition, total, found, perc, url])
+    return [f[1:] for f in sorted(rows)]
+
+
+REPORTS = {
+    "subscriptions": (subscriptions, ["Type", "Number"]),
+    "scores": (scores, ["Statistic", "Score"]),
+    "buckets": (scoreBuckets, ["Score", "Posts", "%"]),
+    "daily": (daily, ["Day", "Posts", "Avg score", "Best"]),
+    "submitters": (submitters, ["Submitter", "Posts", "Total score", "Avg score", "Best"]),
+    "velocity": (velocity, ["Percentile", "Points/hour"]),
+    "spotify": (spotify, ["Edition", "Songs", "Found", "Match %", "Playlist"]),
+}
+
+
+def attach(db, path):
+    # Shadows posts with a temp view over the hot table and the archive's posts view, so every report reads both.
+    # A post in both (a move interrupted between its two commits) counts once. False if nothing is archived yet
+    if not os.path.exists(path):
+        return False
+    # query_only refuses ATTACH and the temp schema too, the files themselves stay opened read-only
+    db.execute("PRAGMA query_only=0")
+    try:
+        db.execute("ATTACH ? AS archive", ("file:{}?mode=ro".format(os.path.abspath(path)),))
+        if db.execute("SELECT 1 FROM archive.sqlite_master WHERE type='view' AND name='posts'").fetchone() is None:
+            return False
+        db.execute("CREATE TEMP VIEW posts AS SELECT ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER FROM main.posts "
+                   "UNION ALL SELECT ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER FROM archive.posts a "
+                   "WHERE NOT EXISTS (SELECT 1 FROM main.posts h WHERE h.ID = a.ID)")
+        return True
+    finally:
+        db.execute("PRAGMA query_only=1")
+
+
+def run(db, names, since):
+    return [(name, REPORTS[name][1], REPORTS[name][0](db, since)) for name in names]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    days = None
+    if "--days" in args:
+        days = float(args[args.index("--days") + 1])
+        del args[args.index("--days"):args.index("--days") + 2]
+    fmt = "csv" if "--csv" in args else "json" if "--json" in args else "table"
+    withArchive = "--archive" in args
+    names = [f for f in args if not f.startswith("--")] or list(REPORTS)
+    unknown = [f for f in names if f not in REPORTS]
+    if unknown:
+        print("Unknown report {}, choose from {}".format(", ".join(unknown), "|".join(REPORTS)))
+        sys.exit(1)
+
+    pool = storage.SQLitePool(os.path.join(vals.cwd, "fresh.db"), size=1)
+    with pool.reader() as db:
+        if withArchive and not attach(db, os.path.join(vals.cwd, "archive.db")):
+            sys.stderr.write("Nothing archived yet, reporting on the hot posts only\n")
+        reports = run(db, names, 0 if days is None else time.time() - days * DAY)
+    pool.close()
+
+    if fmt == "csv":
+        # One block per report, the first column says which
+        writer = csv.writer(sys.stdout)
+        for name, headers, rows in reports:
+            writer.writerow(["report"] + headers)
+            writer.writerows([name] + row for row in rows)
+    elif fmt == "json":
+        json.dump(dict((name, [dict(zip(headers, row)) for row in rows]) for name, headers, rows in reports),
+                  sys.stdout, indent=2)
+        print("")
+    else:
+        for name, headers, rows in reports:
+            print("\n" + name.capitalize())
+            print(tabulate(rows, headers=headers, tablefmt='orgtbl'))
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+# Repository over the shared tables (posts and their refresh schedule, subscriptions, outbox, rate limits, caches)
+# with pooled connections, so every thread works on its own connection and read-only paths never hold a write
+# transaction.
+# SQLite (WAL) is the default, PostgreSQL is there for running several bots against one database (HHHBot.storeDSN).
+# tests/test_storage.py holds the contract and runs it against both
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import logger
+import schema
+
+log = logger.get_logger(__name__)
+
+CHUNK = 500  # Max parameters in one IN (...) list
+
+
+class SQLitePool(object):
+    # Up to `size` read-write connections plus up to `size` read-only ones. The first connection runs the
+    # migrations, the rest only apply the pragmas. `shared` hands everyone the same connection, as before the pool
+    def __init__(self, path, size=4, shared=False):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.writers = queue.Queue()
+        self.readers = queue.Queue()
+        self.opened = {'writers': 0, 'readers': 0}
+        self.shared = None
+        first = schema.connect(path)
+        first.close()
+        if shared or path == ":memory:":
+            # Every :memory: connection is its own database, so everyone has to share one
+            self.shared = self.open(False)
+
+    def open(self, readonly):
+        if self.path == ":memory:":
+            db = sqlite3.connect(":memory:", check_same_thread=False)
+            for pragma in schema.PRAGMAS:
+                db.execute(pragma)
+            schema.migrate(db)
+            db.isolation_level = ""
+            return db
+        if readonly:
+            db = sqlite3.connect("file:{}?mode=ro".format(os.path.abspath(self.path)), uri=True, check_same_thread=False)
+        else:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in schema.PRAGMAS:
+            if not (readonly and "journal_mode" in pragma):
+                db.execute(pragma)
+        if readonly:
+            db.execute("PRAGMA query_only=1")
+        return db
+
+    def acquire(self, readonly):
+        idle = self.readers if readonly else self.writers
+        kind = 'readers' if readonly else 'writers'
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            grow = self.opened[kind] < self.size
+            if grow:
+                self.opened[kind] += 1
+        return self.open(readonly) if grow else idle.get()
+
+    @contextmanager
+    def connection(self, readonly=False):
+        # Commits when the block finishes, rolls back if it raises
+        if self.shared is not None:
+            with self.lock:
+                try:
+                    yield self.shared
+                    self.shared.commit()
+                except Exception:
+                    self.shared.rollback()
+                    raise
+            return
+        db = self.acquire(readonly)
+        try:
+            yield db
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            (self.readers if readonly else self.writers).put(db)
+
+    def reader(self):
+        return self.connection(readonly=True)
+
+    def close(self):
+        for idle in (self.writers, self.readers):
+            while not idle.empty():
+                idle.get_nowait().close()
+        if self.shared is not None:
+            self.shared.close()
+
+
+class Repository(object):
+    # The contract. SQL is written once in the syntax SQLite (3.24+) and PostgreSQL share, with ? placeholders
+    # that backends translate and USER quoted since PostgreSQL reserves it. Subclasses provide the pool
+    PLACEHOLDER = "?"
+
+    def sql(self, query):
+        return query if self.PLACEHOLDER == "?" else query.replace("?", self.PLACEHOLDER)
+
+    def fetch(self, db, query, params=()):
+        c = db.cursor()
+        c.execute(self.sql(query), params)
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    def execute(self, db, query, params=()):
+        # Rows changed
+        c = db.cursor()
+        c.execute(self.sql(query), params)
+        changed = c.rowcount
+        c.close()
+        return changed
+
+    def many(self, db, query, rows):
+        if rows:
+            c = db.cursor()
+            c.executemany(self.sql(query), rows)
+            c.close()
+
+    def chunked(self, db, query, values):
+        # query has one {} for the IN list
+        rows = []
+        values = list(values)
+        for i in range(0, len(values), CHUNK):
+            chunk = values[i:i + CHUNK]
+            rows += self.fetch(db, query.format(",".join("?" * len(chunk))), chunk)
+        return rows
+
+    def close(self):
+        self.pool.close()
+
+    # Posts
+
+    def knownPosts(self, ids):
+        with self.pool.reader() as db:
+            return set(f[0] for f in self.chunked(db, "SELECT ID FROM posts WHERE ID IN ({})", ids))
+
+    def addPosts(self, rows):
+        # (ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER, DAY, HEAD, TAIL, ROUNDUP), existing IDs are left alone
+        with self.pool.connection() as db:
+            self.many(db, "INSERT INTO posts (ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER, DAY, HEAD, TAIL, ROUNDUP) "
+                          "VALUES (?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT (ID) DO NOTHING", rows)
+
+    def postsInWindow(self, timeStart, timeEnd):
+        # Between timeEnd and timeStart, best first
+        with self.pool.reader() as db:
+            return self.fetch(db, "SELECT ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER FROM posts "
+                                  "WHERE TIME<? AND TIME>? ORDER BY SCORE DESC", (timeStart, timeEnd))
+
+    def roundupRows(self, timeStart, timeEnd, roundup):
+        # (day, rendered row) of one roundup between timeEnd and timeStart, best first
+        with self.pool.reader() as db:
+            return self.fetch(db, "SELECT DAY, HEAD || SCORE || TAIL FROM posts WHERE ROUNDUP=? AND TIME<? AND TIME>? "
+                                  "ORDER BY SCORE DESC", (roundup, timeStart, timeEnd))
+
+    def postsVersion(self, timeStart, timeEnd, roundup):
+        # Changes whenever a post of the roundup in the window is added, removed or rescored: inserts and updates
+        # stamp a post with the next value of a counter (CHANGED), deletes lower the count. Answered from the
+        # (ROUNDUP, TIME, CHANGED) index alone
+        with self.pool.reader() as db:
+            row = self.fetch(db, "SELECT COUNT(*), COALESCE(MAX(CHANGED), 0) FROM posts WHERE ROUNDUP=? AND TIME<? "
+                                 "AND TIME>?", (roundup, timeStart, timeEnd))[0]
+        return "{}:{}".format(*row)
+
+    def updateScores(self, updates):
+        # (score, ID)
+        with self.pool.connection() as db:
+            self.many(db, "UPDATE posts SET SCORE=? WHERE ID=?", updates)
+
+    def postCount(self, before=None):
+        with self.pool.reader() as db:
+            if before is None:
+                return self.fetch(db, "SELECT COUNT(*) FROM posts")[0][0]
+            return self.fetch(db, "SELECT COUNT(*) FROM posts WHERE TIME<?", (before,))[0][0]
+
+    def playlistTitles(self, roundup, since, below):
+        # Titles of the roundup's posts newer than since or scoring below `below`
+        with self.pool.reader() as db:
+            return [f[0] for f in self.fetch(db, "SELECT TITLE FROM posts WHERE ROUNDUP=? AND (TIME>? OR SCORE<?)",
+                                             (roundup, since, below))]
+
+    def oldPosts(self, before, limit):
+        # The oldest posts created before `before`, for the archive
+        with self.pool.reader() as db:
+            return self.fetch(db, "SELECT ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER FROM posts WHERE TIME < ? "
+                                  "ORDER BY TIME LIMIT ?", (before, limit))
+
+    def deletePosts(self, ids):
+        # Posts and their refresh schedule and score history, in one transaction
+        rows = [(f,) for f in ids]
+        with self.pool.connection() as db:
+            self.many(db, "DELETE FROM posts WHERE ID = ?", rows)
+            self.many(db, "DELETE FROM refresh WHERE ID = ?", rows)
+            self.many(db, "DELETE FROM score_history WHERE ID = ?", rows)
+
+    # Score refresh schedule
+
+    def duePosts(self, now, limit):
+        # (ID, score, created, last refreshed score, interval) of posts due a refresh, never refreshed ones first
+        # then the most overdue
+        with self.pool.reader() as db:
+            return self.fetch(db, "SELECT p.ID, p.SCORE, p.TIME, r.SCORE, r.INTERVAL FROM posts p LEFT JOIN refresh r "
+                                  "ON r.ID = p.ID WHERE r.DUE IS NULL OR r.DUE <= ? ORDER BY r.DUE IS NOT NULL, r.DUE "
+                                  "LIMIT ?", (now, limit))
+
+    def scheduleRefresh(self, schedule, history):
+        # (ID, checked, score, interval, due) and (ID, time, score)
+        with self.pool.connection() as db:
+            self.many(db, "INSERT INTO refresh VALUES (?,?,?,?,?) ON CONFLICT (ID) DO UPDATE SET "
+                          "CHECKED=excluded.CHECKED, SCORE=excluded.SCORE, INTERVAL=excluded.INTERVAL, DUE=excluded.DUE",
+                      schedule)
+            self.many(db, "INSERT INTO score_history VALUES (?,?,?) ON CONFLICT (ID, TIME) DO UPDATE SET "
+                          "SCORE=excluded.SCORE", history)
+
+    # Subscriptions
+
+    def subscriptions(self, users):
+        with self.pool.reader() as db:
+            return dict(self.chunked(db, 'SELECT "USER", SUBSCRIPTION FROM subscriptions WHERE "USER" IN ({})', users))
+
+    def subscribers(self, lists, format=None):
+        # Everyone on the lists, or only those getting roundups in format ('link' or 'full')
+        sql = 'SELECT "USER" FROM subscriptions WHERE SUBSCRIPTION IN ({})'.format(",".join("?" * len(lists)))
+        params = list(lists)
+        if format is not None:
+            sql += " AND FORMAT = ?"
+            params.append(format)
+        with self.pool.reader() as db:
+            return [f[0] for f in self.fetch(db, sql + ' ORDER BY "USER"', params)]
+
+    def applySubscriptions(self, upserts, deletes):
+        # (user, subscription) to write and users to remove, in one transaction
+        with self.pool.connection() as db:
+            self.many(db, 'INSERT INTO subscriptions ("USER", SUBSCRIPTION) VALUES (?,?) '
+                          'ON CONFLICT ("USER") DO UPDATE SET SUBSCRIPTION=excluded.SUBSCRIPTION', upserts)
+            self.many(db, 'DELETE FROM subscriptions WHERE "USER" = ?', [(f,) for f in deletes])
+
+    def setFormats(self, formats):
+        # (user, format), only subscribed users have a row to update. Unsubscribing forgets the format
+        with self.pool.connection() as db:
+            self.many(db, 'UPDATE subscriptions SET FORMAT=? WHERE "USER"=?', [(f, user) for user, f in formats])
+
+    # Outbox
+
+    def enqueue(self, edition, parts, users, shards=None):
+        # parts is a list of (subject, body), shards maps users to their delivery shard (default 0). Rows that
+        # already exist are kept as they are
+        shards = shards or {}
+        with self.pool.connection() as db:
+            self.many(db, "INSERT INTO outbox_parts VALUES (?,?,?,?) ON CONFLICT (EDITION, PART) DO NOTHING",
+                      [(edition, i, subject, body) for i, (subject, body) in enumerate(parts)])
+            self.many(db, 'INSERT INTO outbox ("USER", EDITION, PART, SHARD) VALUES (?,?,?,?) '
+                          'ON CONFLICT ("USER", EDITION, PART) DO NOTHING',
+                      [(user, edition, i, shards.get(user, 0)) for i in range(len(parts)) for user in users])
+
+    def pendingJobs(self, edition, shard=None):
+        # (user, part, subject, body, attempts), a user's parts in order. All shards when shard is None
+        with self.pool.reader() as db:
+            return self.fetch(db, 'SELECT o."USER", o.PART, p.SUBJECT, p.BODY, o.ATTEMPTS FROM outbox o '
+                                  "JOIN outbox_parts p ON p.EDITION = o.EDITION AND p.PART = o.PART "
+                                  "WHERE o.EDITION = ? AND o.STATUS = 'pending' AND (? IS NULL OR o.SHARD = ?) "
+                                  'ORDER BY o."USER", o.PART', (edition, shard, shard))
+
+    def pendingShards(self, edition):
+        with self.pool.reader() as db:
+            return [f[0] for f in self.fetch(db, "SELECT DISTINCT SHARD FROM outbox WHERE EDITION = ? AND "
+                                                 "STATUS = 'pending' ORDER BY SHARD", (edition,))]
+
+    def pendingEditions(self):
+        with self.pool.reader() as db:
+            return [f[0] for f in self.fetch(db, "SELECT DISTINCT EDITION FROM outbox WHERE STATUS = 'pending' "
+                                                 "ORDER BY EDITION")]
+
+    def editionCounts(self, edition):
+        # status -> rows
+        with self.pool.reader() as db:
+            return dict(self.fetch(db, "SELECT STATUS, COUNT(*) FROM outbox WHERE EDITION = ? GROUP BY STATUS", (edition,)))
+
+    def claimShard(self, edition, shard, worker, expires, now):
+        # True if worker now holds the lease, either it was free, expired or already the worker's. The conditional
+        # upsert is one statement, so two workers can never both get it
+        with self.pool.connection() as db:
+            return self.execute(db, "INSERT INTO outbox_leases VALUES (?,?,?,?) ON CONFLICT (EDITION, SHARD) DO UPDATE "
+                                    "SET WORKER=excluded.WORKER, EXPIRES=excluded.EXPIRES "
+                                    "WHERE outbox_leases.EXPIRES < ? OR outbox_leases.WORKER = excluded.WORKER",
+                                (edition, shard, worker, expires, now)) > 0
+
+    def renewLease(self, edition, shard, worker, expires):
+        # False if the lease expired and another worker took the shard over
+        with self.pool.connection() as db:
+            return self.execute(db, "UPDATE outbox_leases SET EXPIRES=? WHERE EDITION=? AND SHARD=? AND WORKER=?",
+                                (expires, edition, shard, worker)) > 0
+
+    def releaseShard(self, edition, shard, worker):
+        with self.pool.connection() as db:
+            self.execute(db, "DELETE FROM outbox_leases WHERE EDITION=? AND SHARD=? AND WORKER=?", (edition, shard, worker))
+
+    def markJobs(self, edition, results):
+        # (user, part, status, attempts, error)
+        with self.pool.connection() as db:
+            self.many(db, 'UPDATE outbox SET STATUS=?, ATTEMPTS=?, UPDATED=?, ERROR=? WHERE "USER"=? AND EDITION=? AND PART=?',
+                      [(status, attempts, int(time.time()), error, user, edition, part)
+                       for user, part, status, attempts, error in results])
+
+    # Rate limits
+
+    def takeToken(self, name, now, rate, capacity):
+        # One token from the bucket `name`, shared by every process on this store. It refills at its rate since it
+        # was last touched, up to capacity; rate and capacity also create it. 0 if a token was taken, otherwise the
+        # seconds until one is due. The refill takes the row's write lock, so the take after it can't race
+        with self.pool.connection() as db:
+            self.execute(db, "INSERT INTO rate_limits VALUES (?,?,?,?,?) ON CONFLICT (NAME) DO NOTHING",
+                         (name, capacity, rate, now, 0))
+            # A rate cut to 0 is back to the default once the window it was cut for resets
+            self.execute(db, "UPDATE rate_limits SET RATE=? WHERE NAME=? AND RATE<=0 AND RESET<=?", (rate, name, now))
+            # Another machine's clock may be ahead, time never runs backwards for the bucket
+            self.execute(db, "UPDATE rate_limits SET TOKENS=CASE WHEN UPDATED>=? THEN TOKENS "
+                             "WHEN TOKENS + (? - UPDATED) * RATE > ? THEN ? ELSE TOKENS + (? - UPDATED) * RATE END, "
+                             "UPDATED=CASE WHEN UPDATED>=? THEN UPDATED ELSE ? END WHERE NAME=?",
+                         (now, now, capacity, capacity, now, now, now, name))
+            if self.execute(db, "UPDATE rate_limits SET TOKENS=TOKENS - 1 WHERE NAME=? AND TOKENS>=1", (name,)) > 0:
+                return 0
+            tokens, rate, reset = self.fetch(db, "SELECT TOKENS, RATE, RESET FROM rate_limits WHERE NAME=?", (name,))[0]
+        return (1 - tokens) / rate if rate > 0 else max(reset - now, 0.1)
+
+    def setRate(self, name, rate, remaining, reset):
+        # reddit's view of the account: spread `remaining` over the window ending at `reset`
+        with self.pool.connection() as db:
+            self.execute(db, "UPDATE rate_limits SET RATE=?, RESET=?, TOKENS=CASE WHEN TOKENS > ? THEN ? ELSE TOKENS END "
+                             "WHERE NAME=?", (rate, reset, remaining, remaining, name))
+
+    # Publications
+
+    def publication(self, subreddit, edition):
+        # (title, [(part, text, fullname once posted)]) of a roundup posted or being posted, None if never started
+        with self.pool.reader() as db:
+            rows = self.fetch(db, "SELECT TITLE, PART, BODY, THING FROM publications WHERE SUBREDDIT=? AND EDITION=? "
+                                  "ORDER BY PART", (subreddit, edition))
+        if not rows:
+            return None
+        return rows[0][0], [tuple(f[1:]) for f in rows]
+
+    def startPublication(self, subreddit, edition, title, texts):
+        # Every part's text in one transaction, before anything is posted. A started publication is kept as it is
+        with self.pool.connection() as db:
+            self.many(db, "INSERT INTO publications (SUBREDDIT, EDITION, PART, TITLE, BODY) VALUES (?,?,?,?,?) "
+                          "ON CONFLICT (SUBREDDIT, EDITION, PART) DO NOTHING",
+                      [(subreddit, edition, i, title, text) for i, text in enumerate(texts)])
+
+    def markPublished(self, subreddit, edition, part, thing):
+        with self.pool.connection() as db:
+            self.execute(db, "UPDATE publications SET THING=? WHERE SUBREDDIT=? AND EDITION=? AND PART=?",
+                         (thing, subreddit, edition, part))
+
+    # Caches
+
+    def setting(self, key, default=None):
+        with self.pool.reader() as db:
+            rows = self.fetch(db, "SELECT VALUE FROM settings WHERE KEY=?", (key,))
+        return rows[0][0] if rows else default
+
+    def setSetting(self, key, value):
+        with self.pool.connection() as db:
+            self.many(db, "INSERT INTO settings VALUES (?,?) ON CONFLICT (KEY) DO UPDATE SET VALUE=excluded.VALUE",
+                      [(key, value)])
+
+    def roundup(self, key):
+        # (version, days, parts) for a (roundup, window start, window end) key
+        with self.pool.reader() as db:
+            rows = self.fetch(db, "SELECT VERSION, DAYS, PARTS FROM roundup_cache WHERE ROUNDUP=? AND WINDOW_START=? "
+                                  "AND WINDOW_END=?", key)
+        if not rows:
+            return None
+        return rows[0][0], [tuple(f) for f in json.loads(rows[0][1])], json.loads(rows[0][2])
+
+    def putRoundup(self, key, version, days, parts):
+        with self.pool.connection() as db:
+            self.many(db, "INSERT INTO roundup_cache VALUES (?,?,?,?,?,?) "
+                          "ON CONFLICT (ROUNDUP, WINDOW_START, WINDOW_END) DO UPDATE SET VERSION=excluded.VERSION, "
+                          "DAYS=excluded.DAYS, PARTS=excluded.PARTS",
+                      [tuple(key) + (version, json.dumps(days), json.dumps(parts))])
+
+    def pruneRoundups(self, before):
+        # Cached roundups for windows starting (at their newer end) before `before`, in the key's units
+        with self.pool.connection() as db:
+            return self.execute(db, "DELETE FROM roundup_cache WHERE WINDOW_START<?", (before,))
+
+
+class SQLiteRepository(Repository):
+    def __init__(self, path, size=4, shared=False):
+        self.pool = SQLitePool(path, size, shared)
+
+
+# The shared tables in PostgreSQL. Only what the repository covers, the bookkeeping of a single bot (cursors,
+# pending posts, runs, the spotify search cache) stays in its fresh.db
+POSTGRES_TABLES = [
+    "CREATE TABLE IF NOT EXISTS posts (ID TEXT PRIMARY KEY, TITLE TEXT, PERMA TEXT, URL TEXT, "
+    "TIME DOUBLE PRECISION NOT NULL, SCORE INT, SUBMITTER TEXT, DAY INT, HEAD TEXT, TAIL TEXT)",
+    "CREATE INDEX IF NOT EXISTS posts_time_score ON posts (TIME, SCORE)",
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS ROUNDUP TEXT NOT NULL DEFAULT 'fresh'",
+    "CREATE INDEX IF NOT EXISTS posts_roundup_time ON posts (ROUNDUP, TIME, SCORE)",
+    # postsVersion's change counter, see schema._posts_changed
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS CHANGED BIGINT NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS posts_roundup_changed ON posts (ROUNDUP, TIME, CHANGED)",
+    "CREATE SEQUENCE IF NOT EXISTS posts_changed",
+    "CREATE OR REPLACE FUNCTION posts_changed() RETURNS trigger AS $$ "
+    "BEGIN NEW.CHANGED := nextval('posts_changed'); RETURN NEW; END $$ LANGUAGE plpgsql",
+    "DO $$ BEGIN IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'posts_changed') THEN "
+    "CREATE TRIGGER posts_changed BEFORE INSERT OR UPDATE ON posts FOR EACH ROW EXECUTE FUNCTION posts_changed(); "
+    "END IF; END $$",
+    'CREATE TABLE IF NOT EXISTS subscriptions ("USER" TEXT PRIMARY KEY, SUBSCRIPTION TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS subscriptions_type ON subscriptions (SUBSCRIPTION, "USER")',
+    "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS FORMAT TEXT NOT NULL DEFAULT 'link'",
+    "CREATE TABLE IF NOT EXISTS outbox_parts (EDITION TEXT, PART INT, SUBJECT TEXT, BODY TEXT, PRIMARY KEY (EDITION, PART))",
+    "CREATE TABLE IF NOT EXISTS outbox (\"USER\" TEXT, EDITION TEXT, PART INT, STATUS TEXT NOT NULL DEFAULT 'pending', "
+    'ATTEMPTS INT NOT NULL DEFAULT 0, UPDATED INT, ERROR TEXT, PRIMARY KEY ("USER", EDITION, PART))',
+    "CREATE INDEX IF NOT EXISTS outbox_status ON outbox (EDITION, STATUS)",
+    "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS SHARD INT NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS outbox_shard ON outbox (EDITION, SHARD, STATUS)",
+    "CREATE TABLE IF NOT EXISTS outbox_leases (EDITION TEXT, SHARD INT, WORKER TEXT, EXPIRES BIGINT, "
+    "PRIMARY KEY (EDITION, SHARD))",
+    "CREATE TABLE IF NOT EXISTS roundup_cache (ROUNDUP TEXT, WINDOW_START BIGINT, WINDOW_END BIGINT, VERSION TEXT, "
+    "DAYS TEXT, PARTS TEXT, PRIMARY KEY (ROUNDUP, WINDOW_START, WINDOW_END))",
+    "CREATE TABLE IF NOT EXISTS settings (KEY TEXT PRIMARY KEY, VALUE TEXT)",
+    "CREATE TABLE IF NOT EXISTS publications (SUBREDDIT TEXT, EDITION TEXT, PART INT, TITLE TEXT, BODY TEXT, THING TEXT, "
+    "PRIMARY KEY (SUBREDDIT, EDITION, PART))",
+    "CREATE TABLE IF NOT EXISTS refresh (ID TEXT PRIMARY KEY, CHECKED BIGINT, SCORE INT, INTERVAL BIGINT, DUE BIGINT)",
+    "CREATE INDEX IF NOT EXISTS refresh_due ON refresh (DUE)",
+    "CREATE TABLE IF NOT EXISTS score_history (ID TEXT, TIME BIGINT, SCORE INT, PRIMARY KEY (ID, TIME))",
+    "CREATE TABLE IF NOT EXISTS rate_limits (NAME TEXT PRIMARY KEY, TOKENS DOUBLE PRECISION, RATE DOUBLE PRECISION, "
+    "UPDATED DOUBLE PRECISION, RESET DOUBLE PRECISION)",
+]
+
+
+class PostgresRepository(Repository):
+    # Needs psycopg2, imported here so SQLite only installs don't have to have it
+    PLACEHOLDER = "%s"
+
+    def __init__(self, dsn, size=4):
+        import psycopg2.pool
+        self.pool = PostgresPool(psycopg2.pool.ThreadedConnectionPool(1, size, dsn), size)
+        with self.pool.connection() as db:
+            c = db.cursor()
+            for statement in POSTGRES_TABLES:
+                c.execute(statement)
+            c.close()
+
+
+class PostgresPool(object):
+    # psycopg2's pool raises once all `size` connections are out, this one waits for a free one like SQLitePool
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.free = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self, readonly=False):
+        self.free.acquire()
+        db = self.pool.getconn()
+        try:
+            db.set_session(readonly=readonly)
+            yield db
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            self.pool.putconn(db)
+            self.free.release()
+
+    def reader(self):
+        return self.connection(readonly=True)
+
+    def close(self):
+        self.pool.closeall()
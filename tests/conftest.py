@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# The modules live at the top of the repo, next to the vals.py holding the bot's credentials
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# weekly_playlist's diff sync against the fake spotify, from random playlists with duplicates and empty slots
+# (tracks spotify no longer has) to random targets. Each seed is one playlist
+import random
+import warnings
+import pytest
+import fake_spotify
+import weekly_playlist
+
+TRACKS = ["spotify:track:{}".format(f) for f in "abcdefgh"]
+
+
+@pytest.fixture(scope="module")
+def spotify():
+    server = fake_spotify.FakeSpotify().start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_sync(spotify, seed):
+    rng = random.Random(seed)
+    current = [rng.choice(TRACKS[:6] + [None]) for _ in range(rng.randint(0, 12))]
+    target = [rng.choice(TRACKS[2:]) for _ in range(rng.randint(0, 8))]
+    sp = spotify.client()
+    playlist = spotify.create_playlist("owner", {'json': {'name': "Test {}".format(seed)}})
+    spotify.playlists[playlist['id']]['uris'] = list(current)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)  # spotipy's user_playlist_* names
+        found = weekly_playlist.playlist_tracks(sp, "owner", playlist['id'])
+        assert found == current  # One entry per slot, the positions line up
+        weekly_playlist.sync_playlist(sp, "owner", playlist, found, target, chunk=3)
+    assert spotify.playlists[playlist['id']]['uris'] == weekly_playlist.unique(target)
+
+
+def test_plan_clears_empty_slots():
+    removals, additions, moves = weekly_playlist.plan_sync(["a", None, "b", None], ["a", "b"])
+    assert removals == [(None, 1), (None, 3)]
+    assert additions == [] and moves == []
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# roundup.split over random weeks: row and label lengths, multibyte and escaped text, empty days and rows sized
+# right up to the limit. Each seed is one week, so a failure names the seed that reproduces it
+import random
+import pytest
+import roundup
+
+FOOTER = "\n\n---\n\n^[Unsubscribe](http://www.reddit.com/message/compose/?to=bot&subject=unsubscribe&message=x)"
+RESERVE = roundup.PART_HEADER.format(99) + FOOTER
+INTRO = "Welcome to The Weekly [Fresh]ness! <3 & more\n\n"
+ALPHABET = "abcdefghij KLMNOP 0123 -_()[]:&<>" + "éüñß" + "日本語" + "🎤🔥"
+
+
+def reddit(text):
+    # Characters and bytes the way reddit counts them, after its escaping
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return len(text), len(text.encode('utf-8'))
+
+
+def text(rng, length):
+    return "".join(rng.choice(ALPHABET) for _ in range(length))
+
+
+def week(rng, maxRow):
+    # (label, rows) for 7 days, rows numbered so a lost, repeated or reordered one shows
+    days = []
+    n = 0
+    for d in range(7):
+        label = "Day {} {}".format(d, text(rng, rng.randint(0, 40)))
+        rows = []
+        for _ in range(rng.choice([0, 0, 1, rng.randint(1, 80)])):
+            rows.append("[r{} {}](u) | [link](p) | 1 | /u/x\n".format(n, text(rng, rng.randint(0, maxRow))))
+            n += 1
+        days.append((label, rows))
+    return days
+
+
+def parse(part):
+    # The (label, row) pairs of a part, checking the part is made of whole days: label, table header, rows, DAY_END
+    pairs = []
+    rest = part
+    while rest:
+        assert rest.startswith("**")
+        label, rest = rest[2:].split("**" + roundup.TABLE_HEADER, 1)
+        rows = []
+        while rest.startswith("[r"):
+            row, rest = rest.split("\n", 1)
+            rows.append(row + "\n")
+        assert rows, "a day header without rows"
+        assert rest.startswith(roundup.DAY_END)
+        rest = rest[len(roundup.DAY_END):]
+        pairs.extend((label, row) for row in rows)
+    return pairs
+
+
+def check(days, parts, maxChars, maxBytes):
+    for i, part in enumerate(parts):
+        chars, bytes_ = reddit(RESERVE + (INTRO if i == 0 else "") + part)
+        assert chars <= maxChars, "part {} is {} characters".format(i, chars)
+        assert bytes_ <= maxBytes, "part {} is {} bytes".format(i, bytes_)
+    assert [f for part in parts for f in parse(part)] == [(label, row) for label, rows in days for row in rows]
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_weeks(seed):
+    rng = random.Random(seed)
+    maxChars = rng.choice([1000, 3000, 10000])
+    maxBytes = rng.choice([None, maxChars, maxChars // 2])
+    # Row text stays short enough to fit a part alone, at 5 bytes for the widest character
+    limit = maxChars if maxBytes is None else maxBytes
+    days = week(rng, maxRow=min(rng.choice([10, 100, 400]), (limit - 400) // 5))
+    parts = list(roundup.split(days, maxChars, maxBytes, reserve=RESERVE, firstReserve=INTRO))
+    check(days, parts, maxChars, maxChars if maxBytes is None else maxBytes)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_rows_at_the_limit(seed):
+    # Rows as long as fits a part on their own. Each takes a part, and fills it exactly
+    rng = random.Random(seed)
+    maxChars = rng.choice([1000, 10000])
+    label = text(rng, rng.randint(0, 20))
+    fixed = reddit(RESERVE + INTRO + "**" + label + "**" + roundup.TABLE_HEADER + roundup.DAY_END)
+    rows = []
+    for n in range(rng.randint(1, 5)):
+        row = "[r{} ".format(n)
+        left = maxChars - fixed[1] - reddit(row + "](u)\n")[1]
+        while left > 0:
+            row += rng.choice("ab&<>" if left >= 5 else "a")
+            left = maxChars - fixed[1] - reddit(row + "](u)\n")[1]
+        rows.append(row + "](u)\n")
+    days = [(label, rows)]
+    parts = list(roundup.split(days, maxChars, reserve=RESERVE, firstReserve=INTRO))
+    check(days, parts, maxChars, maxChars)
+    assert len(parts) == len(rows)
+
+
+def test_empty_days():
+    assert list(roundup.split([("Monday", []), ("Tuesday", [])], 1000)) == [""]
+    days = [("Monday", []), ("Tuesday", ["[r0 a](u)\n"]), ("Wednesday", [])]
+    assert list(roundup.split(days, 1000)) == ["**Tuesday**" + roundup.TABLE_HEADER + "[r0 a](u)\n" + roundup.DAY_END]
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_size_matches_reddit(seed):
+    rng = random.Random(seed)
+    sample = text(rng, rng.randint(0, 200))
+    assert roundup.size(sample) == reddit(sample)
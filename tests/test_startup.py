@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Each trigger run cold in a fresh interpreter against the fake reddit, held to an import time budget and kept
+# from loading the modules it doesn't need
+import os
+import subprocess
+import sys
+import pytest
+import fake_reddit
+
+# Per trigger: import time budget in ms and modules it must not load at all. Import time is what -X importtime
+# reports for every module loaded over the whole run, lazy imports included
+STARTUP_BUDGETS = [
+    ("help", 200, ["praw", "prawcore", "numpy", "tqdm", "spotipy", "unidecode"]),
+    ("checkMail", 350, ["numpy", "tqdm", "spotipy", "unidecode"]),
+    ("mailDaily", 350, ["numpy", "tqdm", "spotipy", "unidecode"]),
+    ("getFresh", 450, ["numpy", "spotipy"]),
+]
+STARTUP_SCRIPT = "import sys, vals; vals.cwd = sys.argv[1]; import HHHBot; HHHBot.main(['HHHBot.py', sys.argv[2]])"
+RUNS = 3  # Best of, import time is noisy
+
+
+@pytest.fixture(scope="module")
+def reddit(tmp_path_factory):
+    tmp = str(tmp_path_factory.mktemp("startup"))
+    server = fake_reddit.FakeReddit(ratelimit=10 ** 9).start()
+    # praw reads praw.ini from the working directory, that is how HHHBot's own client ends up at the fake
+    with open(os.path.join(tmp, "praw.ini"), "w") as f:
+        f.write("[DEFAULT]\noauth_url={url}\nreddit_url={url}\n".format(url=server.url))
+    yield tmp
+    server.stop()
+
+
+def startup(tmp, trigger):
+    # (import ms, modules loaded) of one cold run
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PRAW_ALLOW_ENDPOINT_OVERRIDE="1",
+               PYTHONPATH=os.pathsep.join([here] + [f for f in [os.environ.get("PYTHONPATH")] if f]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT, tmp, trigger], env=env, cwd=tmp,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    # "import time: self | cumulative | name", nested imports are indented under their importer
+    lines = [f.split("|") for f in result.stderr.splitlines() if f.startswith("import time:") and "|" in f]
+    lines = [f for f in lines if f[1].strip().isdigit()]
+    return sum(int(f[1]) for f in lines if not f[2].startswith("  ")) / 1000.0, set(f[2].strip() for f in lines)
+
+
+@pytest.mark.parametrize("trigger,budget,forbidden", STARTUP_BUDGETS)
+def test_startup(reddit, trigger, budget, forbidden):
+    runs = [startup(reddit, trigger) for _ in range(RUNS)]
+    imports = min(f[0] for f in runs)
+    assert imports <= budget, "{} imports took {}ms".format(trigger, imports)
+    for _, modules in runs:
+        assert sorted(f for f in forbidden if f in modules) == []
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Reports over the hot posts table, alone and together with archive.db
+import os
+import archive
+import schema
+import stats
+import storage
+
+DAY = 24 * 60 * 60
+NOW = 40 * DAY
+
+
+def fill(tmp, posts=20):
+    # posts one a day up to NOW, the older half moved to the archive. Returns (hot path, archive path)
+    hot = os.path.join(tmp, "fresh.db")
+    old = os.path.join(tmp, "archive.db")
+    db = schema.connect(hot)
+    db.executemany("INSERT INTO posts (ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER) VALUES (?,?,?,?,?,?,?)",
+                   [("p{}".format(i), "Title", "https://redd.it/p{}".format(i), "https://example.com/x", NOW - i * DAY,
+                     10 * i, "user{}".format(i % 3)) for i in range(posts)])
+    db.commit()
+    db.close()
+    store = archive.Archive(old)
+    repo = storage.SQLiteRepository(hot)
+    assert store.move(repo, NOW - (posts // 2 - 0.5) * DAY) == posts // 2
+    repo.close()
+    store.close()
+    return hot, old
+
+
+def report(hot, name, old=None):
+    pool = storage.SQLitePool(hot, size=1)
+    try:
+        with pool.reader() as db:
+            if old is not None:
+                assert stats.attach(db, old)
+            return stats.run(db, [name], 0)[0][2]
+    finally:
+        pool.close()
+
+
+def test_hot_only(tmp_path):
+    hot, old = fill(str(tmp_path))
+    assert dict(report(hot, "scores"))["Posts"] == 10
+    assert dict(report(hot, "scores"))["Max"] == 90
+
+
+def test_archive(tmp_path):
+    hot, old = fill(str(tmp_path))
+    assert dict(report(hot, "scores", old))["Posts"] == 20
+    assert dict(report(hot, "scores", old))["Max"] == 190
+    assert len(report(hot, "daily", old)) == 20
+    assert sum(f[1] for f in report(hot, "submitters", old)) == 20
+
+
+def test_archive_counts_a_post_once(tmp_path):
+    # A move that archived a chunk but died before deleting it from the hot table
+    hot, old = fill(str(tmp_path))
+    store = archive.Archive(old)
+    db = schema.connect(hot)
+    store.store(db.execute("SELECT ID, TITLE, PERMA, URL, TIME, SCORE, SUBMITTER FROM posts").fetchall())
+    store.close()
+    db.close()
+    assert dict(report(hot, "scores", old))["Posts"] == 20
+
+
+def test_nothing_archived(tmp_path):
+    hot = os.path.join(str(tmp_path), "fresh.db")
+    schema.connect(hot).close()
+    pool = storage.SQLitePool(hot, size=1)
+    with pool.reader() as db:
+        assert not stats.attach(db, os.path.join(str(tmp_path), "archive.db"))
+        assert stats.run(db, ["scores"], 0)[0][2] == []
+    pool.close()
+
+
+def test_spotify(tmp_path):
+    # From the per edition rows weeklyPlaylist saves, oldest week first
+    hot = os.path.join(str(tmp_path), "fresh.db")
+    db = schema.connect(hot)
+    db.executemany("INSERT INTO settings VALUES (?,?)", [
+        ("playlist:weekly-1970-02-01", '["https://open.spotify.com/playlist/b", 8, 10, 80.0]'),
+        ("playlist:weekly-1970-01-25", '["https://open.spotify.com/playlist/b", 5, 10, 50.0]'),
+        ("playlist:other-weekly-1970-02-01", '["https://open.spotify.com/playlist/o", 1, 4, 25.0]'),
+        ("spotify_playlist", "b")])
+    db.commit()
+    db.close()
+    assert [f[0] for f in report(hot, "spotify")] == ["weekly-1970-01-25", "other-weekly-1970-02-01",
+                                                      "weekly-1970-02-01"]
+    assert report(hot, "spotify")[0][1:] == [10, 5, 50.0, "https://open.spotify.com/playlist/b"]
+    pool = storage.SQLitePool(hot, size=1)
+    with pool.reader() as db:  # Only weeks still running after `since`
+        assert [f[0] for f in stats.run(db, ["spotify"], NOW - 5 * DAY)[0][2]] == ["other-weekly-1970-02-01",
+                                                                                  "weekly-1970-02-01"]
+    pool.close()
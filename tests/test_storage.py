@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# The repository contract, against a pooled and a shared connection SQLiteRepository and a PostgresRepository.
+# The PostgreSQL run needs a database to empty, set HHH_POSTGRES_DSN to one to run it
+import os
+import re
+import threading
+import time
+import pytest
+import roundup
+import storage
+
+NOW = time.time()
+DAY = int(NOW // 86400)
+POSTGRES_DSN = os.environ.get("HHH_POSTGRES_DSN")
+
+
+@pytest.fixture(params=["pool", "shared", "postgres"])
+def repo(request, tmp_path):
+    if request.param == "postgres":
+        if POSTGRES_DSN is None:
+            pytest.skip("HHH_POSTGRES_DSN isn't set")
+        repo = storage.PostgresRepository(POSTGRES_DSN)
+        with repo.pool.connection() as db:
+            c = db.cursor()
+            c.execute("TRUNCATE " + ", ".join(re.match(r"CREATE TABLE IF NOT EXISTS (\w+)", f).group(1)
+                                              for f in storage.POSTGRES_TABLES if f.startswith("CREATE TABLE")))
+            c.close()
+    else:
+        repo = storage.SQLiteRepository(os.path.join(str(tmp_path), "check.db"), shared=request.param == "shared")
+    yield repo
+    repo.close()
+
+
+def addPosts(repo, ids, roundup="fresh"):
+    repo.addPosts([(id_, "Title " + id_, "https://redd.it/" + id_, "https://example.com/" + id_, NOW - 60 * i, 100 * i,
+                    "u", DAY, "[" + id_ + "](url) | ", " | /u/u\n", roundup) for i, id_ in enumerate(ids)])
+
+
+def test_posts(repo):
+    ids = ["p0", "p1", "p2"]
+    addPosts(repo, ids)
+    repo.addPosts([("p0", "Changed", "", "", NOW, 5, "u", DAY, "", "", "fresh")])  # Existing IDs are ignored
+    assert repo.knownPosts(ids + ["missing"]) == set(ids)
+    assert [f[0] for f in repo.postsInWindow(NOW + 1, NOW - 3600)] == ["p2", "p1", "p0"]
+    assert repo.postsInWindow(NOW + 1, NOW - 3600)[-1][1] == "Title p0"
+
+    version = repo.postsVersion(NOW + 1, NOW - 3600, "fresh")
+    repo.updateScores([(999, "p0")])
+    assert repo.postsVersion(NOW + 1, NOW - 3600, "fresh") != version
+    assert repo.postsInWindow(NOW + 1, NOW - 3600)[0][0] == "p0"
+    assert (DAY, "[p0](url) | 999 | /u/u\n") in repo.roundupRows(NOW + 1, NOW - 3600, "fresh")
+    assert repo.roundupRows(NOW + 1, NOW - 3600, "other") == []
+
+
+def test_old_posts(repo):
+    addPosts(repo, ["p0", "p1", "p2"])
+    repo.scheduleRefresh([("p2", 1, 1, 60, 61)], [("p2", 1, 1)])
+    assert repo.postCount() == 3
+    assert repo.postCount(NOW - 30) == 2
+    assert [f[0] for f in repo.oldPosts(NOW - 30, 10)] == ["p2", "p1"]
+    assert [f[0] for f in repo.oldPosts(NOW - 30, 1)] == ["p2"]
+    repo.deletePosts(["p2", "p1"])
+    assert repo.knownPosts(["p0", "p1", "p2"]) == {"p0"}
+    addPosts(repo, ["p0", "p1", "p2"])  # The schedule went with the post, p2 is due as a new post again
+    assert [f[3] for f in repo.duePosts(NOW, 10) if f[0] == "p2"] == [None]
+
+
+def test_due_posts(repo):
+    addPosts(repo, ["p0", "p1", "p2", "p3"])
+    repo.scheduleRefresh([("p0", 100, 5, 60, 160), ("p1", 100, 5, 30, 130), ("p2", 100, 5, 600, 700)],
+                         [("p0", 100, 5), ("p1", 100, 5)])
+    # Never refreshed first, then the most overdue
+    assert [(f[0], f[3], f[4]) for f in repo.duePosts(200, 10)] == [("p3", None, None), ("p1", 5, 30), ("p0", 5, 60)]
+    assert [f[0] for f in repo.duePosts(200, 2)] == ["p3", "p1"]
+    repo.scheduleRefresh([("p1", 200, 9, 60, 260)], [("p1", 100, 7), ("p1", 200, 9)])
+    assert [f[0] for f in repo.duePosts(200, 10)] == ["p3", "p0"]
+
+
+def test_playlist_titles(repo):
+    addPosts(repo, ["p0", "p1", "p2"])
+    addPosts(repo, ["q0"], "other")
+    assert sorted(repo.playlistTitles("fresh", NOW - 90, 0)) == ["Title p0", "Title p1"]
+    assert sorted(repo.playlistTitles("fresh", NOW, 150)) == ["Title p0", "Title p1"]
+    assert repo.playlistTitles("other", NOW - 90, 0) == ["Title q0"]
+
+
+def test_posts_version_changes(repo):
+    # Edits that leave the window's count and score total as they were
+    addPosts(repo, ["p0", "p1", "p2"])
+    versions = [repo.postsVersion(NOW + 1, NOW - 3600, "fresh")]
+    repo.updateScores([(150, "p1"), (150, "p2")])  # p1 +50, p2 -50
+    versions.append(repo.postsVersion(NOW + 1, NOW - 3600, "fresh"))
+    repo.deletePosts(["p2"])
+    repo.addPosts([("p3", "Title p3", "", "", NOW - 120, 150, "u", DAY, "", "", "fresh")])  # p2's time and score
+    versions.append(repo.postsVersion(NOW + 1, NOW - 3600, "fresh"))
+    assert len(set(versions)) == 3
+    assert repo.postsVersion(NOW + 1, NOW - 3600, "fresh") == versions[-1]
+
+
+def test_posts_version_per_roundup(repo):
+    addPosts(repo, ["p0"])
+    version = repo.postsVersion(NOW + 1, NOW - 3600, "fresh")
+    addPosts(repo, ["q0"], "other")
+    assert repo.postsVersion(NOW + 1, NOW - 3600, "fresh") == version
+
+
+def test_subscriptions(repo):
+    repo.applySubscriptions([("a", "daily"), ("b", "both"), ("c", "weekly")], [])
+    repo.applySubscriptions([("c", "daily")], ["b"])
+    assert repo.subscriptions(["a", "b", "c"]) == {"a": "daily", "c": "daily"}
+    assert repo.subscribers(["daily", "both"]) == ["a", "c"]
+    repo.setFormats([("c", "full"), ("b", "full")])  # b isn't subscribed anymore
+    assert repo.subscribers(["daily"], "link") == ["a"]
+    assert repo.subscribers(["daily"], "full") == ["c"]
+    repo.applySubscriptions([("c", "both")], [])  # Changing lists keeps the format
+    assert repo.subscribers(["both"], "full") == ["c"]
+
+
+def test_outbox(repo):
+    repo.enqueue("e", [("Part 1", "a"), ("Part 2", "b")], ["a", "b"])
+    repo.enqueue("e", [("Part 1", "changed"), ("Part 2", "b")], ["a", "b"])  # A re-run adds nothing
+    assert [(f[0], f[1], f[3]) for f in repo.pendingJobs("e")] == [("a", 0, "a"), ("a", 1, "b"), ("b", 0, "a"),
+                                                                  ("b", 1, "b")]
+    repo.markJobs("e", [("a", 0, "sent", 1, None), ("a", 1, "failed", 5, "Forbidden")])
+    assert [(f[0], f[1]) for f in repo.pendingJobs("e")] == [("b", 0), ("b", 1)]
+    assert repo.editionCounts("e") == {"sent": 1, "failed": 1, "pending": 2}
+    assert repo.pendingEditions() == ["e"]
+
+
+def test_shard_leases(repo):
+    repo.enqueue("e", [("Part 1", "a")], ["a", "b", "c"], {"b": 3, "c": 3})
+    assert repo.pendingShards("e") == [0, 3]
+    assert [f[0] for f in repo.pendingJobs("e", 3)] == ["b", "c"]
+    assert repo.claimShard("e", 3, "w1", NOW + 60, NOW)
+    assert repo.claimShard("e", 3, "w1", NOW + 90, NOW)  # Its own lease
+    assert not repo.claimShard("e", 3, "w2", NOW + 60, NOW)
+    assert repo.renewLease("e", 3, "w1", NOW + 120)
+    assert repo.claimShard("e", 3, "w2", NOW + 300, NOW + 121)  # Expired, w1 crashed
+    assert not repo.renewLease("e", 3, "w1", NOW + 180)
+    repo.releaseShard("e", 3, "w1")  # Not its lease anymore, nothing happens
+    assert not repo.claimShard("e", 3, "w1", NOW + 60, NOW + 122)
+    repo.releaseShard("e", 3, "w2")
+    assert repo.claimShard("e", 3, "w1", NOW + 60, NOW + 122)
+
+
+def test_rate_limits(repo):
+    assert [repo.takeToken("a", NOW, 1.0, 3) for _ in range(3)] == [0, 0, 0]
+    assert repo.takeToken("a", NOW, 1.0, 3) == pytest.approx(1)
+    assert repo.takeToken("b", NOW, 1.0, 3) == 0  # Buckets are separate
+    assert repo.takeToken("a", NOW + 0.5, 1.0, 3) == pytest.approx(0.5)
+    assert repo.takeToken("a", NOW + 1, 1.0, 3) == 0
+    assert repo.takeToken("a", NOW + 100, 1.0, 3) == 0  # Refilled to capacity only
+    assert [repo.takeToken("a", NOW + 100, 1.0, 3) for _ in range(2)] == [0, 0]
+    assert repo.takeToken("a", NOW + 100, 1.0, 3) > 0
+    repo.setRate("a", 0, 0, NOW + 160)  # reddit says the window is spent
+    assert repo.takeToken("a", NOW + 110, 1.0, 3) == pytest.approx(50)
+    assert repo.takeToken("a", NOW + 161, 1.0, 3) == 0  # Back to the default rate after the reset
+
+
+def test_rate_limit_shared(repo, tmp_path):
+    # Two processes' repositories on the same store draw from one bucket
+    if isinstance(repo, storage.PostgresRepository):
+        other = storage.PostgresRepository(POSTGRES_DSN)
+    else:
+        other = storage.SQLiteRepository(os.path.join(str(tmp_path), "check.db"))
+    taken = []
+
+    def take(r):
+        for _ in range(20):
+            taken.append(r.takeToken("a", NOW, 1.0, 10) == 0)
+    threads = [threading.Thread(target=take, args=(f,)) for f in (repo, other, repo, other)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    other.close()
+    assert taken.count(True) == 10
+
+
+def test_publications(repo):
+    assert repo.publication("sub", "e") is None
+    repo.startPublication("sub", "e", "Title", ["a", "b"])
+    repo.markPublished("sub", "e", 0, "t3_x")
+    repo.startPublication("sub", "e", "Changed", ["c"])  # A re-run keeps what the first one saved
+    assert repo.publication("sub", "e") == ("Title", [(0, "a", "t3_x"), (1, "b", None)])
+    assert repo.publication("other", "e") is None
+
+
+def test_caches(repo):
+    assert repo.setting("k") is None and repo.setting("k", "x") == "x"
+    repo.setSetting("k", "1")
+    repo.setSetting("k", "2")
+    assert repo.setting("k") == "2"
+    key = ("fresh", 1, 2)
+    assert repo.roundup(key) is None
+    repo.putRoundup(key, "v1", [("text", "label", 1)], ["part"])
+    repo.putRoundup(key, "v2", [("text", "label", 2)], ["part 1", "part 2"])
+    assert repo.roundup(key) == ("v2", [("text", "label", 2)], ["part 1", "part 2"])
+    assert repo.roundup(("other", 1, 2)) is None
+    repo.putRoundup(("fresh", 5, 2), "v", [], [])
+    assert repo.pruneRoundups(5) == 1
+    assert repo.roundup(key) is None and repo.roundup(("fresh", 5, 2)) is not None
+
+
+def test_roundup_cache_prunes(repo):
+    cache = roundup.RoundupCache(repo, granularity=1, keep=10)
+    for start in range(0, 100, 5):
+        cache.put("fresh", start, 0, "v", [], [])
+    assert sorted(f[1] for f in cache.memory) == [85, 90, 95]
+    assert cache.get("fresh", 90, 0, "v") is not None
+    assert repo.roundup(("fresh", 80, 0)) is None
+
+
+def test_concurrent_writers(repo):
+    errors = []
+
+    def write(i):
+        try:
+            repo.applySubscriptions([("t{}".format(i), "weekly")], [])
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(repo.subscriptions(["t{}".format(i) for i in range(8)])) == 8
+
+
+def test_failed_block_rolls_back(repo):
+    # Whatever a block wrote before it raised is gone, and the connection is usable again
+    with pytest.raises(RuntimeError):
+        with repo.pool.connection() as db:
+            db.cursor().execute("INSERT INTO settings VALUES ('k', 'v')")
+            raise RuntimeError()
+    assert repo.setting("k") is None
+    repo.setSetting("k", "v")
+    assert repo.setting("k") == "v"
@@ -6,49 +6,122 @@ import time
 import requests
 import json
 import base64
+import re
+import ingest
 import logger
+import metrics
+import schema
+from multiprocessing.pool import ThreadPool
 from vals import SPOTIPI_CLIENT_SECRET, SPOTIPI_CLIENT_ID, SPOTIPI_REDIRECT_URL
 
 log = logger.get_logger(__name__)
 
+PLAYLIST = "Weekly r/HHHFreshness"
 
-def weekly_playlist(sqlite3_cursor):
-    log.debug("Beginning weekly_playlist...")
-    t = time.time()
-    c = sqlite3_cursor
-    c.execute("SELECT title FROM posts WHERE TIME>{} OR SCORE<{}".format(
-                    time.time() - 7*24*60*60,
-                    50
-                ))
-    weekly_songs = ["".join(f[0].split("] ")[1:]) for f in c.fetchall()]
-    log.info("There are {} songs this week!".format(len(weekly_songs)))
+NEGATIVE_TTL = 7 * 24 * 60 * 60  # Songs often land on spotify after the post, retry misses weekly
+SEARCH_WORKERS = 4
 
+TAGS = re.compile(r'^\s*(\[[^\]]*\]\s*)+')  # [FRESH], [FRESH VIDEO] ...
+CREDITS = re.compile(r'[\(\[][^\)\]]*\b(feat|ft|featuring|prod|produced|official|video|audio)\b[^\)\]]*[\)\]]', re.I)
+BARE_FEAT = re.compile(r'\s(feat|ft|featuring|prod)\b\.?\s.*$', re.I)
+SEPARATOR = re.compile(r'\s+[-\u2013\u2014]+\s+')
 
 
-    # Change this if you're wanting to use it and aren't me
-    username = 'iwishiwasaneagle'
-    scope = 'playlist-modify-public ugc-image-upload'
+def normalize(title):
+    # Post title to (artist, track), artist is None if the title isn't "Artist - Track"
+    title = TAGS.sub('', title.replace('\\', ''))
+    title = CREDITS.sub('', title)
+    parts = SEPARATOR.split(title, 1)
+    parts = [" ".join(BARE_FEAT.sub('', f).replace('"', '').split()).lower() for f in parts]
+    if len(parts) == 2 and parts[0] and parts[1]:
+        return parts[0], parts[1]
+    return None, parts[-1]
+
+
+def search_track(sp, artist, track):
+    if artist is None:
+        queries = [track]
+    else:
+        queries = ['artist:{} track:{}'.format(artist, track), '{} {}'.format(artist, track)]
+    for query in queries:
+        metrics.incr(metrics.API_CALLS)
+        items = sp.search(query, limit=1, type='track')['tracks']['items']
+        if items:
+            return items[0]['uri']
+    return None
+
+
+@metrics.timed("spotify_search")
+def resolve_tracks(sp, c, titles):
+    # Spotify URIs for titles, from the spotify_tracks cache where possible and a bounded search pool otherwise
+    keys = []
+    for title in titles:
+        artist, track = normalize(title)
+        keys.append((artist, track, track if artist is None else "{} - {}".format(artist, track)))
+
+    cached = {}
+    unique = list(set(f[2] for f in keys))
+    for i in range(0, len(unique), 500):
+        chunk = unique[i:i + 500]
+        c.execute("SELECT QUERY, URI, CHECKED FROM spotify_tracks WHERE QUERY IN ({})".format(",".join("?" * len(chunk))),
+                  chunk)
+        for query, uri, checked in c.fetchall():
+            if uri is not None or time.time() - checked < NEGATIVE_TTL:
+                cached[query] = uri
+
+    misses = dict((f[2], f) for f in keys if f[2] not in cached)
+
+    def search(key):
+        artist, track, query = misses[key]
+        try:
+            return query, search_track(sp, artist, track), None
+        except Exception as e:
+            return query, None, e
+
+    pool = ThreadPool(SEARCH_WORKERS)
+    try:
+        results = pool.map(search, list(misses.keys()))
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = []
+    for query, uri, err in results:
+        if err is not None:
+            log.error("Eror whilst searching for song with name '{}'".format(query))
+            log.error(err)
+            continue
+        cached[query] = uri
+        rows.append((query, uri, int(time.time())))
+    c.executemany("INSERT OR REPLACE INTO spotify_tracks VALUES (?,?,?)", rows)
+    c.connection.commit()
+    log.info("Resolved {} songs ({} distinct), {} were not cached and searched".format(len(titles), len(unique), len(misses)))
 
-    token = util.prompt_for_user_token(
-        username,
-        scope,
-        client_id=SPOTIPI_CLIENT_ID,
-        client_secret=SPOTIPI_CLIENT_SECRET,
-        redirect_uri=SPOTIPI_REDIRECT_URL)
-    log.debug("Spotify auth token received")
+    return [cached[f[2]] for f in keys if cached.get(f[2]) is not None]
 
-    sp = spotipy.Spotify(auth=token)
+
+def find_playlist(sp, c, username, name, token):
+    # The playlist ID is kept in settings so the user_playlists scan only happens once, per playlist name
+    key = 'spotify_playlist' if name == PLAYLIST else 'spotify_playlist:' + name
+    c.execute("SELECT VALUE FROM settings WHERE KEY=?", (key,))
+    row = c.fetchone()
+    if row is not None:
+        try:
+            return sp.playlist(row[0], fields='id,snapshot_id,external_urls')
+        except spotipy.SpotifyException as e:
+            if e.http_status != 404:
+                raise
+            log.info("Cached playlist {} no longer exists".format(row[0]))
 
     playlists = sp.user_playlists(username)
     weekly_playlist = None
-    name = "Weekly r/HHHFreshness"
     while playlists:
         for i, playlist in enumerate(playlists['items']):
             if name == playlist['name']:
                 weekly_playlist = playlist
                 log.debug("Found playlist with name {}".format(name))
                 break
-        if playlists['next']:
+        if playlists['next'] and weekly_playlist is None:
             playlists = sp.next(playlists)
         else:
             playlists = None
@@ -58,8 +131,8 @@ def weekly_playlist(sqlite3_cursor):
         weekly_playlist = sp.user_playlist_create(username, name)
 
         # Update playlist's description
-        url = "https://api.spotify.com/v1/playlists/{playlist_id}".format(
-            playlist_id = weekly_playlist['id']
+        url = "{prefix}playlists/{playlist_id}".format(
+            prefix = sp.prefix, playlist_id = weekly_playlist['id']
         )
         headers = {
             "Authorization":"Bearer {token}".format(token=token),
@@ -69,8 +142,8 @@ def weekly_playlist(sqlite3_cursor):
         requests.put(url, headers=headers, data=json.dumps(data))
 
         # Update playlist's cover photo
-        url = "https://api.spotify.com/v1/playlists/{playlist_id}/images".format(
-            playlist_id = weekly_playlist['id']
+        url = "{prefix}playlists/{playlist_id}/images".format(
+            prefix = sp.prefix, playlist_id = weekly_playlist['id']
         )
         headers = {
             "Authorization":"Bearer {token}".format(token=token),
@@ -80,34 +153,174 @@ def weekly_playlist(sqlite3_cursor):
             image = base64.b64encode(image.read())
             print(requests.put(url, headers=headers, data=image))
 
-    songs_in_playlist = sp.user_playlist_tracks(username, weekly_playlist['id'])
-    songs_in_playlist = [f['track']['uri'] for f in songs_in_playlist['items']]
+    c.execute("INSERT OR REPLACE INTO settings VALUES (?,?)", (key, weekly_playlist['id']))
+    c.connection.commit()
+    return weekly_playlist
 
-    songs_to_add = []
-    for song in weekly_songs:
-        try:
-            search = sp.search(song)
-            for i, result in enumerate(search["tracks"]['items']):
-                songs_to_add.append(result["uri"])
-                break
-        except Exception as e:
-            log.error("Eror whilst searching for song with name '{}'".format(song))
-            log.error(e)
+
+def playlist_tracks(sp, username, playlist_id):
+    # Every page of the playlist, not just the first 100 tracks. One entry per slot so positions line up with
+    # spotify's, None where the track is gone from spotify (plan_sync clears those slots)
+    page = sp.user_playlist_tracks(username, playlist_id, fields='items(track(uri)),next')
+    uris = []
+    while page:
+        uris.extend((f.get('track') or {}).get('uri') for f in page['items'])
+        page = sp.next(page) if page['next'] else None
+    return uris
+
+
+def unique(uris):
+    seen = set()
+    return [f for f in uris if not (f in seen or seen.add(f))]
+
+
+def stable_positions(ranks):
+    # Indices of a longest increasing subsequence of ranks, those tracks never have to move
+    tails = []
+    tailIndex = []
+    previous = [None] * len(ranks)
+    for i, rank in enumerate(ranks):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous[i] = tailIndex[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append(rank)
+            tailIndex.append(i)
+        else:
+            tails[lo] = rank
+            tailIndex[lo] = i
+    stable = set()
+    i = tailIndex[-1] if tailIndex else None
+    while i is not None:
+        stable.add(i)
+        i = previous[i]
+    return stable
+
+
+def plan_sync(current, target):
+    # Minimal (removals, additions, moves) turning the current playlist into target, duplicates and empty (None)
+    # slots dropped. Removals are (uri, position) against the current snapshot, moves are (range_start,
+    # insert_before) applied in order after the removals and additions
+    target = unique(target)
+    wanted = set(target)
+
+    kept = []
+    removals = []
+    seen = set()
+    for position, uri in enumerate(current):
+        if uri in wanted and uri not in seen:
+            kept.append(uri)
+            seen.add(uri)
+        else:
+            removals.append((uri, position))
+    additions = [f for f in target if f not in seen]
+
+    order = kept + additions
+    rank = dict((uri, i) for i, uri in enumerate(target))
+    stable = set(order[i] for i in stable_positions([rank[f] for f in order]))
+    moves = []
+    for i, uri in enumerate(target):
+        if uri in stable:
+            continue
+        # Spotify's insert_before is in the coordinates from before the move
+        start = order.index(uri)
+        before = order.index(target[i - 1]) + 1 if i else 0
+        if start == before:
+            continue
+        moves.append((start, before))
+        order.insert(before - 1 if start < before else before, order.pop(start))
+    return removals, additions, moves
+
+
+@metrics.timed("spotify_sync")
+def sync_playlist(sp, username, playlist, current, target, chunk=100):
+    removals, additions, moves = plan_sync(current, target)
+    snapshot = playlist.get('snapshot_id')
+
+    if any(uri is None for uri, position in removals):
+        # Spotify only removes tracks by URI and an empty slot has none, the playlist is written out afresh instead
+        target = unique(target)
+        snapshot = sp.user_playlist_replace_tracks(username, playlist['id'], target[:chunk])['snapshot_id']
+        for i in range(chunk, len(target), chunk):
+            snapshot = sp.user_playlist_add_tracks(username, playlist['id'], target[i:i + chunk])['snapshot_id']
+        metrics.incr(metrics.API_CALLS, max(-(-len(target) // chunk), 1))
+        log.info("Rewrote playlist with {} tracks, dropping {} empty slots".format(
+            len(target), len([f for f in current if f is None])))
+        return snapshot
+
+    # Highest positions first, so earlier chunks never shift the positions of later ones
+    removals.sort(key=lambda f: -f[1])
+    for i in range(0, len(removals), chunk):
+        tracks = {}
+        for uri, position in removals[i:i + chunk]:
+            tracks.setdefault(uri, []).append(position)
+        snapshot = sp.user_playlist_remove_specific_occurrences_of_tracks(
+            username, playlist['id'], [{'uri': uri, 'positions': p} for uri, p in tracks.items()],
+            snapshot_id=snapshot)['snapshot_id']
+
+    for i in range(0, len(additions), chunk):
+        snapshot = sp.user_playlist_add_tracks(username, playlist['id'], additions[i:i + chunk])['snapshot_id']
+
+    for start, before in moves:
+        snapshot = sp.user_playlist_reorder_tracks(username, playlist['id'], start, before,
+                                                   snapshot_id=snapshot)['snapshot_id']
+
+    metrics.incr(metrics.API_CALLS, -(-len(removals) // chunk) + -(-len(additions) // chunk) + len(moves))
+    log.info("Synced playlist: {} removed, {} added, {} moved, {} unchanged".format(
+        len(removals), len(additions), len(moves), len(current) - len(removals)))
+    return snapshot
+
+
+def weekly_playlist(sqlite3_cursor, sp=None, roundup=ingest.DEFAULT, name=PLAYLIST, titles=None):
+    # sp is an authorised spotipy client, by default one is created for the playlist owner. Only the posts of
+    # roundup go into the playlist called name. titles are the week's post titles, by default read from the
+    # cursor's posts table, HHHBot passes them from its store
+    log.debug("Beginning weekly_playlist...")
+    t = time.time()
+    c = sqlite3_cursor
+    if titles is None:
+        c.execute("SELECT title FROM posts WHERE ROUNDUP=? AND (TIME>? OR SCORE<?)", (
+                        roundup,
+                        time.time() - 7*24*60*60,
+                        50
+                    ))
+        titles = [f[0] for f in c.fetchall()]
+    weekly_songs = list(titles)
+    log.info("There are {} songs this week!".format(len(weekly_songs)))
+
+
+
+    # Change this if you're wanting to use it and aren't me
+    username = 'iwishiwasaneagle'
+    scope = 'playlist-modify-public ugc-image-upload'
+
+    if sp is None:
+        token = util.prompt_for_user_token(
+            username,
+            scope,
+            client_id=SPOTIPI_CLIENT_ID,
+            client_secret=SPOTIPI_CLIENT_SECRET,
+            redirect_uri=SPOTIPI_REDIRECT_URL)
+        log.debug("Spotify auth token received")
+
+        sp = spotipy.Spotify(auth=token)
+    else:
+        token = sp._auth
+
+    weekly_playlist = find_playlist(sp, c, username, name, token)
+    songs_in_playlist = playlist_tracks(sp, username, weekly_playlist['id'])
+
+    songs_to_add = resolve_tracks(sp, c, weekly_songs)
     log.info("{}/{} ({}%) of fresh songs have been found on spotify".format(
         len(songs_to_add), len(weekly_songs), round((100*len(songs_to_add))/len(weekly_songs),1)
     ))
 
-    songs_to_remove = [f for f in songs_in_playlist]
-    sp.user_playlist_remove_all_occurrences_of_tracks(
-        username,
-        weekly_playlist['id'],
-        songs_to_remove)
-
-    sp.user_playlist_add_tracks(
-        username,
-        weekly_playlist['id'],
-        songs_to_add
-    )
+    sync_playlist(sp, username, weekly_playlist, songs_in_playlist, songs_to_add)
 
     log.debug("weekly_playlist was succesfully run in {}s".format(time.time()-t))
     try:
@@ -119,6 +332,6 @@ def weekly_playlist(sqlite3_cursor):
 
 if __name__ == "__main__":
     log.debug("Running weekly_playlist test")
-    conn = sqlite3.connect("fresh.db")
+    conn = schema.connect("fresh.db")
     c = conn.cursor()
     weekly_playlist(c)